@@ -5,11 +5,13 @@ from .source import *
 from .block_source import *
 from .templates import *
 from .likelihood import *
+from .binned_likelihood import *
 from .inference import *
 from .bounds import *
 from .mu_estimation import *
 from .frozen_reservoir import *
 from .non_asymptotic_inference import *
+from .batched_fits import *
 
 # Original flamedisx models
 # Accessible under fd root package (for now), for backwards compatibility
@@ -0,0 +1,291 @@
+import typing as ty
+
+import flamedisx as fd
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+export, __all__ = fd.exporter()
+
+o = tf.newaxis
+
+
+@export
+class BatchedToyFitter():
+    """Fit the rate multipliers of many toy datasets at once, for likelihoods
+    whose sources have fixed shapes: ColumnSources (e.g. TemplateSources and
+    FrozenReservoirSources) in a LogLikelihood, or template sources in a
+    BinnedLogLikelihood. The only fit parameters must be rate multipliers.
+
+    The differential rates of each toy's events under each source (or, for a
+    binned likelihood, the expected events per bin) are stacked into one
+    (n_toys, n_events, n_sources) tensor. A damped Newton optimization then
+    runs over all toys simultaneously, in float64. The log constraint is
+    evaluated with (n_toys,) tensors of parameters and extra arguments, so it
+    must be an elementwise function of them.
+
+    Arguments:
+        - likelihood: fd.LogLikelihood or fd.BinnedLogLikelihood, with a single
+            dataset. Its data is not used or modified.
+        - max_iterations: maximum number of Newton iterations
+        - tolerance: stop once no toy's log likelihood improves by more than this
+    """
+    def __init__(self, likelihood, max_iterations=100, tolerance=1e-8):
+        assert len(likelihood.dsetnames) == 1, \
+            "BatchedToyFitter supports a single dataset only"
+        for pname in likelihood.param_names:
+            if not pname.endswith('_rate_multiplier'):
+                raise ValueError(
+                    f"BatchedToyFitter can only fit rate multipliers, "
+                    f"but the likelihood has a parameter {pname}")
+
+        self.binned = isinstance(likelihood, fd.BinnedLogLikelihood)
+        for sname, source in likelihood.sources.items():
+            if not (self.binned or isinstance(source, fd.ColumnSource)):
+                raise ValueError(
+                    f"Source {sname} does not have a precomputed differential "
+                    f"rate, cannot use BatchedToyFitter")
+
+        self.likelihood = likelihood
+        self.max_iterations = max_iterations
+        self.tolerance = tolerance
+
+        self.source_names = list(likelihood.sources.keys())
+        self.param_names = [f'{sname}_rate_multiplier'
+                            for sname in self.source_names]
+
+        # Sources without a rate multiplier are fixed at 1
+        self.bounds = dict()
+        for pname in self.param_names:
+            if pname not in likelihood.param_names:
+                self.bounds[pname] = (1., 1.)
+                continue
+            left, right = likelihood.default_bounds.get(pname, (None, None))
+            self.bounds[pname] = (
+                fd.LOWER_RATE_MULTIPLIER_BOUND if left is None else left,
+                np.inf if right is None else right)
+
+        if self.binned:
+            # (n_bins, n_sources) array of expected events per bin.
+            # Sources' shape parameters are not fitted, so evaluate at
+            # their defaults.
+            self.expected_events_per_bin = np.stack([
+                source.expected_events_per_bin(
+                    source.ptensor_from_kwargs()).numpy()
+                for source in likelihood.sources.values()], axis=1)
+            self.mus = tf.constant(
+                self.expected_events_per_bin.sum(axis=0), dtype=tf.float64)
+        else:
+            self.mus = tf.constant([
+                float(likelihood.mu_estimators[sname]())
+                for sname in self.source_names], dtype=tf.float64)
+
+    def rate_matrix(self, toy_datasets):
+        """Return (rates, weights) tensors for a list of toy datasets.
+        rates is an (n_toys, n_events, n_sources) tensor of differential rates
+        (or expected events per bin), weights is an (n_toys, n_events) tensor
+        of event counts (one, or zero for padding, for unbinned toys).
+        """
+        if self.binned:
+            # Same expected events per bin for each toy
+            expected = self.expected_events_per_bin
+            counts = np.stack([
+                self.likelihood.histogram(d) if isinstance(d, pd.DataFrame)
+                else np.asarray(d, dtype=float)
+                for d in toy_datasets])
+            rates = np.broadcast_to(expected[o], counts.shape + expected.shape[-1:])
+            return (tf.constant(rates, dtype=tf.float64),
+                    tf.constant(counts, dtype=tf.float64))
+
+        n_events = max(1, max(len(d) for d in toy_datasets))
+        rates = np.ones((len(toy_datasets), n_events, len(self.source_names)))
+        weights = np.zeros((len(toy_datasets), n_events))
+        for toy_i, d in enumerate(toy_datasets):
+            # Annotate a copy, so the caller's toys are not modified
+            d = self.likelihood.annotate_data(d.copy())
+            rates[toy_i, :len(d)] = np.stack([
+                d[self.likelihood.sources[sname].column].values
+                for sname in self.source_names], axis=1)
+            weights[toy_i, :len(d)] = 1.
+        return (tf.constant(rates, dtype=tf.float64),
+                tf.constant(weights, dtype=tf.float64))
+
+    def _log_likelihood(self, rms, rates, weights, constraint_args):
+        """Return (n_toys,) tensor of log likelihoods (up to a constant)
+        at the (n_toys, n_sources) rate multipliers rms
+        """
+        expected = tf.reduce_sum(rms[:, o, :] * rates, axis=2)
+        ll = tf.reduce_sum(tf.math.xlogy(weights, expected), axis=1)
+        ll -= tf.reduce_sum(rms * self.mus[o, :], axis=1)
+        params = {pname: x
+                  for pname, x in zip(self.param_names, tf.unstack(rms, axis=1))
+                  if pname in self.likelihood.param_names}
+        constraint = self.likelihood.log_constraint(**params, **constraint_args)
+        return ll + tf.cast(constraint, tf.float64)
+
+    def _log_likelihood_grad_hess(self, rms, rates, weights, constraint_args):
+        """Return log likelihoods, (n_toys, n_sources) gradients, and
+        (n_toys, n_sources, n_sources) Hessians at the rate multipliers rms
+        """
+        # Toys are independent, so gradients of sums over toys give the
+        # per-toy gradients. This is much faster than batch_jacobian.
+        with tf.GradientTape(persistent=True) as outer_tape:
+            outer_tape.watch(rms)
+            with tf.GradientTape() as tape:
+                tape.watch(rms)
+                ll = self._log_likelihood(rms, rates, weights, constraint_args)
+            grad = tape.gradient(
+                ll, rms, unconnected_gradients=tf.UnconnectedGradients.ZERO)
+            grad_components = tf.unstack(grad, axis=1)
+        hess = tf.stack([
+            outer_tape.gradient(
+                g, rms, unconnected_gradients=tf.UnconnectedGradients.ZERO)
+            for g in grad_components], axis=1)
+        del outer_tape
+        return ll, grad, hess
+
+    def _params_array(self, params, n_toys, fallback):
+        """Return (n_toys, n_sources) array of parameter values from a dict
+        {param: scalar or (n_toys,) array}, filling in missing parameters
+        with fallback(param)
+        """
+        return np.stack([
+            np.broadcast_to(np.asarray(
+                params[pname] if pname in params else fallback(pname),
+                dtype=float), (n_toys,))
+            for pname in self.param_names], axis=1)
+
+    def bestfit(self,
+                toy_datasets: ty.Union[list, ty.Tuple[tf.Tensor, tf.Tensor]],
+                guess: ty.Dict[str, ty.Union[float, np.ndarray]] = None,
+                fix: ty.Dict[str, ty.Union[float, np.ndarray]] = None,
+                constraint_extra_args: ty.Union[list, dict] = None):
+        """Return (best_fits, ll): a dictionary {param: (n_toys,) array}
+        of best-fit rate multipliers, including any fixed ones,
+        and an (n_toys,) array of log likelihoods at the best fits.
+
+        Arguments:
+            - toy_datasets: list of toy datasets (DataFrames, or arrays of counts
+                per bin for a binned likelihood), or the result of rate_matrix
+            - guess: dictionary {param: guess} of scalars or (n_toys,) arrays.
+                Missing parameters are guessed at the likelihood's defaults
+            - fix: dictionary {param: value} of parameters to keep fixed
+            - constraint_extra_args: list of dictionaries with the constraint
+                extra arguments for each toy, or dictionary {arg: (n_toys,) array}
+        """
+        if isinstance(toy_datasets, tuple):
+            rates, weights = toy_datasets
+        else:
+            rates, weights = self.rate_matrix(toy_datasets)
+        n_toys = rates.shape[0]
+        if guess is None:
+            guess = dict()
+        if fix is None:
+            fix = dict()
+        if constraint_extra_args is None:
+            constraint_extra_args = dict()
+        if isinstance(constraint_extra_args, (list, tuple)):
+            constraint_extra_args = {
+                k: [float(args[k]) for args in constraint_extra_args]
+                for k in constraint_extra_args[0]} if len(constraint_extra_args) else dict()
+        constraint_args = {
+            k: tf.constant(np.broadcast_to(np.asarray(v, dtype=float), (n_toys,)),
+                           dtype=tf.float64)
+            for k, v in constraint_extra_args.items()}
+
+        # (n_toys, n_sources) bounds; fixed parameters have equal bounds
+        lower = self._params_array(
+            fix, n_toys, fallback=lambda pname: self.bounds[pname][0])
+        upper = self._params_array(
+            fix, n_toys, fallback=lambda pname: self.bounds[pname][1])
+        is_fixed = lower == upper
+        defaults = {pname: self.likelihood.param_defaults[pname].numpy()
+                    if pname in self.likelihood.param_defaults else 1.
+                    for pname in self.param_names}
+        rms = self._params_array(guess, n_toys, fallback=defaults.get)
+        rms = np.clip(rms, lower, upper)
+
+        def log_likelihood(x):
+            return self._log_likelihood(
+                tf.constant(x), rates, weights, constraint_args).numpy()
+
+        for _ in range(self.max_iterations):
+            ll, grad, hess = [x.numpy() for x in self._log_likelihood_grad_hess(
+                tf.constant(rms), rates, weights, constraint_args)]
+
+            # Parameters at a bound, with the gradient pointing out of bounds,
+            # are kept fixed in this iteration
+            free = ~(is_fixed
+                     | ((rms <= lower) & (grad < 0))
+                     | ((rms >= upper) & (grad > 0)))
+            grad = np.where(free, grad, 0.)
+            free_2d = free[:, :, o] & free[:, o, :]
+            eye = np.eye(len(self.param_names))[o]
+            hess = np.where(free_2d, hess, -eye)
+            # The log likelihood is concave in the rate multipliers,
+            # but guard against a numerically singular Hessian
+            hess -= 1e-12 * np.abs(hess).max() * eye
+            step = -np.linalg.solve(hess, grad[..., o])[..., 0]
+            step = np.where(np.isfinite(step), step, 0.)
+
+            # Backtracking line search, per toy
+            step_size = np.ones(n_toys)
+            improved = np.zeros(n_toys, dtype=bool)
+            for _ in range(30):
+                rms_try = np.clip(rms + step_size[:, o] * step, lower, upper)
+                ll_try = log_likelihood(rms_try)
+                accept = np.isfinite(ll_try) & (ll_try >= ll)
+                improved |= accept
+                if np.all(improved):
+                    break
+                step_size = np.where(improved, step_size, step_size / 2)
+            rms_new = np.clip(rms + step_size[:, o] * step, lower, upper)
+            rms = np.where(improved[:, o], rms_new, rms)
+            ll_new = np.where(improved, log_likelihood(rms), ll)
+
+            converged = np.all(ll_new - ll <= self.tolerance)
+            ll = ll_new
+            if converged:
+                break
+
+        best_fits = {pname: rms[:, i]
+                     for i, pname in enumerate(self.param_names)
+                     if pname in self.likelihood.param_names}
+        return best_fits, ll
+
+    def test_statistic(self,
+                       test_statistic: fd.TestStatistic.__class__,
+                       toy_datasets: list,
+                       mu_test: float,
+                       signal_source_name: str,
+                       guess: ty.Dict[str, ty.Union[float, np.ndarray]],
+                       constraint_extra_args: ty.Union[list, dict] = None):
+        """Return (ts, bf_unconditional, bf_conditional) for a list of toy
+        datasets: an (n_toys,) array of test statistics, and dictionaries
+        {param: (n_toys,) array} of the unconditional and conditional best fits.
+
+        Arguments:
+            - test_statistic: class type of the test statistic
+            - toy_datasets: list of toy datasets, as for bestfit
+            - mu_test: signal rate multiplier to fix in the conditional fit
+            - signal_source_name: name of the signal source
+            - guess: dictionary {param: guess} for the unconditional fit.
+                The conditional fit uses the same guesses for the nuisance parameters
+            - constraint_extra_args: as for bestfit
+        """
+        rate_matrix = self.rate_matrix(toy_datasets)
+        fix_dict = {f'{signal_source_name}_rate_multiplier': mu_test}
+
+        guess_nuisance = guess.copy()
+        guess_nuisance.pop(f'{signal_source_name}_rate_multiplier')
+
+        bf_conditional, ll_conditional = self.bestfit(
+            rate_matrix, guess=guess_nuisance, fix=fix_dict,
+            constraint_extra_args=constraint_extra_args)
+        bf_unconditional, ll_unconditional = self.bestfit(
+            rate_matrix, guess=guess,
+            constraint_extra_args=constraint_extra_args)
+
+        ts = test_statistic(self.likelihood).evaluate_from_ll(
+            ll_conditional, ll_unconditional)
+        return ts, bf_unconditional, bf_conditional
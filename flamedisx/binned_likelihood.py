@@ -0,0 +1,182 @@
+import typing as ty
+import warnings
+
+import flamedisx as fd
+import numpy as np
+import pandas as pd
+import tensorflow as tf
+
+export, __all__ = fd.exporter()
+
+
+@export
+class BinnedLogLikelihood(fd.LogLikelihood):
+    """Extended binned Poisson likelihood, for sources that are all
+    TemplateSources or MultiTemplateSources with the same binning.
+
+    Data is histogrammed onto the template binning once, in set_data.
+    Evaluating the likelihood then costs O(n_bins), regardless of the number
+    of events. Data can also be set directly as an array of counts per bin,
+    e.g. from simulate_binned, which draws Poisson counts in each bin.
+
+    Expected events are computed from the templates' events per bin, so
+    events outside the template range are ignored, and template interpolation
+    (interpolate=True) is not used.
+
+    Arguments are the same as for LogLikelihood; batch_size is irrelevant.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self._bins_checked = False
+        super().__init__(*args, **kwargs)
+
+    def _check_bins(self):
+        """Check all sources are template sources with the same binning"""
+        if self._bins_checked:
+            return
+        self.bin_edges = dict()
+        self.axis_names = dict()
+        for dsetname in self.dsetnames:
+            for sname in self.sources_in_dset[dsetname]:
+                s = self.sources[sname]
+                if not isinstance(s, (fd.TemplateSource, fd.MultiTemplateSource)):
+                    raise ValueError(
+                        f"Source {sname} is not a template source, "
+                        f"cannot use a binned likelihood")
+                if dsetname not in self.bin_edges:
+                    self.bin_edges[dsetname] = s.bin_edges
+                    self.axis_names[dsetname] = tuple(s.final_dimensions)
+                    continue
+                if (tuple(s.final_dimensions) != self.axis_names[dsetname]
+                        or len(s.bin_edges) != len(self.bin_edges[dsetname])
+                        or not all(
+                            len(e1) == len(e2) and np.allclose(e1, e2)
+                            for e1, e2 in zip(s.bin_edges, self.bin_edges[dsetname]))):
+                    raise ValueError(
+                        f"Source {sname} has a different binning than other "
+                        f"sources in dataset {dsetname}")
+        self._bins_checked = True
+
+    def histogram(self, data: pd.DataFrame, dsetname=fd.likelihood.DEFAULT_DSETNAME):
+        """Return (n_bins,) array of event counts of data in the template bins
+        of dataset dsetname, flattened in C order
+        """
+        self._check_bins()
+        counts, _ = np.histogramdd(
+            np.stack([data[dim].values for dim in self.axis_names[dsetname]],
+                     axis=1),
+            bins=self.bin_edges[dsetname])
+        n_outside = len(data) - counts.sum()
+        if n_outside:
+            warnings.warn(f"{n_outside:.0f} events are outside the template "
+                          f"binning and will be ignored")
+        return counts.ravel()
+
+    def set_data(self,
+                 data: ty.Union[pd.DataFrame, np.ndarray,
+                                ty.Dict[str, ty.Union[pd.DataFrame, np.ndarray]]],
+                 data_is_annotated=False,
+                 update_guesses=True):
+        """Set new data for the likelihood. Data can be passed as for
+        LogLikelihood.set_data, or as arrays of event counts per bin
+        (flattened in C order) instead of DataFrames.
+        data_is_annotated is ignored, since template bins need no annotation.
+        """
+        self._check_bins()
+        if not isinstance(data, dict):
+            assert len(self.dsetnames) == 1, \
+                "You passed data for one dataset but there are multiple datasets"
+            data = {fd.likelihood.DEFAULT_DSETNAME: data}
+
+        if any([d is None for d in data.values()]):
+            self.counts = dict()
+            self.data_tensors = dict()
+            return
+
+        if not hasattr(self, 'counts'):
+            self.counts = dict()
+        for dsetname, _data in data.items():
+            if isinstance(_data, pd.DataFrame):
+                _data = self.histogram(_data, dsetname)
+            self.counts[dsetname] = np.asarray(_data, dtype=float)
+
+        if update_guesses:
+            self._update_rate_multiplier_guesses(
+                {dsetname: self.counts[dsetname].sum() for dsetname in data})
+
+        # The batch info is not used, but _log_likelihood expects it
+        self.batch_info = tf.zeros((len(self.dsetnames), 3),
+                                   dtype=fd.int_type())
+        # A single 'batch' per dataset, with the counts
+        self.data_tensors = {
+            dsetname: fd.np_to_tf(counts[None, :])
+            for dsetname, counts in self.counts.items()}
+
+    def annotate_data(self, data):
+        """Binned likelihoods need no annotation; returns data unchanged"""
+        return data
+
+    def _n_batches(self, dsetname):
+        if dsetname in getattr(self, 'counts', dict()):
+            return 1
+        return 0
+
+    def expected_events_per_bin(self, source_name, **params):
+        """Return (n_bins,) tensor of expected events in each bin from
+        the source source_name, including its rate multiplier
+        """
+        s = self.sources[source_name]
+        ptensor = s.ptensor_from_kwargs(
+            **self._filter_source_kwargs(params, source_name))
+        return (self._get_rate_mult(source_name, params)
+                * s.expected_events_per_bin(ptensor))
+
+    def mu(self, *,
+           source_name=None,
+           dataset_name=None,
+           **kwargs):
+        """Return expected number of events
+        :param dataset_name: ... for just this dataset
+        :param source_name: ... for just this source.
+        You must provide either dsetname or source, since it makes no sense to
+        add events from multiple datasets
+        """
+        kwargs = {**self.param_defaults, **kwargs}
+        if dataset_name is None and source_name is None:
+            raise ValueError("Provide either source or dataset name")
+        mu = tf.constant(0., dtype=fd.float_type())
+        for sname in self.sources:
+            if (dataset_name is not None
+                    and self.dset_for_source[sname] != dataset_name):
+                continue
+            if source_name is not None and sname != source_name:
+                continue
+            mu += tf.reduce_sum(self.expected_events_per_bin(sname, **kwargs))
+        return mu
+
+    def _log_likelihood_inner(self, i_batch, params,
+                              dsetname, data_tensor, batch_info):
+        """Return log likelihood contribution of the binned dataset
+        (without the -mu term, and the constant -log(n!) terms)
+        """
+        expected = tf.add_n([
+            self.expected_events_per_bin(sname, **params)
+            for sname in self.sources_in_dset[dsetname]])
+        # xlogy is 0 (with zero gradient) for empty bins
+        return tf.reduce_sum(tf.math.xlogy(data_tensor, expected))
+
+    def simulate_binned(self, **params):
+        """Return array of event counts per bin (flattened in C order),
+        drawn from Poisson distributions around the expected events per bin.
+        If there are multiple datasets, return a dict {dataset_name: counts}.
+        """
+        params = self.prepare_params(params, free_all_rates=True)
+        result = dict()
+        for dsetname in self.dsetnames:
+            expected = sum([
+                self.expected_events_per_bin(sname, **params).numpy()
+                for sname in self.sources_in_dset[dsetname]])
+            result[dsetname] = np.random.poisson(expected).astype(float)
+        if len(self.dsetnames) == 1:
+            return result[self.dsetnames[0]]
+        return result
@@ -1,3 +1,5 @@
+import hashlib
+import inspect
 import typing as ty
 
 import numpy as np
@@ -65,6 +67,20 @@ class Block:
     #: for variable tensor stepping
     max_dim_size: ty.Dict[str, int] = dict()
 
+    #: Whether the block implements _simulation_weight, so its simulations
+    #: can be reweighted to other parameters (see fd.ReweightedMu)
+    reweightable = False
+
+    #: Whether annotate only adds or replaces columns of the data, without
+    #: other side effects, so sources with the same block can share its
+    #: annotations (see BlockModelSource._annotate_blocks_cached)
+    share_annotations = True
+
+    #: Source attributes, besides model functions and attributes,
+    #: that annotate depends on
+    annotation_attributes: ty.Tuple[str] = (
+        'max_sigma', 'max_sigma_outer', 'bounds_prob', 'bounds_prob_outer')
+
     def __init__(self, source):
         self.source = source
         assert len(self.dimensions) in (1, 2), \
@@ -133,10 +149,19 @@ class Block:
         assert return_value is None, f"_simulate of {self} should return None"
         # Check necessary columns were actually added
         for dim in self.dimensions:
-            assert dim in d.columns, f"_simulate of {self} must set {dim}"
-            assert np.all(np.isfinite(d[dim].values)), \
+            assert dim in d, f"_simulate of {self} must set {dim}"
+            assert np.all(np.isfinite(np.asarray(d[dim]))), \
                 f"_simulate of {self} returned non-finite values of {dim}"
 
+    def simulation_weight(self, d, data_tensor, ptensor):
+        """Return (log_prob, acceptance) of simulated events, see
+        _simulation_weight
+        """
+        log_prob, acceptance = self._simulation_weight(d, data_tensor, ptensor)
+        n_events = data_tensor.shape[0]
+        return (tf.broadcast_to(tf.cast(log_prob, fd.float_type()), (n_events,)),
+                tf.broadcast_to(tf.cast(acceptance, fd.float_type()), (n_events,)))
+
     def annotate(self, d: pd.DataFrame):
         """Add _min and _max for each dimension to d in-place"""
         return_value = self._annotate(d)
@@ -154,6 +179,26 @@ class Block:
                           <= d[f'{dim}_max'].values), \
                 f"_annotate of {self} set misordered bounds"
 
+    def annotation_fingerprint(self):
+        """Return hashable fingerprint of everything annotate depends on,
+        other than the data: the block class, the values of its model
+        functions and attributes, the defaults of the parameters the model
+        functions take, and the annotation_attributes of the source.
+
+        Blocks of different sources with equal fingerprints add the same
+        columns when annotating the same data.
+        """
+        source = self.source
+        result = [type(self)]
+        for name in self.model_functions + self.model_attributes:
+            result.append((name, _fingerprint(getattr(self, name, None))))
+            for pname in source.f_params.get(name, []):
+                result.append(
+                    (pname, _fingerprint(source.defaults[pname])))
+        for name in self.annotation_attributes:
+            result.append((name, _fingerprint(getattr(source, name, None))))
+        return tuple(result)
+
     def annotate_special(self, d: pd.DataFrame):
         """Will be called after annotate for any blocks which choose to implement it.
         """
@@ -182,6 +227,10 @@ class Block:
 
         Use the p_accepted column to modify acceptances; do not remove
         events here.
+
+        d is a DataFrame, or, if the source uses columnar simulation,
+        a dictionary of numpy arrays. Draw random numbers from
+        self.source.rng, rather than np.random or scipy.stats.
         """
         raise NotImplementedError
 
@@ -189,6 +238,18 @@ class Block:
         """Add _min and _max for each dimension to d in-place"""
         raise NotImplementedError
 
+    def _simulation_weight(self, d, data_tensor, ptensor):
+        """Return (log_prob, acceptance): (n_events,) tensors with the
+        log probability (density) of the values _simulate drew for simulated
+        events, and the acceptance _simulate applied to them, under the
+        parameters in ptensor.
+
+        :param d: Dictionary {dimension: (n_events,) tensor} of the simulated
+            values of all dimensions
+        :param data_tensor: (n_events, n_columns) tensor of the simulated events
+        """
+        raise NotImplementedError
+
     def _annotate_special(self, d):
         """Will be called after annotate for any blocks which choose to implement it.
 
@@ -241,6 +302,13 @@ class BlockModelSource(fd.IntegratingSource):
     #: Dimensions provided by the first block
     initial_dimensions: tuple
 
+    #: If True, simulate with events in a dictionary of numpy arrays rather
+    #: than a DataFrame, and draw random numbers from a counter-based
+    #: (Philox) generator. This is faster for large simulations. All blocks
+    #: (and add_extra_columns) must support it: the LXe blocks do, the NEST
+    #: blocks do not yet.
+    columnar_simulation = False
+
     def __init__(self, *args, **kwargs):
         if isinstance(self.model_blocks[0], FirstBlock):
             # Blocks have already been instantiated
@@ -489,20 +557,40 @@ class BlockModelSource(fd.IntegratingSource):
             b.check_data()
 
     def _simulate_response(self):
-        # All blocks after the first help to simulate the response
-        d = self.data
-        d['p_accepted'] = 1.   # Cut on p_accepted is made in Source.simulate
-        for b in self.model_blocks[1:]:
-            b.simulate(d)
-        return d
+        if not self.columnar_simulation:
+            # All blocks after the first help to simulate the response
+            d = self.data
+            d['p_accepted'] = 1.   # Cut on p_accepted is made in Source.simulate
+            for b in self.model_blocks[1:]:
+                b.simulate(d)
+            return d
+
+        # Keep events in a dictionary of arrays until all blocks are done,
+        # and use a counter-based generator seeded from the numpy random state.
+        df = self.data
+        d = {col: df[col].values for col in df.columns}
+        d['p_accepted'] = np.ones(len(df))
+        self.data = d
+        self.rng = np.random.Generator(np.random.Philox(
+            np.random.randint(2**32, size=4, dtype=np.uint64)))
+        try:
+            for b in self.model_blocks[1:]:
+                b.simulate(d)
+        finally:
+            self.data = df
+            del self.rng
+        return pd.DataFrame(d)
 
     def _annotate(self):
         d = self.data
         # By going in reverse order through the blocks, we can use the bounds
         # on hidden variables closer to the final signals (easy to compute)
         # for estimating the bounds on deeper hidden variables.
-        for b in self.model_blocks[::-1]:
-            b.annotate(d)
+        if self._annotation_cache is None:
+            for b in self.model_blocks[::-1]:
+                b.annotate(d)
+        else:
+            self._annotate_blocks_cached(d, self._annotation_cache)
 
         # Next, we obtain any desired hidden variable priors, in case we want
         # to improve the bounds estimation for any hidden variables.
@@ -514,6 +602,36 @@ class BlockModelSource(fd.IntegratingSource):
         for b in self.model_blocks[::-1]:
             b.annotate_special(d)
 
+    def _annotate_blocks_cached(self, d, cache):
+        """Annotate d with the blocks in reverse order, reusing columns
+        other sources computed when annotating the same data.
+
+        :param cache: Dictionary shared between sources, mapping
+            fingerprints of the annotation state to the columns
+            the next block added or replaced.
+        """
+        # The columns a block adds depend on the data, and on the
+        # annotations of the blocks before it. Once a source's block
+        # differs from that of other sources, so do all later annotations.
+        key = _fingerprint_data(d)
+        for b in self.model_blocks[::-1]:
+            if key is None or not b.share_annotations:
+                key = None
+                b.annotate(d)
+                continue
+            key = (key, b.annotation_fingerprint())
+            if key in cache:
+                for column, values in cache[key].items():
+                    d[column] = values.copy()
+                continue
+            before = {column: d[column].values for column in d.columns}
+            b.annotate(d)
+            cache[key] = {
+                column: d[column].values.copy()
+                for column in d.columns
+                if not (column in before and np.may_share_memory(
+                    d[column].values, before[column]))}
+
     def mu_before_efficiencies(self, **params):
         return self.model_blocks[0].mu_before_efficiencies(**params)
 
@@ -551,3 +669,34 @@ class BlockModelSource(fd.IntegratingSource):
 
 class BlockNotFoundError(Exception):
     pass
+
+
+def _fingerprint(x):
+    """Return hashable fingerprint of a model function or attribute"""
+    if inspect.ismethod(x):
+        if isinstance(x.__self__, Block):
+            # Source attributes the method uses must be listed in
+            # the block's annotation_attributes
+            return x.__func__
+        return x.__func__, type(x.__self__)
+    if isinstance(x, (tf.Tensor, tf.Variable, np.ndarray)):
+        x = np.ascontiguousarray(x)
+        return (str(x.dtype), x.shape, hashlib.sha1(x.tobytes()).hexdigest())
+    try:
+        hash(x)
+    except TypeError:
+        return repr(x)
+    return x
+
+
+def _fingerprint_data(d):
+    """Return fingerprint of the columns of the DataFrame d"""
+    h = hashlib.sha1()
+    for column in sorted(d.columns):
+        values = d[column].values
+        if values.dtype == object:
+            # Array-valued column
+            values = np.stack(values)
+        h.update(f'{column}:{values.dtype}:{values.shape}'.encode())
+        h.update(np.ascontiguousarray(values).tobytes())
+    return h.hexdigest()
@@ -1,4 +1,5 @@
 import typing as ty
+import numpy as np
 import pandas as pd
 import pickle as pkl
 
@@ -6,11 +7,38 @@ import flamedisx as fd
 export, __all__ = fd.exporter()
 
 
+def _simulate_reservoir(ntoys, max_rm_dict, n_workers, seed, sources):
+    """Return DataFrame of events simulated from sources for a reservoir,
+    see make_event_reservoir
+    """
+    if seed is None:
+        source_seeds = [None] * len(sources)
+    else:
+        source_seeds = [ss.generate_state(4)
+                        for ss in np.random.SeedSequence(seed).spawn(len(sources))]
+
+    dfs = []
+    for (sname, source), source_seed in zip(sources.items(), source_seeds):
+        if sname in max_rm_dict.keys():
+            max_rm = max_rm_dict[sname]
+        else:
+            max_rm = 1.
+        n_simulate = int(max_rm * ntoys * source.mu_before_efficiencies())
+
+        sdata = source.simulate(n_simulate, n_workers=n_workers, seed=source_seed)
+        sdata['source'] = sname
+        dfs.append(sdata)
+
+    return pd.concat(dfs, ignore_index=True)
+
+
 def make_event_reservoir(ntoys: int = None,
                          input_prefix='',
                          input_label=None,
                          reservoir_output_name=None,
                          max_rm_dict=None,
+                         n_workers=None,
+                         seed=None,
                          **sources):
     """Generate an annotated reservoir of events to be used in FrozenReservoirSource s.
 
@@ -23,6 +51,10 @@ def make_event_reservoir(ntoys: int = None,
         - reservoir_output_name: if supplied, the filename the reservoir will be saved under.
         - max_rm_dict: dictionary {sourcename: max_rm, ...} giving the maximum rate multiplier
             scanned over for each source, to control the size of the reservoir.
+        - n_workers: number of processes to simulate each source with (optional),
+            see Source.simulate.
+        - seed: seed for the simulation (optional). The reservoir is then reproducible,
+            regardless of n_workers.
         - sources: pass in source instances to be used to build the reservoir, like
             'source1'=source1(args, kwargs), 'source2'=source2(args, kwargs), ...
     """
@@ -50,19 +82,7 @@ def make_event_reservoir(ntoys: int = None,
 
         return data_reservoir
 
-    dfs = []
-    for sname, source in sources.items():
-        if sname in max_rm_dict.keys():
-            max_rm = max_rm_dict[sname]
-        else:
-            max_rm = 1.
-        n_simulate = int(max_rm * ntoys * source.mu_before_efficiencies())
-
-        sdata = source.simulate(n_simulate)
-        sdata['source'] = sname
-        dfs.append(sdata)
-
-    data_reservoir = pd.concat(dfs, ignore_index=True)
+    data_reservoir = _simulate_reservoir(ntoys, max_rm_dict, n_workers, seed, sources)
 
     for sname, source in sources.items():
         source.set_data(data_reservoir)
@@ -78,6 +98,8 @@ def make_event_reservoir_no_compute(ntoys: int = None,
                                     output_prefix='',
                                     output_label='',
                                     max_rm_dict=None,
+                                    n_workers=None,
+                                    seed=None,
                                     **sources):
     """Generate data tensor and event reservoir without differetial rates, to be used to
     generate the full reservoir for a FrozenReservoirSource. This could be useful for
@@ -91,6 +113,10 @@ def make_event_reservoir_no_compute(ntoys: int = None,
         - output_label: supply a label for the saved data tensor filename (optional).
         - max_rm_dict: dictionary {sourcename: max_rm, ...} giving the maximum rate multiplier
             scanned over for each source, to control the size of the reservoir.
+        - n_workers: number of processes to simulate each source with (optional),
+            see Source.simulate.
+        - seed: seed for the simulation (optional). The reservoir is then reproducible,
+            regardless of n_workers.
         - sources: pass in source instances to be used to build the reservoir, like
             'source1'=source1(args, kwargs), 'source2'=source2(args, kwargs), ...
     """
@@ -104,19 +130,7 @@ def make_event_reservoir_no_compute(ntoys: int = None,
     if max_rm_dict is None:
         max_rm_dict = dict()
 
-    dfs = []
-    for sname, source in sources.items():
-        if sname in max_rm_dict.keys():
-            max_rm = max_rm_dict[sname]
-        else:
-            max_rm = 1.
-        n_simulate = int(max_rm * ntoys * source.mu_before_efficiencies())
-
-        sdata = source.simulate(n_simulate)
-        sdata['source'] = sname
-        dfs.append(sdata)
-
-    data_reservoir = pd.concat(dfs, ignore_index=True)
+    data_reservoir = _simulate_reservoir(ntoys, max_rm_dict, n_workers, seed, sources)
 
     data_reservoir.to_pickle(f'{output_prefix}partial_toy_reservoir{output_label}.pkl')
 
@@ -169,6 +183,11 @@ class FrozenReservoirSource(fd.ColumnSource):
 
         super().__init__(*args, **kwargs)
 
+    def cache_fingerprint(self):
+        return dict(source_name=self.source_name,
+                    mu=self.mu,
+                    reservoir=self.reservoir)
+
     def random_truth(self, n_events, fix_truth=None, **params):
         if fix_truth is not None:
             raise NotImplementedError("FrozenReservoirSource does not yet support fix_truth")
@@ -1,4 +1,7 @@
+from concurrent.futures import ThreadPoolExecutor
 from copy import deepcopy
+import json
+import os
 import warnings
 
 import flamedisx as fd
@@ -32,13 +35,20 @@ class LogLikelihood:
 
     dsetnames: ty.List
 
-    # Concatenated data tensors for all sources in each dataset
+    # Data tensors with the distinct columns of all sources in each dataset
     # dsetname -> Tensor
     data_tensors: ty.Dict[str, tf.Tensor]
 
     # Track which columns in the data tensor belong to which sources
-    # dsetname -> [start, stop] array over sources
-    column_indices: ty.Dict[str, np.ndarray]
+    # dsetname -> list over sources of (n_source_columns) index arrays
+    source_column_indices: ty.Dict[str, ty.List[np.ndarray]]
+
+    @property
+    def column_indices(self):
+        # Sources no longer have contiguous column ranges
+        raise AttributeError(
+            "column_indices was replaced by source_column_indices, "
+            "which holds an index array for each source")
 
     def __init__(
             self,
@@ -55,6 +65,8 @@ class LogLikelihood:
             max_sigma=None,
             max_sigma_outer=None,
             n_trials=None,
+            mu_n_workers=None,
+            mu_cache_dir=None,
             log_constraint=None,
             bounds_specified=True,
             progress=True,
@@ -90,6 +102,15 @@ class LogLikelihood:
 
         :param n_trials: Number of Monte-Carlo trials for mu estimation.
 
+        :param mu_n_workers: Number of processes to use for the mu estimation
+            simulations (-1 for all CPUs). If not specified, mu estimators
+            use their own default (a single process).
+
+        :param mu_cache_dir: Directory in which to cache built mu estimators.
+            Estimators built before with the same sources, parameter
+            specifications and estimator settings are loaded from here,
+            skipping the mu estimation.
+
         :param log_constraint: Logarithm of constraint to include in likelihood
 
         :param bounds_specified: If True (default), optimizers will be
@@ -215,10 +236,16 @@ class LogLikelihood:
             mu_est = mu_estimators[sname]
             if fd.is_mu_estimator_class(mu_est):
                 # Build a new mu estimator using the source and configuration
+                mu_options = dict()
+                if mu_n_workers is not None:
+                    mu_options['n_workers'] = mu_n_workers
+                if mu_cache_dir is not None:
+                    mu_options['cache_dir'] = mu_cache_dir
                 mu_est = mu_est(
                     source=s,
                     n_trials=n_trials,
                     progress=progress,
+                    **mu_options,
                     # Source will filter out the params it needs
                     **common_param_specs)
             elif isinstance(mu_est, fd.MuEstimator):
@@ -239,6 +266,14 @@ class LogLikelihood:
         self.log_constraint = log_constraint
         self.constraint_extra_args = None
 
+        # The column layout of the data tensors depends only on the sources,
+        # so traced functions stay valid when setting new data.
+        self.source_column_indices = {
+            dsetname: self._column_layout(
+                [self.sources[sname]
+                 for sname in self.sources_in_dset[dsetname]])
+            for dsetname in self.dsetnames}
+
         self.set_data(data)
 
     def set_log_constraint(self, log_constraint):
@@ -252,11 +287,19 @@ class LogLikelihood:
             self.default_bounds[f'{source}_rate_multiplier'] = bounds
 
     def set_data(self,
-                 data: ty.Union[pd.DataFrame, ty.Dict[str, pd.DataFrame]]):
+                 data: ty.Union[pd.DataFrame, ty.Dict[str, pd.DataFrame]],
+                 data_is_annotated=False,
+                 update_guesses=True):
         """set new data for sources in the likelihood.
         Data is passed in the same format as for __init__
         Data can contain any subset of the original data keys to only
         update specific datasets.
+
+        :param data_is_annotated: If True, data was already annotated for all
+            sources, e.g. by simulate(annotate=True) or annotate_data. It is
+            then used without copying or re-annotating it.
+        :param update_guesses: If False, keep the current rate multiplier
+            guesses, instead of choosing new ones based on the data.
         """
         if isinstance(data, pd.DataFrame):
             assert len(self.dsetnames) == 1, \
@@ -275,24 +318,149 @@ class LogLikelihood:
 
         batch_info = np.zeros((len(self.dsetnames), 3), dtype=int)
 
+        # Sources in the same dataset often share blocks (e.g. the detector
+        # response), whose annotations we only compute once.
+        annotation_caches = {dname: dict() for dname in data}
+
         for sname, source in self.sources.items():
             dname = self.dset_for_source[sname]
             if dname not in data:
                 warnings.warn(f"Dataset {dname} not provided in set_data")
                 continue
 
-            # Copy ensures annotations don't clobber
-            source.set_data(deepcopy(data[dname]))
+            if data_is_annotated:
+                source.set_data(data[dname], data_is_annotated=True)
+            else:
+                # Copy ensures annotations don't clobber
+                source.set_data(deepcopy(data[dname]),
+                                annotation_cache=annotation_caches[dname])
 
             # Update batch info
             dset_index = self.dsetnames.index(dname)
             batch_info[dset_index, :] = [
                 source.n_batches, source.batch_size, source.n_padding]
 
+        if update_guesses:
+            self._update_rate_multiplier_guesses(
+                {dname: len(_data) for dname, _data in data.items()})
+
+        self.batch_info = tf.convert_to_tensor(batch_info, dtype=fd.int_type())
+
+        # Build a big data tensor for each dataset.
+        # Each source has an [n_batches, batch_size, n_columns] tensor.
+        # Columns the sources read unchanged from the data (e.g. s1, s2)
+        # are stored once, see _column_layout.
+        self.data_tensors = {
+            dsetname: self._shared_data_tensor(
+                [self.sources[sname]
+                 for sname in self.sources_in_dset[dsetname]],
+                self.source_column_indices[dsetname])
+            for dsetname in self.dsetnames}
+
+    @staticmethod
+    def _column_layout(sources):
+        """Return list with, for each source in a dataset, the indices in
+        the dataset's data tensor of the columns of its data tensor.
+
+        Columns that several sources list in shared_columns are stored once.
+        All other columns get their own index, even if their values happen
+        to be the same: the layout must not depend on the data.
+
+        :param sources: List of sources in the dataset
+        """
+        # (column name, position in array column) -> index
+        shared_indices = dict()
+        n_columns = 0
+        column_indices = []
+        for source in sources:
+            keys = [None] * source.n_columns_in_data_tensor
+            shared_columns = set(source.shared_columns())
+            for name, index in source.column_index.items():
+                if name not in shared_columns:
+                    continue
+                if isinstance(index, slice):
+                    for j in range(int(index.start), int(index.stop)):
+                        keys[j] = (name, j - int(index.start))
+                else:
+                    keys[int(index)] = (name, 0)
+
+            indices = []
+            for key in keys:
+                if key in shared_indices:
+                    index = shared_indices[key]
+                else:
+                    index = n_columns
+                    n_columns += 1
+                    if key is not None:
+                        shared_indices[key] = index
+                indices.append(index)
+            column_indices.append(np.array(indices, dtype=int))
+        return column_indices
+
+    @staticmethod
+    def _shared_data_tensor(sources, column_indices):
+        """Return (n_batches, batch_size, n_columns) data tensor with the
+        columns of the sources' data tensors, laid out as in column_indices
+        (see _column_layout).
+
+        If any source uses compact_data_tensor, the result is a
+        fd.CompactTensor.
+
+        :param sources: List of sources in the dataset
+        :param column_indices: List with, for each source, the indices in
+            the result of the columns of its data tensor
+        """
+        n_columns = 1 + max([max(indices, default=-1)
+                             for indices in column_indices])
+        columns = [None] * n_columns
+        for source, indices in zip(sources, column_indices):
+            source_data = source.data_tensor.numpy()
+            assert source_data.shape[2] == len(indices), \
+                "Data tensor does not match the source's column layout"
+            for index, values in zip(indices, np.moveaxis(source_data, 2, 0)):
+                if columns[index] is None:
+                    columns[index] = values
+
+        if columns:
+            data_tensor = np.stack(columns, axis=2)
+        else:
+            data_tensor = np.zeros(sources[0].data_tensor.shape)
+        data_tensor = fd.np_to_tf(data_tensor)
+
+        if any([source.compact_data_tensor for source in sources]):
+            int16, int32, low_precision = np.zeros(
+                (3, data_tensor.shape[2]), dtype=bool)
+            for source, indices in zip(sources, column_indices):
+                int16[indices[source.integer_mask(
+                    source.int16_column_suffixes)]] = True
+                int32[indices[source.integer_mask(
+                    source.int32_column_suffixes)]] = True
+                low_precision[indices[source.low_precision_mask()]] = True
+            data_tensor = fd.CompactTensor.from_tensor(
+                data_tensor, int16=int16, int32=int32,
+                low_precision=low_precision)
+        return data_tensor
+
+    def _source_data_tensor(self, data_tensor, dsetname, source_i):
+        """Return the columns of a batch data_tensor of dataset dsetname
+        that belong to the source_i'th source in the dataset
+        """
+        indices = self.source_column_indices[dsetname][source_i]
+        start = indices[0] if len(indices) else 0
+        if np.array_equal(indices, np.arange(start, start + len(indices))):
+            # Contiguous columns (always the case for the first source),
+            # take a slice instead of gathering
+            return data_tensor[:, start:start + len(indices)]
+        return tf.gather(data_tensor, indices, axis=1)
+
+    def _update_rate_multiplier_guesses(self, n_observed):
+        """Update rate multiplier guesses given the dictionary n_observed
+        {dataset_name: number of observed events}
+        """
         # Choose sensible default rate multiplier guesses:
         #  (1) Assume each free source produces just 1 event
         for sname in self.sources:
-            if self.dset_for_source[sname] not in data:
+            if self.dset_for_source[sname] not in n_observed:
                 # This dataset is not being updated, skip
                 continue
             rmname = sname + '_rate_multiplier'
@@ -304,60 +472,93 @@ class LogLikelihood:
 
         # (2) If we still saw more events than expected, assume the
         #     first free source is responsible for all of this.
-        for dname, _data in data.items():
-            n_observed = len(_data)
+        for dname, n_obs in n_observed.items():
             n_expected = self.mu(dataset_name=dname).numpy()
             assert n_expected > 0
-            if n_observed <= n_expected:
+            if n_obs <= n_expected:
                 continue
             for sname in self.sources_in_dset[dname]:
                 rmname = sname + '_rate_multiplier'
                 if rmname in self.param_names:
                     # Rate multiplier is set to value that produces
                     # one event, so we just have to multiply it:
-                    self.param_defaults[rmname] *= 1 + n_observed - n_expected
+                    self.param_defaults[rmname] *= 1 + n_obs - n_expected
                     break
 
-        self.batch_info = tf.convert_to_tensor(batch_info, dtype=fd.int_type())
+    def annotate_data(self,
+                      data: ty.Union[pd.DataFrame, ty.Dict[str, pd.DataFrame]]):
+        """Annotate data in-place for all sources in the likelihood, so it can
+        be passed to set_data with data_is_annotated=True.
+        Data is passed in the same format as for set_data, and returned.
 
-        # Build a big data tensor for each dataset.
-        # Each source has an [n_batches, batch_size, n_columns] tensor.
-        # Since the number of columns are different, we must concat along
-        # axis=2 and track which indices belong to which source.
-        self.data_tensors = {
-            dsetname: tf.concat(
-                [self.sources[sname].data_tensor
-                 for sname in self.sources_in_dset[dsetname]],
-                axis=2)
-            for dsetname in self.dsetnames}
+        This is only possible if every source stores its annotations in its own
+        columns, as for template and frozen reservoir sources; other sources
+        overwrite each other's annotations.
+        """
+        for sname, source in self.sources.items():
+            if not isinstance(source, (fd.ColumnSource, fd.MultiTemplateSource)):
+                raise NotImplementedError(
+                    f"Cannot annotate data for all sources at once: source "
+                    f"{sname} may share annotation columns with other sources.")
 
-        self.column_indices = dict()
-        for dsetname in self.dsetnames:
-            # Do not use len(cols_to_cache), some sources have extra columns...
-            stop_idx = np.cumsum([self.sources[sname].data_tensor.shape[2]
-                                  for sname in self.sources_in_dset[dsetname]])
-            self.column_indices[dsetname] = np.transpose([
-                np.concatenate([[0], stop_idx[:-1]]),
-                stop_idx])
-
-    def simulate(self, fix_truth=None, **params):
+        data_dict = data
+        if isinstance(data, pd.DataFrame):
+            assert len(self.dsetnames) == 1, \
+                "You passed one DataFrame but there are multiple datasets"
+            data_dict = {DEFAULT_DSETNAME: data}
+
+        for sname, source in self.sources.items():
+            dname = self.dset_for_source[sname]
+            if dname not in data_dict:
+                continue
+            with source._set_temporarily(data_dict[dname],
+                                         _skip_bounds_computation=True):
+                source._annotate()
+        return data
+
+    def simulate(self, fix_truth=None, annotate=False,
+                 n_workers=None, seed=None, **params):
         """Simulate events from sources.
+
+        :param annotate: If True, also annotate the events for all sources,
+            see annotate_data.
+        :param n_workers: Number of processes each source simulates with,
+            see Source.simulate.
+        :param seed: Seed for the simulation. If given, the number of events,
+            the simulation of each source, and the final shuffle use
+            independent random streams derived from it, so the result is
+            reproducible regardless of n_workers.
         """
         params = self.prepare_params(params, free_all_rates=True)
+        if seed is None:
+            rng = np.random
+            source_seeds = [None] * len(self.sources)
+        else:
+            seeds = np.random.SeedSequence(seed).spawn(len(self.sources) + 1)
+            rng = np.random.default_rng(seeds[0])
+            source_seeds = [ss.generate_state(4) for ss in seeds[1:]]
+        # Only pass options that are used, not all sources support them
+        sim_options = dict()
+        if n_workers is not None:
+            sim_options['n_workers'] = n_workers
+
         # Collect Source event DFs in ds
         ds = []
-        for sname, s in self.sources.items():
+        for (sname, s), source_seed in zip(self.sources.items(), source_seeds):
             # mean number of events to simulate, rate mult times mu before
             # efficiencies, the simulator deals with the efficiencies
             rm = self._get_rate_mult(sname, params)
             mu = rm * s.mu_before_efficiencies(
                 **self._filter_source_kwargs(params, sname))
             # Simulate this many events from source
-            n_to_sim = np.random.poisson(mu)
+            n_to_sim = rng.poisson(mu)
             if n_to_sim == 0:
                 continue
-            d = s.simulate(n_to_sim,
+            if source_seed is not None:
+                sim_options['seed'] = source_seed
+            d = s.simulate(int(n_to_sim),
                            fix_truth=fix_truth,
+                           **sim_options,
                            **self._filter_source_kwargs(params,
                                                         sname))
             # If events were simulated add them to the list
@@ -370,7 +571,11 @@ class LogLikelihood:
         # Adding empty DataFrame ensures pd.concat doesn't fail if
         # n_to_sim is 0 for all sources or all sources return 0 events
         ds = pd.concat([pd.DataFrame()] + ds, sort=False)
-        return ds.sample(frac=1).reset_index(drop=True)
+        ds = ds.sample(frac=1, random_state=None if seed is None else rng)
+        ds = ds.reset_index(drop=True)
+        if annotate:
+            self.annotate_data(ds)
+        return ds
 
     def __call__(self, **kwargs):
         assert 'second_order' not in kwargs, 'Roep gewoon log_likelihood aan'
@@ -385,8 +590,7 @@ class LogLikelihood:
         llgrad2 = np.zeros((n_grads, n_grads), dtype=np.float64)
 
         for dsetname in self.dsetnames:
-            # Getting this from the batch_info tensor is much slower
-            n_batches = self.sources[self.sources_in_dset[dsetname][0]].n_batches
+            n_batches = self._n_batches(dsetname)
             if n_batches == 0:
                 # Signal _log_likelihood to do a 'dummy batch' without data,
                 # just to get the mu and constraint terms
@@ -424,6 +628,174 @@ class LogLikelihood:
             return ll, llgrad, llgrad2
         return ll, llgrad, None
 
+    def log_likelihood_grid(self, points, points_per_call=None):
+        """Return (n_points,) array of log likelihoods at n_points
+        parameter points. Each batch of events is evaluated at many points
+        in a single call, which is much faster than calling the likelihood
+        for each point (e.g. for likelihood scans or profile grids).
+
+        :param points: DataFrame or dictionary {param: (n_points,) array}
+            of parameter values. Omitted parameters are at their defaults.
+        :param points_per_call: Maximum number of points to evaluate in
+            one call. Use this to limit memory use; by default, all points
+            are evaluated in one call.
+        """
+        points = {k: np.asarray(v, dtype=np.float64)
+                  for k, v in dict(points).items()}
+        for k in points:
+            if k not in self.param_defaults:
+                raise ValueError(f"Unknown parameter {k}")
+        values = np.broadcast_arrays(*[
+            np.atleast_1d(points.get(k, self.param_defaults[k].numpy()))
+            for k in self.param_names])
+        n_points = len(values[0])
+        if points_per_call is None:
+            points_per_call = n_points
+
+        ll = np.zeros(n_points, dtype=np.float64)
+        for start in range(0, n_points, points_per_call):
+            stop = min(start + points_per_call, n_points)
+            # Pad the last call with copies of the last point,
+            # to avoid retracing for a different number of points
+            index = np.minimum(np.arange(start, start + points_per_call),
+                               n_points - 1)
+            ptensors = fd.np_to_tf(np.stack(
+                [v[index] for v in values], axis=1))
+
+            for dsetname in self.dsetnames:
+                n_batches = self._n_batches(dsetname)
+                empty_batch = bool(n_batches == 0)
+                for i_batch in range(max(n_batches, 1)):
+                    if empty_batch:
+                        batch_data_tensor = None
+                    else:
+                        batch_data_tensor = \
+                            self.data_tensors[dsetname][i_batch]
+                    result = self._log_likelihood_grid(
+                        tf.constant(i_batch, dtype=fd.int_type()),
+                        dsetname=dsetname,
+                        data_tensor=batch_data_tensor,
+                        batch_info=self.batch_info,
+                        ptensors=ptensors,
+                        empty_batch=empty_batch,
+                        constraint_extra_args=self.constraint_extra_args)
+                    ll[start:stop] += \
+                        result.numpy().astype(np.float64)[:stop - start]
+        return ll
+
+    def save(self, path):
+        """Save the likelihood to the directory path, from which
+        LogLikelihood.load restores it without building sources,
+        annotating data, estimating mus or tracing.
+
+        This saves the traced likelihood graphs, which include the mu
+        estimators and the constraint, as a TensorFlow SavedModel, and the
+        data tensors and parameter metadata next to it. The loaded
+        likelihood can be evaluated, fitted and scanned, but its data,
+        sources and constraint cannot be changed.
+        """
+        os.makedirs(path, exist_ok=True)
+        params_spec = tf.TensorSpec([len(self.param_names)], fd.float_type())
+        module = tf.Module()
+        n_batches = dict()
+        for dset_i, dsetname in enumerate(self.dsetnames):
+            n_batches[dsetname] = int(self._n_batches(dsetname))
+            if n_batches[dsetname]:
+                data_tensor = self.data_tensors[dsetname]
+                if isinstance(data_tensor, fd.CompactTensor):
+                    data_tensor = data_tensor.expand()
+                np.save(os.path.join(path, f'data_tensor_{dset_i}.npy'),
+                        data_tensor.numpy())
+                data_spec = tf.TensorSpec(data_tensor.shape[1:],
+                                          fd.float_type())
+            else:
+                data_spec = tf.TensorSpec([None], fd.float_type())
+
+            for name, f in self._export_functions(
+                    dsetname, empty_batch=not n_batches[dsetname]).items():
+                signature = dict(
+                    log_likelihood=[data_spec, params_spec],
+                    log_likelihood_second_order=[data_spec, params_spec],
+                    log_likelihood_grid=[
+                        data_spec,
+                        tf.TensorSpec([None, len(self.param_names)],
+                                      fd.float_type())],
+                    mu=[params_spec])[name]
+                if name != 'mu':
+                    signature = [tf.TensorSpec([], fd.int_type())] + signature
+                setattr(module, f'{name}_{dset_i}',
+                        tf.function(f, input_signature=signature))
+        tf.saved_model.save(module, os.path.join(path, 'model'))
+
+        metadata = dict(
+            param_names=self.param_names,
+            param_defaults={k: float(v)
+                            for k, v in self.param_defaults.items()},
+            default_bounds={
+                k: [None if x is None else float(x) for x in bounds]
+                for k, bounds in self.default_bounds.items()},
+            dsetnames=self.dsetnames,
+            sources_in_dset=self.sources_in_dset,
+            dset_for_source=self.dset_for_source,
+            source_column_indices={
+                dsetname: [x.tolist() for x in indices]
+                for dsetname, indices in getattr(
+                    self, 'source_column_indices', dict()).items()},
+            # Traced into the saved graphs; kept for reference
+            constraint_extra_args=(
+                None if self.constraint_extra_args is None
+                else {k: np.asarray(v).tolist()
+                      for k, v in self.constraint_extra_args.items()}),
+            n_batches=n_batches)
+        with open(os.path.join(path, 'metadata.json'), mode='w') as f:
+            json.dump(metadata, f)
+
+    def _export_functions(self, dsetname, empty_batch):
+        """Return dictionary {name: function} of the functions of dataset
+        dsetname to save, see save
+        """
+        def log_likelihood(i_batch, data_tensor, ptensor,
+                           second_order=False):
+            return self._log_likelihood(
+                i_batch,
+                dsetname=dsetname,
+                data_tensor=None if empty_batch else data_tensor,
+                batch_info=self.batch_info,
+                second_order=second_order,
+                empty_batch=empty_batch,
+                constraint_extra_args=self.constraint_extra_args,
+                **self.params_to_dict(ptensor))[:2 + second_order]
+
+        return dict(
+            log_likelihood=log_likelihood,
+            log_likelihood_second_order=(
+                lambda i_batch, data_tensor, ptensor: log_likelihood(
+                    i_batch, data_tensor, ptensor, second_order=True)),
+            log_likelihood_grid=(
+                lambda i_batch, data_tensor, ptensors:
+                    self._log_likelihood_grid(
+                        i_batch,
+                        dsetname=dsetname,
+                        data_tensor=None if empty_batch else data_tensor,
+                        batch_info=self.batch_info,
+                        ptensors=ptensors,
+                        empty_batch=empty_batch,
+                        constraint_extra_args=self.constraint_extra_args)),
+            mu=lambda ptensor: self.mu(dataset_name=dsetname,
+                                       **self.params_to_dict(ptensor)))
+
+    @staticmethod
+    def load(path):
+        """Return likelihood saved with save to the directory path,
+        see SavedLogLikelihood
+        """
+        return SavedLogLikelihood(path)
+
+    def _n_batches(self, dsetname):
+        """Return number of batches in the dataset dsetname"""
+        # Getting this from the batch_info tensor is much slower
+        return self.sources[self.sources_in_dset[dsetname][0]].n_batches
+
     def minus2_ll(self, *, omit_grads=tuple(), **kwargs):
         result = self.log_likelihood(omit_grads=omit_grads, **kwargs)
         ll, grad = result[:2]
@@ -507,30 +879,59 @@ class LogLikelihood:
         del params    # Do not reuse accidentally!
 
         # Forward computation
+        ll = self._log_likelihood_forward(
+            i_batch, params_unstacked, dsetname, data_tensor, batch_info,
+            empty_batch=empty_batch,
+            constraint_extra_args=constraint_extra_args)
+
+        # Autodifferentiation. This is why we use tensorflow:
+        grad = tf.gradients(ll, grad_par_stack)[0]
+        if second_order:
+            return ll, grad, tf.hessians(ll, grad_par_stack)[0]
+        return ll, grad, None
+
+    def _log_likelihood_forward(self, i_batch, params,
+                                dsetname, data_tensor, batch_info,
+                                empty_batch=False, constraint_extra_args=None):
+        """Return log likelihood contribution of one batch in a dataset,
+        including the mu and constraint terms
+        """
         if empty_batch:
             ll = 0
         else:
             ll = self._log_likelihood_inner(
-                i_batch, params_unstacked, dsetname, data_tensor, batch_info)
+                i_batch, params, dsetname, data_tensor, batch_info)
 
         # Add mu once (to the first batch)
         # and constraint really only once (to first batch of first dataset)
         ll += tf.where(
             tf.equal(i_batch, tf.constant(0, dtype=fd.int_type())),
-            - self.mu(dataset_name=dsetname, **params_unstacked),
+            - self.mu(dataset_name=dsetname, **params),
             0.)
         if dsetname == self.dsetnames[0]:
             if constraint_extra_args is None:
-                ll += self.log_constraint(**params_unstacked)
+                ll += self.log_constraint(**params)
             else:
-                kwargs = {**params_unstacked, **constraint_extra_args}
+                kwargs = {**params, **constraint_extra_args}
                 ll += self.log_constraint(**kwargs)
+        return ll
 
-        # Autodifferentiation. This is why we use tensorflow:
-        grad = tf.gradients(ll, grad_par_stack)[0]
-        if second_order:
-            return ll, grad, tf.hessians(ll, grad_par_stack)[0]
-        return ll, grad, None
+    @tf.function
+    def _log_likelihood_grid(self,
+                             i_batch, dsetname, data_tensor, batch_info,
+                             ptensors, empty_batch=False,
+                             constraint_extra_args=None):
+        # Vectorize over the (n_points, n_params) ptensors, so all
+        # points are evaluated in one graph call
+        def log_likelihood_at(ptensor):
+            return self._log_likelihood_forward(
+                i_batch, self.params_to_dict(ptensor),
+                dsetname, data_tensor, batch_info,
+                empty_batch=empty_batch,
+                constraint_extra_args=constraint_extra_args)
+
+        return tf.vectorized_map(log_likelihood_at, ptensors,
+                                 fallback_to_while_loop=True)
 
     def _log_likelihood_inner(self, i_batch, params,
                               dsetname, data_tensor, batch_info):
@@ -546,6 +947,10 @@ class LogLikelihood:
         batch_size = batch_info[dataset_index, 1]
         n_padding = batch_info[dataset_index, 2]
 
+        if isinstance(data_tensor, fd.CompactTensor):
+            # Upcast the compact columns once, inside the graph
+            data_tensor = data_tensor.expand()
+
         # Compute differential rates from all sources
         # drs = list[n_sources] of [n_events] tensors
         drs = tf.zeros((batch_size,), dtype=fd.float_type())
@@ -553,9 +958,8 @@ class LogLikelihood:
             s = self.sources[sname]
             rate_mult = self._get_rate_mult(sname, params)
 
-            col_start, col_stop = self.column_indices[dsetname][source_i]
             dr = s.differential_rate(
-                data_tensor[:, col_start:col_stop],
+                self._source_data_tensor(data_tensor, dsetname, source_i),
                 # We are already tracing; if we call the traced function here
                 # it breaks the Hessian (it will give NaNs)
                 autograph=False,
@@ -668,6 +1072,77 @@ class LogLikelihood:
 
         return result
 
+    def scan(self, param_grid, profile=False, guess=None, n_workers=1,
+             points_per_call=None, **kwargs):
+        """Return DataFrame with the log likelihood on a grid of parameter
+        values, with one row per grid point, and columns for all
+        parameters and the log likelihood ('ll').
+
+        :param param_grid: Dictionary {param: (n,) array of values} of the
+            parameters to scan. The grid consists of all combinations of
+            values, and rows are in C order of the grid.
+        :param profile: If False, keep other parameters at guess, and
+            evaluate all grid points in batches (see log_likelihood_grid).
+            If True, fit the other parameters at each grid point. The fits
+            walk the grid in snake order, each starting from the fit at
+            the neighbouring point.
+        :param guess: Dictionary {param: value} of values of the other
+            parameters, or, for a profile scan, the guess for the first fit.
+            Omitted parameters are at their defaults.
+        :param n_workers: Number of threads for a profile scan. Each walks
+            a contiguous part of the snake path.
+        :param points_per_call: Maximum number of grid points to evaluate
+            in one call, see log_likelihood_grid.
+        :param kwargs: Arguments passed to bestfit for a profile scan.
+        """
+        if guess is None:
+            guess = dict()
+        for k in param_grid:
+            if k not in self.param_defaults:
+                raise ValueError(f"Unknown parameter {k}")
+        scan_params = list(param_grid.keys())
+        values = [np.asarray(param_grid[k], dtype=np.float64)
+                  for k in scan_params]
+        shape = tuple(len(v) for v in values)
+        grid = [x.ravel() for x in np.meshgrid(*values, indexing='ij')]
+        points = pd.DataFrame({
+            **{k: np.full(len(grid[0]), float(v))
+               for k, v in {**self.guess(), **guess}.items()},
+            **dict(zip(scan_params, grid))})[self.param_names]
+
+        if profile and len(scan_params) < len(self.param_names):
+            points = self._profile_scan(
+                points, scan_params, _snake_order(shape), n_workers,
+                **kwargs)
+
+        points['ll'] = self.log_likelihood_grid(
+            points, points_per_call=points_per_call)
+        return points
+
+    def _profile_scan(self, points, scan_params, order, n_workers,
+                      **kwargs):
+        """Return DataFrame points, with other parameters than scan_params
+        fitted at each point, fitting points in the given order
+        """
+        fits = points.to_dict('records')
+
+        def walk(indices):
+            guess = fits[indices[0]]
+            for i in indices:
+                fix = {k: fits[i][k] for k in scan_params}
+                guess = fits[i] = {
+                    **fix, **self.bestfit(guess=guess, fix=fix, **kwargs)}
+
+        segments = [x for x in np.array_split(order, max(n_workers, 1))
+                    if len(x)]
+        if len(segments) == 1:
+            walk(segments[0])
+        else:
+            with ThreadPoolExecutor(max_workers=len(segments)) as executor:
+                # Raise any exception from the workers
+                list(executor.map(walk, segments))
+        return pd.DataFrame(fits, columns=points.columns)
+
     def interval(self, parameter, **kwargs):
         """Return central confidence interval on parameter.
         Options are the same as for limit."""
@@ -885,6 +1360,151 @@ class LogLikelihood:
         pd.reset_option('display.precision')
 
 
+@export
+class SavedLogLikelihood(LogLikelihood):
+    """Likelihood restored with LogLikelihood.load, which evaluates the
+    graphs traced when it was saved.
+
+    The data tensors are memory-mapped. Evaluating, fitting, scanning and
+    setting limits work as for the original likelihood, but the data,
+    sources and constraint (including constraint_extra_args, which are
+    those of the original likelihood when it was saved) are fixed, and mu
+    is only available per dataset. Methods that need the sources or
+    the constraint raise NotImplementedError.
+    """
+
+    def __init__(self, path):
+        with open(os.path.join(path, 'metadata.json')) as f:
+            metadata = json.load(f)
+        self.param_names = metadata['param_names']
+        self.param_defaults = fd.values_to_constants(
+            metadata['param_defaults'])
+        self.default_bounds = {k: tuple(v) for k, v
+                               in metadata['default_bounds'].items()}
+        self.dsetnames = metadata['dsetnames']
+        self.sources_in_dset = metadata['sources_in_dset']
+        self.dset_for_source = metadata['dset_for_source']
+        self.source_column_indices = {
+            dsetname: [np.array(x, dtype=int) for x in indices]
+            for dsetname, indices
+            in metadata['source_column_indices'].items()}
+        self.n_batches = metadata['n_batches']
+        self.constraint_extra_args = metadata.get('constraint_extra_args')
+        self.batch_info = None
+
+        self.model = tf.saved_model.load(os.path.join(path, 'model'))
+        self.data_tensors = {
+            dsetname: np.load(
+                os.path.join(path, f'data_tensor_{dset_i}.npy'),
+                mmap_mode='r')
+            for dset_i, dsetname in enumerate(self.dsetnames)
+            if self.n_batches[dsetname]}
+
+    def _saved_function(self, name, dsetname):
+        return getattr(self.model,
+                       f'{name}_{self.dsetnames.index(dsetname)}')
+
+    def _batch_data_tensor(self, data_tensor):
+        if data_tensor is None:
+            # Empty batch, the data tensor is not used
+            return tf.zeros((0,), dtype=fd.float_type())
+        return fd.np_to_tf(data_tensor)
+
+    def _log_likelihood(self,
+                        i_batch, dsetname, data_tensor, batch_info,
+                        omit_grads=tuple(), second_order=False,
+                        empty_batch=False, constraint_extra_args=None,
+                        **params):
+        ptensor = tf.stack([tf.cast(params[k], fd.float_type())
+                            for k in self.param_names])
+        name = ('log_likelihood_second_order' if second_order
+                else 'log_likelihood')
+        results = self._saved_function(name, dsetname)(
+            i_batch, self._batch_data_tensor(data_tensor), ptensor)
+
+        # The saved functions differentiate with respect to all parameters
+        keep = [i for i, k in enumerate(self.param_names)
+                if k not in omit_grads]
+        ll, grad = results[0], tf.gather(results[1], keep)
+        if second_order:
+            hess = tf.gather(tf.gather(results[2], keep), keep, axis=1)
+            return ll, grad, hess
+        return ll, grad, None
+
+    def _log_likelihood_grid(self,
+                             i_batch, dsetname, data_tensor, batch_info,
+                             ptensors, empty_batch=False,
+                             constraint_extra_args=None):
+        return self._saved_function('log_likelihood_grid', dsetname)(
+            i_batch, self._batch_data_tensor(data_tensor), ptensors)
+
+    def _n_batches(self, dsetname):
+        return self.n_batches[dsetname]
+
+    def mu(self, *,
+           source_name=None,
+           dataset_name=None,
+           **kwargs):
+        if source_name is not None:
+            raise NotImplementedError(
+                "Saved likelihoods only provide mu per dataset")
+        if dataset_name is None:
+            raise ValueError("Provide a dataset name")
+        params = self.prepare_params(kwargs)
+        return self._saved_function('mu', dataset_name)(
+            tf.stack([params[k] for k in self.param_names]))
+
+    @property
+    def sources(self):
+        raise NotImplementedError("Saved likelihoods have no sources")
+
+    @property
+    def mu_estimators(self):
+        raise NotImplementedError(
+            "Saved likelihoods have no mu estimators; "
+            "use mu(dataset_name=...)")
+
+    @property
+    def log_constraint(self):
+        raise NotImplementedError(
+            "The constraint of a saved likelihood is part of its graphs")
+
+    def set_log_constraint(self, log_constraint):
+        raise NotImplementedError(
+            "Cannot change the constraint of a saved likelihood")
+
+    def set_constraint_extra_args(self, **kwargs):
+        raise NotImplementedError(
+            "Cannot change the constraint of a saved likelihood; "
+            "its constraint_extra_args are those it was saved with")
+
+    def set_data(self, *args, **kwargs):
+        raise NotImplementedError(
+            "Cannot change the data of a saved likelihood")
+
+    def annotate_data(self, *args, **kwargs):
+        raise NotImplementedError(
+            "Saved likelihoods have no sources to annotate data with")
+
+    def simulate(self, *args, **kwargs):
+        raise NotImplementedError(
+            "Saved likelihoods have no sources to simulate from")
+
+
+def _snake_order(shape):
+    """Return flat (C order) indices of a grid of shape in snake order,
+    in which consecutive grid points are neighbours
+    """
+    order = [tuple()]
+    for n in shape:
+        # Walk the new axis back and forth, alternating for each
+        # consecutive point on the previous axes
+        order = [prefix + (i,)
+                 for j, prefix in enumerate(order)
+                 for i in (range(n) if j % 2 == 0 else range(n)[::-1])]
+    return np.ravel_multi_index(tuple(np.array(order).T), shape)
+
+
 @export
 def cov_to_std(cov):
     """Return (std errors, correlation coefficent matrix)
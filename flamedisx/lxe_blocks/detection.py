@@ -1,7 +1,6 @@
 import typing as ty
 
 import numpy as np
-from scipy import stats
 import tensorflow as tf
 import tensorflow_probability as tfp
 
@@ -56,17 +55,42 @@ class DetectPhotonsOrElectrons(fd.Block):
 
         if self.quanta_name == 'photon':
             p *= self.gimme_numpy(
-                'penning_quenching_eff', d['photons_produced'].values)
+                'penning_quenching_eff', np.asarray(d['photons_produced']))
         else:
             p *= self.gimme_numpy(
-                'electron_loss', d['electrons_produced'].values)
+                'electron_loss', np.asarray(d['electrons_produced']))
 
-        d[self.quanta_name + 's_detected'] = stats.binom.rvs(
-            n=d[self.quanta_name + 's_produced'],
-            p=p)
+        d[self.quanta_name + 's_detected'] = self.source.rng.binomial(
+            np.asarray(d[self.quanta_name + 's_produced']),
+            p)
         d['p_accepted'] *= self.gimme_numpy(
             self.quanta_name + '_acceptance',
-            d[self.quanta_name + 's_detected'].values)
+            np.asarray(d[self.quanta_name + 's_detected']))
+
+    reweightable = True
+
+    def _simulation_weight(self, d, data_tensor, ptensor):
+        quanta_produced = d[self.quanta_name + 's_produced']
+        quanta_detected = d[self.quanta_name + 's_detected']
+        p = self.gimme(self.quanta_name + '_detection_eff',
+                       data_tensor=data_tensor, ptensor=ptensor)
+        if self.quanta_name == 'photon':
+            p = p * self.gimme('penning_quenching_eff',
+                               bonus_arg=quanta_produced,
+                               data_tensor=data_tensor, ptensor=ptensor)
+        else:
+            p = p * self.gimme('electron_loss',
+                               bonus_arg=quanta_produced,
+                               data_tensor=data_tensor, ptensor=ptensor)
+
+        log_prob = tfp.distributions.Binomial(
+                total_count=quanta_produced,
+                probs=tf.cast(p, dtype=fd.float_type())
+            ).log_prob(quanta_detected)
+        acceptance = self.gimme(self.quanta_name + '_acceptance',
+                                bonus_arg=quanta_detected,
+                                data_tensor=data_tensor, ptensor=ptensor)
+        return log_prob, acceptance
 
     def _annotate(self, d):
         # Get efficiency
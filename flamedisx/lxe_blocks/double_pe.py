@@ -1,5 +1,4 @@
 import numpy as np
-from scipy import stats
 import tensorflow as tf
 import tensorflow_probability as tfp
 
@@ -45,9 +44,21 @@ class MakeS1Photoelectrons(fd.Block):
                         result)
 
     def _simulate(self, d):
-        d['photoelectrons_detected'] = stats.binom.rvs(
-            n=d['photons_detected'],
-            p=self.gimme_numpy('double_pe_fraction')) + d['photons_detected']
+        photons_detected = np.asarray(d['photons_detected'])
+        d['photoelectrons_detected'] = self.source.rng.binomial(
+            photons_detected,
+            self.gimme_numpy('double_pe_fraction')) + photons_detected
+
+    reweightable = True
+
+    def _simulation_weight(self, d, data_tensor, ptensor):
+        p_dpe = self.gimme('double_pe_fraction',
+                           data_tensor=data_tensor, ptensor=ptensor)
+        log_prob = tfp.distributions.Binomial(
+                total_count=d['photons_detected'],
+                probs=tf.cast(p_dpe, dtype=fd.float_type())
+            ).log_prob(d['photoelectrons_detected'] - d['photons_detected'])
+        return log_prob, 1.
 
     def _annotate(self, d):
         # TODO: this assumes the spread from the double PE effect is subdominant
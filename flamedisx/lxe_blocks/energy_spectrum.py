@@ -1,3 +1,7 @@
+from collections import OrderedDict
+import hashlib
+import os
+
 from multihist import Histdd
 import numpy as np
 import pandas as pd
@@ -55,34 +59,55 @@ class EnergySpectrum(fd.FirstBlock):
     def _annotate(self, d):
         pass
 
-    def draw_positions(self, n_events, **params):
+    def draw_positions(self, n_events, uniforms=None, **params):
         """Return dictionary with x, y, z, r, theta, drift_time
         randomly drawn.
+
+        :param uniforms: (3, n_events) array of numbers uniform in [0, 1)
+            to transform to r, theta and z. If None, draw them.
         """
+        if uniforms is None:
+            uniforms = [np.random.rand(n_events) for _ in range(3)]
         data = dict()
-        data['r'] = (np.random.rand(n_events) * self.fv_radius**2)**0.5
-        data['theta'] = np.random.uniform(0, 2*np.pi, size=n_events)
-        data['z'] = np.random.uniform(self.fv_low, self.fv_high,
-                                      size=n_events)
+        data['r'] = (uniforms[0] * self.fv_radius**2)**0.5
+        data['theta'] = 2 * np.pi * uniforms[1]
+        data['z'] = self.fv_low + (self.fv_high - self.fv_low) * uniforms[2]
         data['x'], data['y'] = fd.pol_to_cart(data['r'], data['theta'])
 
         data['drift_time'] = - data['z'] / self.drift_velocity
         return data
 
-    def draw_time(self, n_events, **params):
+    def draw_time(self, n_events, uniforms=None, **params):
         """Return n_events event_times drawn uniformaly
-        between t_start and t_stop"""
-        return np.random.uniform(
-            self.t_start.value,
-            self.t_stop.value,
-            size=n_events)
+        between t_start and t_stop
 
-    def random_truth(self, n_events, fix_truth=None, **params):
+        :param uniforms: (n_events,) array of numbers uniform in [0, 1)
+            to transform to times. If None, draw them.
+        """
+        if uniforms is None:
+            uniforms = np.random.rand(n_events)
+        return (self.t_start.value
+                + (self.t_stop.value - self.t_start.value) * uniforms)
+
+    def random_truth(self, n_events, fix_truth=None, quasi_random=False,
+                     **params):
         """Return pandas dataframe with event positions and times
         randomly drawn.
+
+        :param quasi_random: If True, draw positions, times and energies
+            from a scrambled Sobol sequence instead.
         """
-        data = self.draw_positions(n_events, **params)
-        data['event_time'] = self.draw_time(n_events, **params)
+        n_events = int(n_events)
+        if quasi_random:
+            uniforms = fd.random_uniforms(n_events, 5, quasi_random=True).T
+            data = self.draw_positions(n_events, uniforms=uniforms[:3],
+                                       **params)
+            data['event_time'] = self.draw_time(n_events,
+                                                uniforms=uniforms[3],
+                                                **params)
+        else:
+            data = self.draw_positions(n_events, **params)
+            data['event_time'] = self.draw_time(n_events, **params)
 
         # The energy spectrum is represented as a 'comb' of delta functions
         # in the differential rate calculation. To get simulator-data agreement,
@@ -92,11 +117,17 @@ class EnergySpectrum(fd.FirstBlock):
         assert len(spectrum_numpy) == len(self.energies), \
             "Energies and spectrum have different length"
 
-        data['energy'] = np.random.choice(
-            fd.tf_to_np(self.energies),
-            size=n_events,
-            p=spectrum_numpy / spectrum_numpy.sum(),
-            replace=True)
+        if quasi_random:
+            # Inverse CDF sampling, as np.random.choice does internally
+            cdf = np.cumsum(spectrum_numpy)
+            data['energy'] = fd.tf_to_np(self.energies)[
+                np.searchsorted(cdf / cdf[-1], uniforms[4], side='right')]
+        else:
+            data['energy'] = np.random.choice(
+                fd.tf_to_np(self.energies),
+                size=n_events,
+                p=spectrum_numpy / spectrum_numpy.sum(),
+                replace=True)
         assert np.all(data['energy'] >= 0), "Generated negative energies??"
 
         # For a constant-shape spectrum, fixing truth values is easy:
@@ -295,6 +326,101 @@ class InvalidEventTimes(Exception):
     pass
 
 
+#: Maximum number of WIMP spectra wimp_spectra keeps in memory
+wimp_spectra_cache_size = 128
+
+# In-memory cache of WIMP spectra at _REFERENCE_SIGMA, most recently used last
+_wimp_spectra_cache = OrderedDict()
+
+# Cross-section (cm^2) at which WIMP spectra are computed and cached.
+# WIMP rates are proportional to the cross-section, so spectra for other
+# cross-sections are obtained by rescaling.
+_REFERENCE_SIGMA = 1e-45
+
+
+def _compute_wimp_spectrum(binning, mw):
+    """Return (n_times, n_energies) array of WIMP spectra at
+    _REFERENCE_SIGMA, integrated over the energy bins
+
+    :param binning: (time_centers, energy_edges) tuple
+    :param mw: WIMP mass in GeV/c^2
+    """
+    time_centers, energy_edges = binning
+    e_centers = 0.5 * (energy_edges[1:] + energy_edges[:-1])
+    return np.array([wr.rate_wimp_std(t=t,
+                                      es=e_centers,
+                                      mw=mw,
+                                      sigma_nucleon=_REFERENCE_SIGMA)
+                     * np.diff(energy_edges)
+                     for t in time_centers])
+
+
+@export
+def wimp_spectra(mws, time_centers, energy_edges, sigma_nucleon=1e-45,
+                 cache_dir=None, n_workers=1):
+    """Return WIMP recoil spectra in events / (tonne year) per energy bin,
+    as an array of shape (len(mws), len(time_centers), n_energy_bins),
+    or (len(time_centers), n_energy_bins) if mws is a scalar.
+
+    Spectra are cached in memory (up to wimp_spectra_cache_size,
+    evicting the least recently used) and, if cache_dir is given, on disk.
+    Masses that are not cached are computed together, optionally in parallel.
+
+    :param mws: WIMP mass, or array of masses, in GeV/c^2
+    :param time_centers: J2000 times at which to compute the spectra
+    :param energy_edges: Energy bin edges in keV
+    :param sigma_nucleon: WIMP-nucleon cross-section in cm^2
+    :param cache_dir: Directory for caching spectra on disk.
+    If None (default), spectra are only cached in memory.
+    :param n_workers: Number of processes used to compute uncached spectra
+    (-1 for all CPUs).
+    """
+    time_centers = np.asarray(time_centers, dtype=float)
+    energy_edges = np.asarray(energy_edges, dtype=float)
+    binning_key = (tuple(time_centers.tolist()), tuple(energy_edges.tolist()))
+
+    def disk_path(mw):
+        key = hashlib.sha256(
+            repr((wr.__version__, float(mw), binning_key)).encode()
+        ).hexdigest()[:32]
+        return os.path.join(cache_dir, f'wimp_spectrum_{key}.npy')
+
+    spectra = dict()
+    for mw in np.unique(mws):
+        key = (float(mw),) + binning_key
+        if key in _wimp_spectra_cache:
+            _wimp_spectra_cache.move_to_end(key)
+            spectra[mw] = _wimp_spectra_cache[key]
+        elif cache_dir is not None and os.path.exists(disk_path(mw)):
+            spectra[mw] = np.load(disk_path(mw))
+
+    to_compute = [mw for mw in np.unique(mws) if mw not in spectra]
+    computed = fd.map_with_worker_state(
+        _compute_wimp_spectrum, (time_centers, energy_edges), to_compute,
+        n_workers=n_workers)
+    for mw, spectrum in zip(to_compute, computed):
+        spectra[mw] = spectrum
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            # Write to a temporary file first, so other processes
+            # never see a partially written cache file
+            tmp_path = disk_path(mw) + f'.{os.getpid()}.tmp.npy'
+            np.save(tmp_path, spectrum)
+            os.replace(tmp_path, disk_path(mw))
+
+    for mw, spectrum in spectra.items():
+        key = (float(mw),) + binning_key
+        _wimp_spectra_cache[key] = spectrum
+        _wimp_spectra_cache.move_to_end(key)
+    while len(_wimp_spectra_cache) > wimp_spectra_cache_size:
+        _wimp_spectra_cache.popitem(last=False)
+
+    scale = sigma_nucleon / _REFERENCE_SIGMA
+    if np.ndim(mws) == 0:
+        return spectra[mws] * scale
+    return np.stack([spectra[mw] for mw in mws]) * scale
+
+
 @export
 class WIMPEnergySpectrum(VariableEnergySpectrum):
     model_attributes = ('pretend_wimps_dont_modulate',
@@ -302,7 +428,8 @@ class WIMPEnergySpectrum(VariableEnergySpectrum):
                         'sigma_nucleon',
                         'exposure_tonneyear',
                         'n_time_bins',
-                        'energy_edges') + VariableEnergySpectrum.model_attributes
+                        'energy_edges',
+                        'wimp_spectra_cache_dir') + VariableEnergySpectrum.model_attributes
 
     #: If set to True, the energy spectrum at each time will be set to its
     #: average over the data taking period.
@@ -324,18 +451,17 @@ class WIMPEnergySpectrum(VariableEnergySpectrum):
     #: to allowed energies.
     energy_edges = np.geomspace(0.7, 50, 100)
 
+    #: Directory in which to cache WIMP spectra on disk.
+    #: If None, spectra are only cached in memory.
+    wimp_spectra_cache_dir = None
+
     frozen_model_functions = ('energy_spectrum',)
     array_columns = (('energy_spectrum', len(energy_edges) - 1),)
 
     def setup(self):
-        wimp_kwargs = dict(mw=self.mw,
-                           sigma_nucleon=self.sigma_nucleon,
-                           exposure_tonneyear=self.exposure_tonneyear,
-                           energy_edges=self.energy_edges)
-
         # BlockModelSource is kind enough to let us change these attributes
         # at this stage.
-        e_centers = self.bin_centers(wimp_kwargs['energy_edges'])
+        e_centers = self.bin_centers(self.energy_edges)
         self.energies = fd.np_to_tf(e_centers)
         self.array_columns = (('energy_spectrum', len(self.energy_edges) - 1),)
 
@@ -344,15 +470,9 @@ class WIMPEnergySpectrum(VariableEnergySpectrum):
                             self.n_time_bins + 1)
         time_centers = self.bin_centers(times)
 
-        # Transform wimp_kwargs to arguments that can be passed to wimprates
-        # which means transforming es from edges to centers
-        del wimp_kwargs['energy_edges'], wimp_kwargs['exposure_tonneyear']
-
-        spectra = np.array([wr.rate_wimp_std(t=t,
-                                             es=e_centers,
-                                             **wimp_kwargs)
-                            * np.diff(self.energy_edges)
-                            for t in time_centers])
+        spectra = fd.wimp_spectra(self.mw, time_centers, self.energy_edges,
+                                  sigma_nucleon=self.sigma_nucleon,
+                                  cache_dir=self.wimp_spectra_cache_dir)
         assert spectra.shape == (len(time_centers), len(e_centers))
 
         self.energy_hist = Histdd.from_histogram(
@@ -365,14 +485,22 @@ class WIMPEnergySpectrum(VariableEnergySpectrum):
                 * self.energy_hist.sum(axis=0).histogram.reshape(1, -1)
                 / self.n_time_bins)
 
+        # Plain (n_time_bins, n_energy_bins) array of spectra, for fast
+        # per-event lookups in energy_spectrum
+        self.time_edges = self.energy_hist.bin_edges[0]
+        self.spectra = self.energy_hist.histogram
+
     def energy_spectrum(self, event_time):
         ts = fd.tf_to_np(event_time)
         ts = wr.j2000(ts)
         ts = self.clip_j2000_times(ts)
 
-        result = np.stack([self.energy_hist.slicesum(t).histogram
-                           for t in ts])
-        return fd.np_to_tf(result)
+        # Index of the time bin containing each event. The last bin
+        # includes its right edge, as in multihist's slicesum.
+        time_index = np.clip(
+            np.searchsorted(self.time_edges, ts, side='right') - 1,
+            0, len(self.spectra) - 1)
+        return fd.np_to_tf(self.spectra[time_index])
 
     def clip_j2000_times(self, ts):
         """Return J2000 time(s) ts, clipped to the range of the
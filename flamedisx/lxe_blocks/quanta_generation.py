@@ -1,5 +1,4 @@
 import numpy as np
-from scipy import stats
 import tensorflow as tf
 import tensorflow_probability as tfp
 
@@ -93,7 +92,7 @@ class MakeERQuanta(fd.Block):
 
     def _simulate(self, d):
         work = self.gimme_numpy('work')
-        d['quanta_produced'] = np.floor(d['energy'].values
+        d['quanta_produced'] = np.floor(np.asarray(d['energy'])
                                         / work).astype(int)
 
     def _annotate(self, d):
@@ -206,10 +205,11 @@ class MakeNRQuanta(fd.Block):
 
     def _simulate(self, d):
         # If you forget the .values here, you may get a Python core dump...
-        energies = d['energy'].values
+        energies = np.asarray(d['energy'])
         work = self.gimme_numpy('work')
         lindhard_l = self.gimme_numpy('lindhard_l', bonus_arg=energies)
-        d['quanta_produced'] = stats.poisson.rvs(energies * lindhard_l / work)
+        d['quanta_produced'] = self.source.rng.poisson(
+            energies * lindhard_l / work)
 
     def _annotate(self, d):
         d['quanta_produced_noStep_min'] = (
@@ -1,5 +1,4 @@
 import numpy as np
-from scipy import stats
 import tensorflow as tf
 import tensorflow_probability as tfp
 
@@ -70,23 +69,24 @@ class MakePhotonsElectronsBinomial(fd.Block):
                 total_count=nq, probs=pel).prob(electrons_produced)
 
     def _simulate(self, d):
-        d['p_el_mean'] = self.gimme_numpy('p_electron',
-                                          d['quanta_produced'].values)
+        quanta_produced = np.asarray(d['quanta_produced'])
+        p_el_mean = d['p_el_mean'] = self.gimme_numpy('p_electron',
+                                                      quanta_produced)
 
         if self.do_pel_fluct:
-            d['p_el_fluct'] = self.gimme_numpy(
-                'p_electron_fluctuation', d['quanta_produced'].values)
-            d['p_el_actual'] = 1. - stats.beta.rvs(
-                *fd.beta_params(1. - d['p_el_mean'], d['p_el_fluct']))
+            p_el_fluct = d['p_el_fluct'] = self.gimme_numpy(
+                'p_electron_fluctuation', quanta_produced)
+            p_el_actual = 1. - self.source.rng.beta(
+                *fd.beta_params(1. - p_el_mean, p_el_fluct))
         else:
-            d['p_el_fluct'] = 0.
-            d['p_el_actual'] = d['p_el_mean']
-
-        d['p_el_actual'] = np.nan_to_num(d['p_el_actual']).clip(0, 1)
-        d['electrons_produced'] = stats.binom.rvs(
-            n=d['quanta_produced'],
-            p=d['p_el_actual'])
-        d['photons_produced'] = d['quanta_produced'] - d['electrons_produced']
+            d['p_el_fluct'] = np.zeros(len(quanta_produced))
+            p_el_actual = p_el_mean
+
+        p_el_actual = d['p_el_actual'] = np.nan_to_num(p_el_actual).clip(0, 1)
+        electrons_produced = d['electrons_produced'] = self.source.rng.binomial(
+            quanta_produced,
+            p_el_actual)
+        d['photons_produced'] = quanta_produced - electrons_produced
 
     def _annotate(self, d):
         for suffix in ('min', 'max', 'mle'):
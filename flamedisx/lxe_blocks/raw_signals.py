@@ -1,7 +1,6 @@
 import typing as ty
 
 import numpy as np
-from scipy import stats
 import tensorflow as tf
 import tensorflow_probability as tfp
 
@@ -27,12 +26,28 @@ class MakeFinalSignals(fd.Block):
     signal_name: str
 
     def _simulate(self, d):
-        d[self.signal_name] = stats.norm.rvs(
-            loc=(d[self.quanta_name + 's_detected']
+        quanta_detected = np.asarray(d[self.quanta_name + 's_detected'])
+        d[self.signal_name] = self.source.rng.normal(
+            loc=(quanta_detected
                  * self.gimme_numpy(self.quanta_name + '_gain_mean')),
-            scale=(d[self.quanta_name + 's_detected']**0.5
+            scale=(quanta_detected**0.5
                    * self.gimme_numpy(self.quanta_name + '_gain_std')))
 
+    reweightable = True
+
+    def _simulation_weight(self, d, data_tensor, ptensor):
+        quanta_detected = d[self.quanta_name + 's_detected']
+        mean = quanta_detected * self.gimme(self.quanta_name + '_gain_mean',
+                                            data_tensor=data_tensor,
+                                            ptensor=ptensor)
+        std = quanta_detected ** 0.5 * self.gimme(self.quanta_name + '_gain_std',
+                                                  data_tensor=data_tensor,
+                                                  ptensor=ptensor)
+        log_prob = tfp.distributions.Normal(
+            loc=mean, scale=std + 1e-10
+        ).log_prob(d[self.signal_name])
+        return log_prob, 1.
+
     def _annotate(self, d):
         m = self.gimme_numpy(self.quanta_name + '_gain_mean')
         s = self.gimme_numpy(self.quanta_name + '_gain_std')
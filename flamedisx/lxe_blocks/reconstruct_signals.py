@@ -1,7 +1,6 @@
 import typing as ty
 
 import numpy as np
-from scipy import stats
 import tensorflow as tf
 import tensorflow_probability as tfp
 
@@ -30,18 +29,19 @@ class ReconstructSignals(fd.Block):
     signal_name: str
 
     def _simulate(self, d):
+        raw_signal = np.asarray(d[self.raw_signal_name])
         bias = self.gimme_numpy(f'reconstruction_bias_{self.signal_name}_simulate',
-                                bonus_arg=d[self.raw_signal_name].values)
-        mu = d[self.raw_signal_name] * bias
+                                bonus_arg=raw_signal)
+        mu = raw_signal * bias
 
         # clipping this to (1e-15, float32max) to be symmetric with _compute
         smear = self.gimme_numpy(f'reconstruction_smear_{self.signal_name}_simulate',
-                                 bonus_arg=d[self.raw_signal_name].values)
+                                 bonus_arg=raw_signal)
         smear = np.clip(smear, 1e-15, tf.float32.max)
         # TODO: why some raw signals <=0?
         # checked 1e7 events and didn't see any raw_signals<=0..
 
-        d[self.signal_name] = stats.norm.rvs(
+        d[self.signal_name] = self.source.rng.normal(
             loc=mu,
             scale=smear)
         # Call add_extra_columns now, since s1 and s2 are known and derived
@@ -50,6 +50,27 @@ class ReconstructSignals(fd.Block):
         self.source.add_extra_columns(d)
         d['p_accepted'] *= self.gimme_numpy(self.signal_name + '_acceptance')
 
+    reweightable = True
+
+    def _simulation_weight(self, d, data_tensor, ptensor):
+        s_raw = d[self.raw_signal_name]
+        bias = self.gimme(f'reconstruction_bias_{self.signal_name}_simulate',
+                          data_tensor=data_tensor,
+                          bonus_arg=s_raw,
+                          ptensor=ptensor)
+        smear = self.gimme(f'reconstruction_smear_{self.signal_name}_simulate',
+                           data_tensor=data_tensor,
+                           bonus_arg=s_raw,
+                           ptensor=ptensor)
+        smear = tf.clip_by_value(smear,
+                                 clip_value_min=1e-15,
+                                 clip_value_max=tf.float32.max)
+        log_prob = tfp.distributions.Normal(
+            loc=s_raw * bias, scale=smear).log_prob(d[self.signal_name])
+        acceptance = self.gimme(self.signal_name + '_acceptance',
+                                data_tensor=data_tensor, ptensor=ptensor)
+        return log_prob, acceptance
+
     def _annotate(self, d):
         bias = self.gimme_numpy(f'reconstruction_bias_{self.signal_name}_annotate',
                                 bonus_arg=d[self.signal_name].values)
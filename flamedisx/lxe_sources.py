@@ -105,3 +105,5 @@ class SpatialRateNRSource(NRSource):
 @export
 class WIMPSource(NRSource):
     model_blocks = (fd.WIMPEnergySpectrum,) + NRSource.model_blocks[1:]
+    # The per-event spectra are smooth, and the largest columns
+    low_precision_columns = ('energy_spectrum',)
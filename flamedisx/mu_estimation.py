@@ -2,10 +2,16 @@
 Routines for estimating the total expected events
 and its variation with parameters.
 """
+import datetime
+import hashlib
+import inspect
 import itertools
 from functools import partial
+import os
+import warnings
 
 import numpy as np
+import pandas as pd
 from tqdm import tqdm
 import tensorflow as tf
 import tensorflow_probability as tfp
@@ -13,6 +19,64 @@ import tensorflow_probability as tfp
 import flamedisx as fd
 
 export, __all__ = fd.exporter()
+o = tf.newaxis
+
+
+def _describe(x):
+    """Return a string describing the content of x, for use in cache keys.
+
+    Raises TypeError if x has no content-based description, e.g. for
+    arbitrary objects, whose repr may only give their address.
+    """
+    if x is None or isinstance(x, (bool, int, float, complex, str, bytes,
+                                   datetime.date, datetime.timedelta)):
+        return repr(x)
+    if isinstance(x, dict):
+        return '{' + ', '.join(f'{k!r}: {_describe(v)}'
+                               for k, v in sorted(x.items())) + '}'
+    if isinstance(x, (list, tuple)):
+        return '(' + ', '.join(_describe(v) for v in x) + ')'
+    if isinstance(x, (tf.Tensor, tf.Variable, np.ndarray, np.generic)):
+        x = np.asarray(x)
+        if x.dtype == object:
+            return _describe(x.tolist())
+        x = np.ascontiguousarray(x)
+        return (f'array({x.dtype}, {x.shape}, '
+                f'{hashlib.sha256(x.tobytes()).hexdigest()})')
+    if isinstance(x, (pd.DataFrame, pd.Series)):
+        columns = x.columns if isinstance(x, pd.DataFrame) else [x.name]
+        return (f'{type(x).__name__}({_describe(list(columns))}, '
+                f'{_describe(pd.util.hash_pandas_object(x).values)})')
+    if hasattr(x, 'histogram') and hasattr(x, 'bin_edges'):
+        # multihist histogram
+        return (f'{type(x).__name__}({_describe(x.histogram)}, '
+                f'{_describe(list(x.bin_edges))}, '
+                f'{_describe(list(getattr(x, "axis_names", None) or []))})')
+    if isinstance(x, partial):
+        return (f'partial({_describe(x.func)}, {_describe(x.args)}, '
+                f'{_describe(x.keywords)})')
+    if inspect.isbuiltin(x):
+        return f'{x.__module__}.{x.__qualname__}'
+    if inspect.isclass(x) or inspect.isroutine(x):
+        f = getattr(x, '__func__', x)
+        try:
+            result = inspect.getsource(f)
+        except (OSError, TypeError):
+            raise TypeError(f"Cannot get source code of {x!r}")
+        if inspect.isfunction(f):
+            # Values the function closes over, or takes as defaults
+            closure = [c.cell_contents for c in f.__closure__ or []]
+            result += _describe((f.__defaults__, f.__kwdefaults__, closure))
+        return result
+    raise TypeError(f"Cannot describe {type(x).__name__} object {x!r} "
+                    f"by its content")
+
+
+def _estimate_mu_with_seed(source, task):
+    """Return source's mu estimate for task = (params, n_trials, seed)"""
+    params, n_trials, seed = task
+    np.random.seed(seed)
+    return float(source.estimate_mu(**params, n_trials=n_trials))
 
 
 @export
@@ -20,6 +84,16 @@ class MuEstimator:
 
     n_trials = int(1e5)  # Number of trials per mu simulation
     progress = True      # Whether to show progress bar during building
+    n_workers = 1        # Number of processes for simulations (-1: all CPUs)
+    seed = None          # Seed for simulations (None: use global random state)
+    cache_dir = None     # Directory for caching built estimators (None: no cache)
+    # Variance reduction options for the simulations, see estimate_mus
+    expected_acceptance = False
+    common_random_numbers = False
+    quasi_random = False
+    #: Attributes set by build, which are cached. Tensors,
+    #: or dictionaries of tensors. If empty, the estimator is never cached.
+    cached_attributes: tuple = tuple()
     options: dict
     bounds: dict
     param_options: dict  # dict param -> dict of options per parameter
@@ -30,11 +104,29 @@ class MuEstimator:
             n_trials=None,
             progress=None,
             options=None,
+            n_workers=None,
+            seed=None,
+            cache_dir=None,
+            expected_acceptance=None,
+            common_random_numbers=None,
+            quasi_random=None,
             **param_specs):
         if n_trials is not None:
             self.n_trials = n_trials
         if progress is not None:
             self.progress = progress
+        if n_workers is not None:
+            self.n_workers = n_workers
+        if seed is not None:
+            self.seed = seed
+        if cache_dir is not None:
+            self.cache_dir = cache_dir
+        if expected_acceptance is not None:
+            self.expected_acceptance = expected_acceptance
+        if common_random_numbers is not None:
+            self.common_random_numbers = common_random_numbers
+        if quasi_random is not None:
+            self.quasi_random = quasi_random
         if options is None:
             options = dict()
         self.options = options
@@ -61,15 +153,253 @@ class MuEstimator:
         # MuEstimator.__call__, however, expects to be called with filtered params
         param_specs = {k: v for k, v in param_specs.items() if k in source.defaults}
 
-        # Build the necessary interpolators
-        self.build(source)
+        # Build the necessary interpolators, or load them from the cache
+        cache_path = self.cache_path(source)
+        if cache_path is not None and os.path.exists(cache_path):
+            self.load_cached(cache_path)
+        else:
+            self.build(source)
+            if cache_path is not None:
+                self.save_cached(cache_path)
 
     def build(self, source: fd.Source):
         raise NotImplementedError
 
+    def cache_key(self, source: fd.Source):
+        """Return hash of everything the built estimator depends on:
+        the source code, settings and instance data (see
+        Source.cache_fingerprint), the parameter specifications,
+        and the estimator configuration.
+
+        Raises TypeError if any of these cannot be described by content.
+        """
+        source_classes = [c for c in type(source).__mro__
+                          if issubclass(c, fd.Source)]
+        source_classes += [type(b) for b in getattr(source, 'model_blocks', [])]
+        description = _describe(dict(
+            flamedisx_version=fd.__version__,
+            source_classes=source_classes,
+            defaults=source.defaults,
+            model_functions={
+                fname: getattr(source, fname, None)
+                for fname in getattr(source, 'model_functions', tuple())},
+            model_attributes={
+                aname: getattr(source, aname, None)
+                for aname in source.model_attributes},
+            source_fingerprint=source.cache_fingerprint(),
+            estimator_classes=[c for c in type(self).__mro__
+                               if issubclass(c, MuEstimator)],
+            bounds=self.bounds,
+            param_options=self.param_options,
+            options=self.options,
+            n_trials=self.n_trials,
+            seed=self.seed,
+            simulation_options=self.simulation_options()))
+        return hashlib.sha256(description.encode()).hexdigest()[:32]
+
+    def cache_path(self, source: fd.Source):
+        """Return path of the cache file for this estimator and source,
+        or None if the estimator is not cached
+        """
+        if self.cache_dir is None or not self.cached_attributes:
+            return None
+        if source.cache_fingerprint() is None:
+            warnings.warn(
+                f"Not caching {type(self).__name__} for "
+                f"{type(source).__name__}, which has no cache_fingerprint")
+            return None
+        try:
+            key = self.cache_key(source)
+        except TypeError as e:
+            warnings.warn(
+                f"Not caching {type(self).__name__} for "
+                f"{type(source).__name__}: {e}")
+            return None
+        return os.path.join(self.cache_dir, f'{type(self).__name__}_{key}.npz')
+
+    def save_cached(self, path):
+        """Save cached_attributes to the npz file path"""
+        arrays = dict()
+        for aname in self.cached_attributes:
+            value = getattr(self, aname)
+            if isinstance(value, dict):
+                for k, v in value.items():
+                    arrays[f'{aname}/{k}'] = np.asarray(v)
+            else:
+                arrays[aname] = np.asarray(value)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Write to a temporary file first, so other processes
+        # never see a partially written cache file
+        tmp_path = path + f'.{os.getpid()}.tmp.npz'
+        np.savez(tmp_path, **arrays)
+        os.replace(tmp_path, path)
+
+    def load_cached(self, path):
+        """Set cached_attributes from the npz file path"""
+        with np.load(path) as f:
+            for aname in self.cached_attributes:
+                if aname in f.files:
+                    setattr(self, aname, fd.np_to_tf(f[aname]))
+                else:
+                    setattr(self, aname, {
+                        key.split('/', 1)[1]: fd.np_to_tf(f[key])
+                        for key in f.files if key.startswith(aname + '/')})
+
     def __call__(self, **params):
         raise NotImplementedError
 
+    def place_anchors(self, source: fd.Source, default_n_anchors=2):
+        """Return (anchors, mus), dictionaries mapping parameter names to
+        arrays of anchor points, and (for adaptively placed anchors only)
+        arrays of mus estimated at the anchors while varying only that
+        parameter.
+
+        By default, n_anchors (a parameter option) anchors are spaced
+        linearly between the bounds. If the tolerance option is given, the
+        anchors are placed adaptively instead: each interval between anchors
+        is bisected, and mu simulated at the midpoint. If this differs from
+        the linear interpolation between the ends by more than tolerance
+        (relative to mu), both halves are bisected again, until the
+        tolerance is met or there are max_anchors (default 65) anchors.
+        Thus anchors are only added where mu is curved. The number of anchors
+        and the estimated maximum interpolation error for each adaptive
+        parameter are stored in the anchor_counts and interpolation_errors
+        attributes.
+
+        Adaptive placement needs mu estimates that are much more precise
+        than tolerance; use enough trials, and preferably
+        common_random_numbers and expected_acceptance.
+        """
+        anchors = dict()
+        for pname, (start, stop) in self.bounds.items():
+            n_anchors = int(self.param_options.get(pname, {}).get(
+                'n_anchors', default_n_anchors))
+            anchors[pname] = np.linspace(start, stop, n_anchors)
+
+        tolerances = {
+            pname: float(opts['tolerance'])
+            for pname, opts in self.param_options.items()
+            if 'tolerance' in opts}
+        if not tolerances:
+            return anchors, dict()
+
+        # Estimate mu at the starting anchors of adaptive parameters
+        points = [(pname, x) for pname in tolerances for x in anchors[pname]]
+        mus = self.estimate_mus(source, [{pname: x} for pname, x in points])
+        mu_at = {pname: dict() for pname in tolerances}
+        for (pname, x), mu in zip(points, mus):
+            mu_at[pname][x] = mu
+
+        # Bisect intervals until the tolerance is met
+        intervals = [(pname, a, b)
+                     for pname in tolerances
+                     for a, b in zip(anchors[pname][:-1], anchors[pname][1:])]
+        self.interpolation_errors = {pname: 0. for pname in tolerances}
+        while intervals:
+            midpoints = [(pname, (a + b) / 2) for pname, a, b in intervals]
+            mus = self.estimate_mus(
+                source, [{pname: x} for pname, x in midpoints],
+                desc="Refining anchors")
+            errors = []
+            for (pname, a, b), (_, x), mu in zip(intervals, midpoints, mus):
+                linear_mu = (mu_at[pname][a] + mu_at[pname][b]) / 2
+                errors.append(
+                    abs(mu - linear_mu) / max(abs(mu), abs(linear_mu), 1e-300))
+                mu_at[pname][x] = mu
+
+            # Split the intervals with the largest errors first,
+            # as long as we do not exceed max_anchors
+            n_anchors = {pname: len(xs) for pname, xs in mu_at.items()}
+            new_intervals = []
+            for i in np.argsort(errors)[::-1]:
+                (pname, a, b), (_, x), error = intervals[i], midpoints[i], errors[i]
+                max_anchors = int(self.param_options[pname].get('max_anchors', 65))
+                if (error > tolerances[pname]
+                        and n_anchors[pname] + 2 <= max_anchors):
+                    new_intervals += [(pname, a, x), (pname, x, b)]
+                    n_anchors[pname] += 2
+                else:
+                    self.interpolation_errors[pname] = max(
+                        self.interpolation_errors[pname], error)
+            intervals = new_intervals
+
+        line_mus = dict()
+        self.anchor_counts = dict()
+        for pname in tolerances:
+            anchors[pname] = np.array(sorted(mu_at[pname]))
+            line_mus[pname] = np.array([mu_at[pname][x] for x in anchors[pname]])
+            self.anchor_counts[pname] = len(anchors[pname])
+            error = self.interpolation_errors[pname]
+            if error > tolerances[pname]:
+                warnings.warn(
+                    f"Could not reach tolerance {tolerances[pname]} for {pname} "
+                    f"with {len(anchors[pname])} anchors; estimated "
+                    f"interpolation error is {error:.2g}")
+            elif self.progress:
+                print(f"{pname}: placed {len(anchors[pname])} anchors, estimated "
+                      f"interpolation error {error:.2g}")
+        return anchors, line_mus
+
+    def simulation_options(self):
+        """Return dictionary of extra options for source.estimate_mu"""
+        # Only pass options that are used, so sources with custom
+        # estimate_mu methods need not support them
+        options = dict()
+        if self.expected_acceptance:
+            options['expected_acceptance'] = True
+        if self.quasi_random:
+            options['quasi_random'] = True
+        return options
+
+    def estimate_mus(self, source: fd.Source, param_points, desc="Estimating mus"):
+        """Return list of mus estimated by source.estimate_mu at each of
+        param_points (a list of {param: value} dicts), using n_trials trials.
+
+        Simulations are distributed over n_workers processes. Each point gets
+        its own random seed, derived from seed if it is given (otherwise drawn
+        from the global numpy random state), so results do not depend on
+        n_workers.
+
+        Variance reduction options:
+         - expected_acceptance: average the acceptance of simulated events,
+           rather than drawing which events pass (see Source.estimate_mu);
+         - common_random_numbers: use the same seed for all points, so
+           the simulation noise is (mostly) common to all points, and the
+           estimated mus vary smoothly with the parameters. Best combined
+           with expected_acceptance;
+         - quasi_random: draw the deep truth (energies, positions) from a
+           scrambled Sobol sequence.
+        """
+        param_points = list(param_points)
+        options = self.simulation_options()
+        if (self.seed is None and self.n_workers == 1
+                and not self.common_random_numbers):
+            # Simulate in the global random state, as sources normally do
+            if self.progress:
+                param_points = tqdm(param_points, desc=desc)
+            return [source.estimate_mu(**params, **options, n_trials=self.n_trials)
+                    for params in param_points]
+
+        n_seeds = 1 if self.common_random_numbers else len(param_points)
+        if self.seed is None:
+            seeds = np.random.randint(2**32, size=n_seeds, dtype=np.uint64)
+        else:
+            seeds = [ss.generate_state(1)[0]
+                     for ss in np.random.SeedSequence(self.seed).spawn(n_seeds)]
+        if self.common_random_numbers:
+            seeds = [seeds[0]] * len(param_points)
+        tasks = [({**params, **options}, self.n_trials, seed)
+                 for params, seed in zip(param_points, seeds)]
+
+        # Do not let seeded simulations disturb the global random state
+        random_state = np.random.get_state()
+        try:
+            return fd.map_with_worker_state(
+                _estimate_mu_with_seed, source, tasks,
+                n_workers=self.n_workers, progress=self.progress, desc=desc)
+        finally:
+            np.random.set_state(random_state)
+
 
 @export
 class CrossInterpolatedMu(MuEstimator):
@@ -77,34 +407,53 @@ class CrossInterpolatedMu(MuEstimator):
     each single parameter, then multiply the relative changes.
     """
 
-    def build(self, source: fd.Source):
-        # Estimate mu under the current defaults
-        self.base_mu = tf.constant(
-            source.estimate_mu(n_trials=self.n_trials),
-            dtype=fd.float_type())
+    cached_attributes = ('base_mu', 'anchors', 'mus')
 
-        # Estimate mu variation along each direction
+    def build(self, source: fd.Source):
+        # Anchors along each direction
+        anchors, line_mus = self.place_anchors(source, default_n_anchors=2)
+
+        # Estimate mu under the current defaults, and its variation
+        # along each direction (if not already done), in one go
+        mus = self.estimate_mus(
+            source,
+            [dict()] + [{pname: x}
+                        for pname, xs in anchors.items() for x in xs
+                        if pname not in line_mus])
+
+        self.base_mu = tf.constant(mus[0], dtype=fd.float_type())
+        self.anchors = {pname: fd.np_to_tf(xs) for pname, xs in anchors.items()}
         self.mus = dict()   # parameter -> tensor of mus along anchors
-        _iter = self.bounds.items()
-        if self.progress:
-            _iter = tqdm(_iter, desc="Estimating mus")
-        for pname, (start, stop) in _iter:
-            n_anchors = int(self.param_options.get(pname, {}).get('n_anchors', 2))
+        i = 1
+        for pname, xs in anchors.items():
+            if pname in line_mus:
+                self.mus[pname] = fd.np_to_tf(line_mus[pname])
+                continue
             self.mus[pname] = tf.convert_to_tensor(
-                 [source.estimate_mu(**{pname: x}, n_trials=self.n_trials)
-                  for x in np.linspace(start, stop, n_anchors)],
-                 dtype=fd.float_type())
+                mus[i:i + len(xs)], dtype=fd.float_type())
+            i += len(xs)
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'anchors' not in state:
+            # Pickled by an older flamedisx, which spaced anchors
+            # linearly between the bounds
+            self.anchors = {
+                pname: fd.np_to_tf(np.linspace(start, stop,
+                                               len(self.mus[pname])))
+                for pname, (start, stop) in self.bounds.items()}
 
     def __call__(self, **kwargs):
         kwargs = {param_name: kwargs[param_name] for param_name in self.bounds}
 
         mu = self.base_mu
         for pname, v in kwargs.items():
-            mu *= tfp.math.interp_regular_1d_grid(
-                x=v,
-                x_ref_min=self.bounds[pname][0],
-                x_ref_max=self.bounds[pname][1],
-                y_ref=self.mus[pname]) / self.base_mu
+            # Anchors need not be equally spaced
+            mu *= tfp.math.batch_interp_rectilinear_nd_grid(
+                x=tf.reshape(tf.cast(v, fd.float_type()), (1, 1)),
+                x_grid_points=(self.anchors[pname],),
+                y_ref=self.mus[pname],
+                axis=-1)[0] / self.base_mu
         return mu
 
 
@@ -120,7 +469,7 @@ class SimulateEachCallMu(MuEstimator):
         self.source = source
 
     def __call__(self, **params):
-        return self.source.estimate_mu(**params)
+        return self.source.estimate_mu(**params, **self.simulation_options())
 
 
 @export
@@ -128,6 +477,9 @@ class ConstantMu(MuEstimator):
     """Assume the expected number of events does not depend
     on the fitted parameters
     """
+
+    cached_attributes = ('mu',)
+
     def __init__(self, *args, input_mu=None, **kwargs):
         if input_mu is not None:
             self.mu = input_mu
@@ -136,9 +488,16 @@ class ConstantMu(MuEstimator):
 
         super().__init__(*args, **kwargs)
 
+    def cache_path(self, source: fd.Source):
+        if self.mu is not None:
+            # mu was passed in, nothing to build
+            return None
+        return super().cache_path(source)
+
     def build(self, source: fd.Source):
         if self.mu is None:
-            self.mu = source.estimate_mu(n_trials=self.n_trials)
+            self.mu = source.estimate_mu(n_trials=self.n_trials,
+                                         **self.simulation_options())
 
     def __call__(self, **params):
         result = self.mu
@@ -221,6 +580,12 @@ class CombinedMu(MuEstimator):
                 n_trials=n_trials,
                 progress=progress,
                 options=est_options,
+                n_workers=self.n_workers,
+                seed=None if self.seed is None else (self.seed, len(self.estimators)),
+                cache_dir=self.cache_dir,
+                expected_acceptance=self.expected_acceptance,
+                common_random_numbers=self.common_random_numbers,
+                quasi_random=self.quasi_random,
                 **param_specs
             )
 
@@ -249,6 +614,8 @@ class CombinedMu(MuEstimator):
 class GridInterpolatedMu(MuEstimator):
     """Linearly interpolate the estimated mu on an n-dimensional grid"""
 
+    cached_attributes = ('anchors', 'mu_grid')
+
     def __init__(self, *args, **kwargs):
         if ('n_trials' not in kwargs) or (kwargs['n_trials'] is None):
             kwargs['n_trials'] = int(1e6)
@@ -256,46 +623,166 @@ class GridInterpolatedMu(MuEstimator):
         super().__init__(*args, **kwargs)
 
     def build(self, source: fd.Source):
-        param_lowers = []
-        param_uppers = []
-        grid_shape = ()
-        grid_dict = dict()
-        for pname, (start, stop) in self.bounds.items():
-            param_lowers.append(start)
-            param_uppers.append(stop)
-            n_anchors = int(self.param_options.get(pname, {}).get('n_anchors', 3))
-            grid_shape += (n_anchors,)
-            grid_dict[pname] = np.linspace(start, stop, n_anchors)
-
-        self.param_lowers = fd.np_to_tf(np.asarray(param_lowers))
-        self.param_uppers = fd.np_to_tf(np.asarray(param_uppers))
+        # Anchors along each axis. Adaptive anchors are placed using
+        # the variation of mu along each parameter separately.
+        grid_dict, _ = self.place_anchors(source, default_n_anchors=3)
+        grid_shape = tuple(len(xs) for xs in grid_dict.values())
+        self.anchors = {pname: fd.np_to_tf(xs) for pname, xs in grid_dict.items()}
 
         # Convert dict of anchors to a list of grid points
         # (like sklearn.ParameterGrid)
         keys, values = grid_dict.keys(), grid_dict.values()
         param_grid = [dict(zip(keys, v)) for v in itertools.product(*values)]
-        if self.progress:
-            param_grid = tqdm(param_grid, desc="Estimating mus")
 
-        mu_grid = [
-            source.estimate_mu(**params, n_trials=self.n_trials)
-            for params in param_grid
-        ]
+        mu_grid = self.estimate_mus(source, param_grid)
         self.mu_grid = fd.np_to_tf(np.asarray(mu_grid).reshape(grid_shape))
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'anchors' not in state:
+            # Pickled by an older flamedisx, which spaced anchors
+            # linearly between the bounds (param_lowers, param_uppers)
+            self.anchors = {
+                pname: fd.np_to_tf(np.linspace(start, stop, n_anchors))
+                for (pname, (start, stop)), n_anchors
+                in zip(self.bounds.items(), self.mu_grid.shape)}
+
     def __call__(self, **kwargs):
         # Match kwargs order to grid param order
         # (LogLikelihood.mu already filtered params)
-        kwargs = {param_name: kwargs[param_name] for param_name in self.bounds}
+        x = tf.stack([tf.cast(kwargs[param_name], fd.float_type())
+                      for param_name in self.bounds])
 
-        return tfp.math.batch_interp_regular_nd_grid(
-            [list(kwargs.values())],
-            x_ref_min=self.param_lowers,
-            x_ref_max=self.param_uppers,
+        return tfp.math.batch_interp_rectilinear_nd_grid(
+            x[o, :],
+            x_grid_points=tuple(self.anchors[pname] for pname in self.bounds),
             y_ref=self.mu_grid,
             axis=-len(self.bounds))[0]
 
 
+@export
+class ReweightedMu(MuEstimator):
+    """Estimate mu by reweighting a single simulation, made at the source's
+    defaults, to other parameter values.
+
+    For each simulated event, all hidden variables and the acceptance are
+    stored. mu(params) is then the mean acceptance under params, weighting
+    each event by the ratio of the probabilities of its simulated values
+    under params and under the defaults (normalized by the sum of the
+    weights, which reduces the variance a lot). This is differentiable,
+    so the gradient of mu is exact rather than piecewise-linear.
+
+    Only works for BlockModelSources, and parameters that do not affect the
+    first block (e.g. the energy spectrum). Blocks whose model functions
+    depend on the parameters must be reweightable (e.g. detection,
+    double-PE, raw signal and reconstruction blocks).
+    Reweighting is only efficient if the parameters change the simulation
+    little compared to its event-by-event fluctuations; a warning is
+    shown if the effective number of events drops a lot at the bounds.
+    """
+
+    # Warn if the effective number of events at a bound drops below this
+    # fraction of that at the defaults
+    min_effective_fraction = 0.1
+
+    def build(self, source: fd.Source):
+        if not isinstance(source, fd.BlockModelSource):
+            raise ValueError("ReweightedMu only works for BlockModelSources")
+        self.source = source
+
+        def block_params(b):
+            return set(sum([source.f_params.get(fname, [])
+                            for fname in b.model_functions], []))
+
+        first_block, *blocks = source.model_blocks
+        params = set(self.bounds.keys())
+        if block_params(first_block) & params:
+            raise ValueError(
+                f"Parameters {block_params(first_block) & params} affect "
+                f"{first_block}, and cannot be estimated by reweighting")
+        self.reweighted_blocks = [b for b in blocks if block_params(b) & params]
+        for b in self.reweighted_blocks:
+            if not b.reweightable:
+                raise ValueError(
+                    f"{b} depends on {block_params(b) & params}, but its "
+                    f"simulation cannot be reweighted")
+
+        # Simulate at the defaults, recording the acceptance of each block
+        # rather than removing events
+        random_state = np.random.get_state()
+        if self.seed is not None:
+            np.random.seed(self.seed)
+        try:
+            d = source.random_truth(self.n_trials)
+            with source._set_temporarily(d, _skip_bounds_computation=True):
+                d = source.data
+                fixed_acceptance = np.ones(len(d))
+                for b in blocks:
+                    d['p_accepted'] = 1.
+                    b.simulate(d)
+                    if b not in self.reweighted_blocks:
+                        fixed_acceptance *= d['p_accepted'].values
+                self.data_tensor = source._flat_data_tensor(fill_missing=True)
+        finally:
+            if self.seed is not None:
+                np.random.set_state(random_state)
+
+        self.hidden = {dim: fd.np_to_tf(d[dim].values)
+                       for b in self.reweighted_blocks for dim in b.dimensions}
+        self.fixed_acceptance = fd.np_to_tf(fixed_acceptance)
+        self.mu_before_efficiencies = tf.constant(
+            source.mu_before_efficiencies(), dtype=fd.float_type())
+        self.n_simulated = len(d)
+
+        # Log probabilities of the simulated values at the defaults
+        ptensor = source.ptensor_from_kwargs()
+        self.reference_log_probs = [
+            b.simulation_weight(self.hidden, self.data_tensor, ptensor)[0]
+            for b in self.reweighted_blocks]
+
+        # Check the effective number of events at the bounds
+        self.effective_events = dict()
+        n_ref = self._effective_events(dict())
+        for pname, bounds in self.bounds.items():
+            for x in bounds:
+                n_eff = self._effective_events({pname: x})
+                self.effective_events[(pname, x)] = n_eff
+                if n_eff < self.min_effective_fraction * n_ref:
+                    warnings.warn(
+                        f"Reweighting to {pname}={x} leaves only {n_eff:.0f} "
+                        f"effective events (vs {n_ref:.0f} at the defaults). "
+                        f"Use a narrower range, more trials, or another "
+                        f"mu estimator.")
+
+    def _weights(self, params):
+        """Return (weights, acceptances): (n_simulated,) tensors of
+        event weights and acceptances at params
+        """
+        ptensor = self.source.ptensor_from_kwargs(**params)
+        log_weights = tf.zeros(self.n_simulated, dtype=fd.float_type())
+        acceptances = self.fixed_acceptance
+        for b, reference_log_prob in zip(self.reweighted_blocks,
+                                         self.reference_log_probs):
+            log_prob, acceptance = b.simulation_weight(
+                self.hidden, self.data_tensor, ptensor)
+            log_weights += log_prob - reference_log_prob
+            acceptances = acceptances * acceptance
+        # Subtracting the maximum avoids overflow, and cancels in __call__
+        log_weights -= tf.stop_gradient(tf.reduce_max(log_weights))
+        return tf.exp(log_weights), acceptances
+
+    def _effective_events(self, params):
+        """Return the effective number of simulated events (Kish's
+        effective sample size) at params"""
+        w = self._weights(params)[0].numpy().astype(np.float64)
+        return w.sum()**2 / (w**2).sum()
+
+    def __call__(self, **params):
+        weights, acceptances = self._weights(params)
+        return (self.mu_before_efficiencies
+                * tf.reduce_sum(weights * acceptances) / tf.reduce_sum(weights))
+
+
 @export
 def is_mu_estimator_class(x):
     if isinstance(x, partial):
@@ -137,6 +137,8 @@ class DetectPhotons(DetectPhotonsOrElectrons):
     model_functions = ('photon_detection_eff',
                        's1_posDependence') + special_model_functions
 
+    annotation_attributes = fd.Block.annotation_attributes + ('coin_table',)
+
     def s1_posDependence(self, r, z):
         """
         Override for specific detector.
@@ -18,6 +18,9 @@ class EnergySpectrum(fd.FirstBlock):
         'drift_velocity',
         't_start', 't_stop')
 
+    # Annotation draws an MC reservoir for the source, so it is not shared
+    share_annotations = False
+
     # The default boundaries are at points where the WIMP wind is at its
     # average speed.
     # This will then also be true at the midpoint of these times.
@@ -345,7 +348,8 @@ class WIMPEnergySpectrum(VariableEnergySpectrum):
                         'mw',
                         'sigma_nucleon',
                         'n_time_bins',
-                        'energy_edges') + VariableEnergySpectrum.model_attributes
+                        'energy_edges',
+                        'wimp_spectra_cache_dir') + VariableEnergySpectrum.model_attributes
 
     # If set to True, the energy spectrum at each time will be set to its
     # average over the data taking period.
@@ -359,17 +363,17 @@ class WIMPEnergySpectrum(VariableEnergySpectrum):
     # for other purposes
     energy_edges = np.geomspace(0.7, 50, 100)
 
+    # Directory in which to cache WIMP spectra on disk.
+    # If None, spectra are only cached in memory.
+    wimp_spectra_cache_dir = None
+
     frozen_model_functions = ('energy_spectrum',)
     array_columns = (('energy_spectrum', len(energy_edges) - 1),)
 
     def setup(self):
-        wimp_kwargs = dict(mw=self.mw,
-                           sigma_nucleon=self.sigma_nucleon,
-                           energy_edges=self.energy_edges)
-
         # BlockModelSource is kind enough to let us change these attributes
         # at this stage.
-        e_centers = self.bin_centers(wimp_kwargs['energy_edges'])
+        e_centers = self.bin_centers(self.energy_edges)
         self.energies = fd.np_to_tf(e_centers)
         self.array_columns = (('energy_spectrum', len(self.energy_edges) - 1),)
 
@@ -378,14 +382,9 @@ class WIMPEnergySpectrum(VariableEnergySpectrum):
                             self.n_time_bins + 1)
         time_centers = self.bin_centers(times)
 
-        # Transform wimp_kwargs to arguments that can be passed to wimprates
-        # which means transforming es from edges to centers
-        del wimp_kwargs['energy_edges']
-        spectra = np.array([wr.rate_wimp_std(t=t,
-                                             es=e_centers,
-                                             **wimp_kwargs)
-                            * np.diff(self.energy_edges)
-                            for t in time_centers])
+        spectra = fd.wimp_spectra(self.mw, time_centers, self.energy_edges,
+                                  sigma_nucleon=self.sigma_nucleon,
+                                  cache_dir=self.wimp_spectra_cache_dir)
         assert spectra.shape == (len(time_centers), len(e_centers))
 
         self.energy_hist = Histdd.from_histogram(
@@ -398,14 +397,22 @@ class WIMPEnergySpectrum(VariableEnergySpectrum):
                 * self.energy_hist.sum(axis=0).histogram.reshape(1, -1)
                 / self.n_time_bins)
 
+        # Plain (n_time_bins, n_energy_bins) array of spectra, for fast
+        # per-event lookups in energy_spectrum
+        self.time_edges = self.energy_hist.bin_edges[0]
+        self.spectra = self.energy_hist.histogram
+
     def energy_spectrum(self, event_time):
         ts = fd.tf_to_np(event_time)
         ts = wr.j2000(ts)
         ts = self.clip_j2000_times(ts)
 
-        result = np.stack([self.energy_hist.slicesum(t).histogram
-                           for t in ts])
-        return fd.np_to_tf(result)
+        # Index of the time bin containing each event. The last bin
+        # includes its right edge, as in multihist's slicesum.
+        time_index = np.clip(
+            np.searchsorted(self.time_edges, ts, side='right') - 1,
+            0, len(self.spectra) - 1)
+        return fd.np_to_tf(self.spectra[time_index])
 
     def clip_j2000_times(self, ts):
         """Return J2000 time(s) ts, clipped to the range of the
@@ -101,6 +101,9 @@ class MakeS1(MakeFinalSignals):
 
     max_dim_size = {'s1_photoelectrons_detected': 120}
 
+    annotation_attributes = fd.Block.annotation_attributes + (
+        'S1_min', 'S1_max', 'spe_thr')
+
     def s1_acceptance(self, s1):
         return tf.where((s1 < self.source.S1_min) | (s1 < self.source.spe_thr) | (s1 > self.source.S1_max),
                         tf.zeros_like(s1, dtype=fd.float_type()),
@@ -133,6 +136,9 @@ class MakeS2(MakeFinalSignals):
 
     max_dim_size = {'s2_photoelectrons_detected': 120}
 
+    annotation_attributes = fd.Block.annotation_attributes + (
+        'S2_min', 'S2_max')
+
     def s2_acceptance(self, s2):
         return tf.where((s2 < self.source.S2_min) | (s2 > self.source.S2_max),
                         tf.zeros_like(s2, dtype=fd.float_type()),
@@ -510,3 +510,5 @@ class nestSpatialRateNRSource(nestNRSource):
 @export
 class nestWIMPSource(nestNRSource):
     model_blocks = (fd_nest.WIMPEnergySpectrum,) + nestNRSource.model_blocks[1:]
+    # The per-event spectra are smooth, and the largest columns
+    low_precision_columns = ('energy_spectrum',)
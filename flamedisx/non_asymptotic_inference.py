@@ -3,6 +3,9 @@ import numpy as np
 from scipy import stats
 from tqdm.auto import tqdm
 import typing as ty
+import glob
+import os
+import zlib
 
 import tensorflow as tf
 
@@ -20,6 +23,11 @@ class TestStatistic():
     def __init__(self, likelihood):
         self.likelihood = likelihood
 
+    def evaluate_from_ll(self, ll_conditional, ll_unconditional):
+        """Override this in derived classes to support batched toy fits"""
+        raise NotImplementedError(
+            f"{self.__class__.__name__} does not support batched toy fits")
+
     def __call__(self, mu_test, signal_source_name, guess_dict):
         # To fix the signal RM in the conditional fit
         fix_dict = {f'{signal_source_name}_rate_multiplier': mu_test}
@@ -53,6 +61,28 @@ class TestStatisticTMuTilde(TestStatistic):
         else:
             return ts
 
+    def evaluate_from_ll(self, ll_conditional, ll_unconditional):
+        """Return array of test statistics from arrays of conditional and
+        unconditional best-fit log likelihoods, e.g. from a BatchedToyFitter
+        """
+        return np.maximum(-2. * (np.asarray(ll_conditional) - np.asarray(ll_unconditional)), 0.)
+
+
+def p_val_with_error(ts_dist, observed_ts, inverse=False):
+    """Return the p-value of observed_ts under the test statistic distribution
+    ts_dist (an array of toy test statistics), and its binomial standard error.
+    Pass inverse=True to evaluate the integral from -infinity to t_obs instead
+    of from t_obs to +infinity.
+
+    The error is regularised (using (k + 0.5) / (n + 1) as the probability),
+    so it does not vanish for p-values of exactly 0 or 1.
+    """
+    n = len(ts_dist)
+    fraction_below = stats.percentileofscore(ts_dist, observed_ts, kind='weak') / 100.
+    p_val = fraction_below if inverse else 1. - fraction_below
+    p_reg = (p_val * n + 0.5) / (n + 1.)
+    return p_val, np.sqrt(p_reg * (1. - p_reg) / n)
+
 
 @export
 class TestStatisticDistributions():
@@ -74,24 +104,24 @@ class TestStatisticDistributions():
     def add_conditional_best_fit(self, mu_test, fit_values):
         self.conditional_best_fits[mu_test] = fit_values
 
-    def get_p_vals(self, observed_test_stats, inverse=False):
+    def get_p_vals(self, observed_test_stats, inverse=False, return_errors=False):
         """Evaluate the p-value for a set of observed test statistics using the
         stored test statistic distributions. Pass inverse=True to evaluate the integral
         from -infinity to t_obs instead of from t_obs to +infinity.
+        Pass return_errors=True to also return the binomial standard errors
+        on the p-values, due to the finite number of toys.
         """
         p_vals = dict()
+        p_val_errors = dict()
         assert self.ts_dists.keys() == observed_test_stats.test_stats.keys(), \
             'POI values for observed test statistics and test statistic distributions ' \
             'do not match'
         for mu_test in observed_test_stats.test_stats.keys():
-            if not inverse:
-                p_vals[mu_test] = (100. - stats.percentileofscore(self.ts_dists[mu_test],
-                                                                  observed_test_stats.test_stats[mu_test],
-                                                                  kind='weak')) / 100.
-            else:
-                p_vals[mu_test] = stats.percentileofscore(self.ts_dists[mu_test],
-                                                          observed_test_stats.test_stats[mu_test],
-                                                          kind='weak') / 100.
+            p_vals[mu_test], p_val_errors[mu_test] = p_val_with_error(
+                self.ts_dists[mu_test], observed_test_stats.test_stats[mu_test],
+                inverse=inverse)
+        if return_errors:
+            return p_vals, p_val_errors
         return p_vals
 
     def get_crit_vals(self, conf_level):
@@ -125,6 +155,252 @@ class ObservedTestStatistics():
         self.conditional_best_fits[mu_test] = fit_values
 
 
+def fits_to_records(fits):
+    """Convert a list of best fit dictionaries to a numpy structured array,
+    with one field per fit parameter.
+    """
+    names = sorted(set().union(*[fit.keys() for fit in fits]))
+    records = np.zeros(len(fits), dtype=[(name, np.float64) for name in names])
+    for i, fit in enumerate(fits):
+        for name, value in fit.items():
+            records[i][name] = value
+    return records
+
+
+def records_to_fits(records):
+    """Convert a numpy structured array back to a list of best fit dictionaries
+    """
+    return [{name: record[name] for name in records.dtype.names}
+            for record in records]
+
+
+@export
+class ToyStore():
+    """Append-only on-disk store for the results of TSEvaluation, so that long
+    runs can be interrupted and resumed, and results of parallel jobs merged.
+
+    Each chunk of toys (or each observed test statistic) is written as a separate
+    NPZ shard, labelled by signal source, mu_test and toy batch. Shards contain
+    the test statistics, the random seeds used to generate the toys, and
+    (optionally) the best fits, stored as numpy structured arrays with one
+    field per fit parameter. The labels are stored in the shards too, and are
+    read from there rather than parsed from the file names, so any signal
+    source name is supported.
+
+    Arguments:
+        - directory: directory in which to store the shards. Will be created
+            if it does not exist.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def _mu_key(mu_test):
+        return repr(float(mu_test))
+
+    def _unit_prefix(self, kind, signal_source_name, mu_test, toy_batch=0):
+        if os.sep in signal_source_name:
+            raise ValueError(f"Signal source name {signal_source_name} "
+                             f"cannot contain {os.sep}")
+        return os.path.join(
+            self.directory,
+            f'{kind}__{signal_source_name}__mu{self._mu_key(mu_test)}__batch{toy_batch}__')
+
+    def _write(self, path, **arrays):
+        # Write to a hidden temporary file first, so a crash while writing
+        # never leaves a corrupted shard behind
+        tmp_path = os.path.join(os.path.dirname(path),
+                                '.' + os.path.basename(path) + '.tmp')
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def _read(path):
+        with np.load(path, allow_pickle=False) as f:
+            return {key: f[key] for key in f.files}
+
+    def _shards(self, kind, signal_source_name=None, mu_test=None, toy_batch=None):
+        """Return list of shards (dictionaries of arrays) matching the
+        selection, in order of file name. None selects everything.
+        """
+        # The glob only preselects files: source names may contain '__'
+        # or glob special characters, so check the labels stored in the shards.
+        source_key = '*' if signal_source_name is None else glob.escape(signal_source_name)
+        mu_key = '*' if mu_test is None else self._mu_key(mu_test)
+        batch_key = '*' if toy_batch is None else toy_batch
+        pattern = os.path.join(
+            glob.escape(self.directory),
+            f'{kind}__{source_key}__mu{mu_key}__batch{batch_key}__*.npz')
+        result = []
+        for path in sorted(glob.glob(pattern)):
+            shard = self._read(path)
+            if ((signal_source_name is None
+                    or shard['signal_source_name'] == signal_source_name)
+                    and (mu_test is None
+                         or self._mu_key(shard['mu_test']) == self._mu_key(mu_test))
+                    and (toy_batch is None
+                         or int(shard['toy_batch']) == toy_batch)):
+                result.append(shard)
+        return result
+
+    def write_toys(self, signal_source_name, mu_test, toy_batch, start, stop,
+                   ts_values_SB, ts_values_B, seeds, fits=None):
+        """Write results for toys start, ..., stop - 1 of one toy batch.
+
+        Arguments:
+            - fits: optional dictionary {'unconditional_bfs_SB': list of fit dicts, ...}
+        """
+        arrays = dict(signal_source_name=np.str_(signal_source_name),
+                      mu_test=np.float64(mu_test),
+                      toy_batch=np.int64(toy_batch),
+                      start=np.int64(start),
+                      stop=np.int64(stop),
+                      toy_index=np.arange(start, stop),
+                      ts_values_SB=np.asarray(ts_values_SB, dtype=np.float64),
+                      ts_values_B=np.asarray(ts_values_B, dtype=np.float64),
+                      seeds=np.asarray(seeds, dtype=np.uint64))
+        if fits is not None:
+            for key, fit_values in fits.items():
+                arrays[key] = fits_to_records(fit_values)
+        path = (self._unit_prefix('toys', signal_source_name, mu_test, toy_batch)
+                + f'{start:09d}-{stop:09d}.npz')
+        self._write(path, **arrays)
+
+    def read_toys(self, signal_source_name, mu_test, toy_batch):
+        """Return dictionary of arrays with the stored results for the contiguous
+        range of toys 0, ..., n_completed - 1 of one toy batch
+        """
+        result = dict()
+        n_completed = 0
+        shards = self._shards('toys', signal_source_name, mu_test, toy_batch)
+        for shard in sorted(shards, key=lambda x: int(x['start'])):
+            if int(shard['start']) != n_completed:
+                # Gap in the stored toys (e.g. chunk size changed between runs)
+                # ignore everything beyond it.
+                break
+            for key, value in shard.items():
+                if value.ndim:
+                    result.setdefault(key, []).append(value)
+            n_completed = int(shard['stop'])
+        return {key: np.concatenate(values) for key, values in result.items()}
+
+    def n_completed_toys(self, signal_source_name, mu_test, toy_batch):
+        """Return the number of toys in the store for one toy batch"""
+        return len(self.read_toys(signal_source_name, mu_test, toy_batch)
+                   .get('toy_index', []))
+
+    def write_observed(self, signal_source_name, mu_test, test_stat, fits=None):
+        """Write an observed test statistic, and optionally the best fits
+        (dictionary {'unconditional_bf': fit dict, 'conditional_bf': fit dict})
+        """
+        arrays = dict(signal_source_name=np.str_(signal_source_name),
+                      mu_test=np.float64(mu_test),
+                      toy_batch=np.int64(0),
+                      test_stat=np.float64(test_stat))
+        if fits is not None:
+            for key, fit_values in fits.items():
+                arrays[key] = fits_to_records([fit_values])
+        path = self._unit_prefix('observed', signal_source_name, mu_test) + 'observed.npz'
+        self._write(path, **arrays)
+
+    def read_observed(self, signal_source_name, mu_test):
+        """Return dictionary of stored observed results, or None if this
+        unit has not been completed yet.
+        """
+        shards = self._shards('observed', signal_source_name, mu_test, 0)
+        if not len(shards):
+            return None
+        return shards[0]
+
+    def _signal_source_names(self, kind):
+        return sorted(set(str(shard['signal_source_name'])
+                          for shard in self._shards(kind)))
+
+    def test_stat_dists(self, signal_source_names=None, toy_batches=None):
+        """Merge all stored toy shards into test statistic distributions.
+
+        Best fits (if stored) are kept as numpy structured arrays, so that
+        fits[mu_test][i]['param'] and fits[mu_test]['param'] both work.
+
+        Arguments:
+            - signal_source_names: signal sources to load. If None, load all.
+            - toy_batches: toy batches to load. If None, load all.
+
+        Returns tuple of dictionaries {sourcename: TestStatisticDistributions}
+        for the S+B and B-only hypotheses.
+        """
+        if signal_source_names is None:
+            signal_source_names = self._signal_source_names('toys')
+
+        test_stat_dists_SB_collection = dict()
+        test_stat_dists_B_collection = dict()
+        for signal_source in signal_source_names:
+            # Group shards per mu_test, in order of toy batch and first toy
+            shards_per_mu = dict()
+            for shard in self._shards('toys', signal_source):
+                if toy_batches is not None and shard['toy_batch'] not in toy_batches:
+                    continue
+                key = (int(shard['toy_batch']), int(shard['toy_index'][0]))
+                shards_per_mu.setdefault(float(shard['mu_test']), []).append((key, shard))
+
+            test_stat_dists_SB = TestStatisticDistributions()
+            test_stat_dists_B = TestStatisticDistributions()
+            for mu_test in sorted(shards_per_mu.keys()):
+                shards = [shard for _, shard in sorted(shards_per_mu[mu_test],
+                                                       key=lambda x: x[0])]
+
+                def merged(key):
+                    return np.concatenate([shard[key] for shard in shards])
+
+                test_stat_dists_SB.add_ts_dist(mu_test, merged('ts_values_SB'))
+                test_stat_dists_B.add_ts_dist(mu_test, merged('ts_values_B'))
+                if 'unconditional_bfs_SB' in shards[0]:
+                    test_stat_dists_SB.add_unconditional_best_fit(
+                        mu_test, merged('unconditional_bfs_SB'))
+                    test_stat_dists_SB.add_conditional_best_fit(
+                        mu_test, merged('conditional_bfs_SB'))
+                    test_stat_dists_B.add_unconditional_best_fit(
+                        mu_test, merged('unconditional_bfs_B'))
+                    test_stat_dists_B.add_conditional_best_fit(
+                        mu_test, merged('conditional_bfs_B'))
+
+            test_stat_dists_SB_collection[signal_source] = test_stat_dists_SB
+            test_stat_dists_B_collection[signal_source] = test_stat_dists_B
+
+        return test_stat_dists_SB_collection, test_stat_dists_B_collection
+
+    def observed_test_stats(self, signal_source_names=None):
+        """Merge all stored observed shards into observed test statistics.
+
+        Best fits (if stored) are numpy records, indexable by parameter name.
+
+        Arguments:
+            - signal_source_names: signal sources to load. If None, load all.
+
+        Returns dictionary {sourcename: ObservedTestStatistics}.
+        """
+        if signal_source_names is None:
+            signal_source_names = self._signal_source_names('observed')
+
+        observed_test_stats_collection = dict()
+        for signal_source in signal_source_names:
+            shards = self._shards('observed', signal_source)
+            observed_test_stats = ObservedTestStatistics()
+            for shard in sorted(shards, key=lambda x: float(x['mu_test'])):
+                mu_test = float(shard['mu_test'])
+                observed_test_stats.add_test_stat(mu_test, float(shard['test_stat']))
+                if 'unconditional_bf' in shard:
+                    observed_test_stats.add_unconditional_best_fit(
+                        mu_test, shard['unconditional_bf'][0])
+                    observed_test_stats.add_conditional_best_fit(
+                        mu_test, shard['conditional_bf'][0])
+            observed_test_stats_collection[signal_source] = observed_test_stats
+
+        return observed_test_stats_collection
+
+
 @export
 class TSEvaluation():
     """NOTE: currently works for a single dataset only.
@@ -149,8 +425,28 @@ class TSEvaluation():
         - log_constraint_fn: logarithm of the constraint function used in the likelihood. Any arguments
             which aren't fit parameters, such as those determining constraint means for toys, will need
             passing via the set_constraint_extra_args() function
-        - ntoys: number of toys that will be run to get test statistic distributions
+        - ntoys: number of toys that will be run to get test statistic distributions.
+            If conf_level is passed, this is the maximum number of toys per mu_test
         - batch_size: batch size that will be used for the RM fits
+        - conf_level: if passed, the number of toys is adapted for each mu_test: toys
+            stop once the S+B p-value is resolved relative to conf_level. The p-value
+            is evaluated at the observed test statistic (if observed_test_stats are
+            passed to run_routine), or otherwise at each of the band_quantiles of the
+            B-only test statistics, which must all be resolved
+        - band_quantiles: quantiles (in sigma) of the B-only test statistics at which
+            the p-value must be resolved when adapting the number of toys for
+            expected limits, see get_bands
+        - ntoys_min: minimum number of toys per mu_test when adapting the number of toys
+        - p_val_precision: when adapting the number of toys, stop once the binomial
+            error on the p-value is below this
+        - n_sigma_resolved: when adapting the number of toys, stop once the p-value
+            differs from conf_level by more than this many binomial errors
+        - binned: if True, use a BinnedLogLikelihood, and simulate toys as counts
+            per template bin. All sources must be template sources with the same binning
+        - batched_fits: if True, fit all toys of a chunk (of checkpoint_every toys)
+            simultaneously with a BatchedToyFitter, rather than one by one. All sources
+            must be template or frozen reservoir sources, and log_constraint_fn must
+            work elementwise on arrays of parameters
     """
     def __init__(
             self,
@@ -165,7 +461,14 @@ class TSEvaluation():
             rm_bounds: ty.Dict[str, ty.Tuple[float, float]] = None,
             log_constraint_fn: ty.Callable = None,
             ntoys=1000,
-            batch_size=10000):
+            batch_size=10000,
+            conf_level=None,
+            ntoys_min=100,
+            band_quantiles=(0, 1, -1, 2, -2),
+            p_val_precision=0.005,
+            n_sigma_resolved=3.,
+            binned=False,
+            batched_fits=False):
 
         for key in sources.keys():
             if key not in arguments.keys():
@@ -193,6 +496,15 @@ class TSEvaluation():
         self.ntoys = ntoys
         self.batch_size = batch_size
 
+        self.conf_level = conf_level
+        self.ntoys_min = ntoys_min
+        self.band_quantiles = band_quantiles
+        self.p_val_precision = p_val_precision
+        self.n_sigma_resolved = n_sigma_resolved
+
+        self.binned = binned
+        self.batched_fits = batched_fits
+
         self.test_statistic = test_statistic
 
         self.signal_source_names = signal_source_names
@@ -206,13 +518,20 @@ class TSEvaluation():
         self.sample_other_constraints = sample_other_constraints
         self.rm_bounds = rm_bounds
 
+        # These are set when calling run_routine
+        self.toy_store = None
+        self.checkpoint_every = None
+        self.seed = None
+        self.toy_batch = 0
+
     def run_routine(self, mus_test=None, save_fits=False,
                     observed_data=None,
                     observed_test_stats=None,
                     generate_B_toys=False,
                     simulate_dict_B=None, toy_data_B=None, constraint_extra_args_B=None,
                     toy_batch=0,
-                    discovery=False):
+                    discovery=False,
+                    toy_store=None, checkpoint_every=100, seed=None):
         """If observed_data is passed, evaluate observed test statistics. Otherwise,
         obtain test statistic distributions (for both S+B and B-only).
 
@@ -238,7 +557,20 @@ class TSEvaluation():
                 generate_B_toys=True)
             - toy_batch: if parallelising toys, this should correspond to the parallel batch index
                 (starting at 0) being run, to ensure the correct background-only toys are accessed
+            - toy_store: fd.ToyStore, or directory for one. If passed, results are written
+                to disk as they are obtained, and results already in the store are not
+                recomputed, so an interrupted run can be resumed by calling this again
+            - checkpoint_every: number of toys after which results are written to the toy_store
+            - seed: seed from which the random seeds of the individual toys are derived.
+                If None, these are drawn from the global numpy random state
         """
+        if toy_store is not None and not isinstance(toy_store, ToyStore):
+            toy_store = ToyStore(toy_store)
+        self.toy_store = toy_store
+        self.checkpoint_every = checkpoint_every
+        self.seed = seed
+        self.toy_batch = toy_batch
+
         if observed_test_stats is not None:
             self.observed_test_stats = observed_test_stats
         else:
@@ -254,7 +586,6 @@ class TSEvaluation():
             self.simulate_dict_B = simulate_dict_B
             self.toy_data_B = toy_data_B
             self.constraint_extra_args_B = constraint_extra_args_B
-            self.toy_batch = toy_batch
 
         observed_test_stats_collection = dict()
         test_stat_dists_SB_collection = dict()
@@ -275,7 +606,8 @@ class TSEvaluation():
             arguments[signal_source] = self.arguments[signal_source]
 
             # Create likelihood of TemplateSources
-            likelihood = fd.LogLikelihood(sources=sources,
+            likelihood_class = fd.BinnedLogLikelihood if self.binned else fd.LogLikelihood
+            likelihood = likelihood_class(sources=sources,
                                           arguments=arguments,
                                           progress=False,
                                           batch_size=self.batch_size,
@@ -363,25 +695,146 @@ class TSEvaluation():
             simulate_dict[f'{background_source}_rate_multiplier'] = expected_background_counts
             simulate_dict[f'{signal_source_name}_rate_multiplier'] = mu_test
 
-        toy_data = likelihood.simulate(**simulate_dict)
+        if self.binned:
+            toy_data = likelihood.simulate_binned(**simulate_dict)
+        else:
+            toy_data = likelihood.simulate(**simulate_dict)
 
         return simulate_dict, toy_data, constraint_extra_args
 
+    @staticmethod
+    def set_toy_data(likelihood, toy_data, fast_toys=False):
+        """Internal function to set toy data in the likelihood. If fast_toys,
+        toy_data is annotated in-place for all sources at once.
+        The rate multiplier guesses are not updated, we pass guesses to the fits.
+        """
+        if fast_toys:
+            likelihood.set_data(likelihood.annotate_data(toy_data),
+                                data_is_annotated=True,
+                                update_guesses=False)
+        else:
+            likelihood.set_data(toy_data, update_guesses=False)
+
+    def toy_seed(self, signal_source_name, mu_test, toy):
+        """Return the random seed for one toy. If a seed was passed to run_routine,
+        this depends only on that seed, the signal source, mu_test, the toy batch and
+        the toy index, so resumed runs reproduce the toys of uninterrupted ones.
+        """
+        if self.seed is None:
+            return np.random.randint(2**32, dtype=np.uint64)
+        unit_key = zlib.crc32(f'{signal_source_name}_{float(mu_test)!r}'.encode())
+        return np.random.SeedSequence(
+            [self.seed, unit_key, self.toy_batch, toy]).generate_state(1)[0]
+
+    def p_val_resolved(self, ts_values_SB, ts_values_B, mu_test, signal_source_name):
+        """Return whether no more toys are needed for this mu_test, when adapting
+        the number of toys: i.e. whether the S+B p-value is either clearly above or
+        below conf_level, or known to the requested precision, at the observed
+        test statistic or (for expected limits) at all band_quantiles of the
+        B-only test statistics.
+        """
+        if self.conf_level is None or len(ts_values_SB) < max(self.ntoys_min, 1):
+            return False
+
+        if self.observed_test_stats is not None:
+            try:
+                observed_ts = [self.observed_test_stats[signal_source_name].test_stats[mu_test]]
+            except Exception:
+                raise RuntimeError("Could not find observed test statistic")
+        else:
+            # For the expected limit and its bands, the relevant test statistics
+            # are those of the B-only toys
+            observed_ts = np.quantile(ts_values_B,
+                                      stats.norm.cdf(self.band_quantiles))
+
+        for ts in observed_ts:
+            p_val, p_val_error = p_val_with_error(np.asarray(ts_values_SB), ts)
+            if not (p_val_error < self.p_val_precision
+                    or abs(p_val - self.conf_level) > self.n_sigma_resolved * p_val_error):
+                return False
+        return True
+
     def toy_test_statistic_dist(self, test_stat_dists_SB, test_stat_dists_B,
                                 mu_test, signal_source_name, likelihood,
                                 save_fits=False, discovery=False):
         """Internal function to get test statistic distribution.
         """
-        ts_values_SB = []
-        ts_values_B = []
+        fit_keys = ('unconditional_bfs_SB', 'conditional_bfs_SB',
+                    'unconditional_bfs_B', 'conditional_bfs_B')
+        results = dict(ts_values_SB=[], ts_values_B=[])
+        if save_fits:
+            results.update({key: [] for key in fit_keys})
+
+        # Start from any toys already in the store
+        n_completed = 0
+        if self.toy_store is not None:
+            stored = self.toy_store.read_toys(signal_source_name, mu_test, self.toy_batch)
+            n_completed = min(len(stored.get('toy_index', [])), self.ntoys)
+            if n_completed and save_fits and fit_keys[0] not in stored:
+                raise RuntimeError("Stored toys do not include best fits, but save_fits=True")
+            for key in results:
+                values = stored.get(key, [])[:n_completed]
+                if key in fit_keys:
+                    values = records_to_fits(values)
+                results[key] += list(values)
+
+        # Loop over chunks of toys, checkpointing after each chunk
+        chunk_size = self.checkpoint_every if self.checkpoint_every else self.ntoys
+        for start in range(n_completed, self.ntoys, chunk_size):
+            if self.p_val_resolved(results['ts_values_SB'], results['ts_values_B'],
+                                   mu_test, signal_source_name):
+                break
+            stop = min(start + chunk_size, self.ntoys)
+            chunk_results = self.run_toys(start, stop, mu_test, signal_source_name, likelihood,
+                                          save_fits=save_fits, discovery=discovery)
+            seeds = chunk_results.pop('seeds')
+            if self.toy_store is not None:
+                self.toy_store.write_toys(
+                    signal_source_name, mu_test, self.toy_batch, start, stop,
+                    chunk_results['ts_values_SB'], chunk_results['ts_values_B'], seeds,
+                    fits={key: chunk_results[key] for key in fit_keys} if save_fits else None)
+            for key in results:
+                results[key] += chunk_results[key]
+
+        # Add to the test statistic distributions
+        test_stat_dists_SB.add_ts_dist(mu_test, results['ts_values_SB'])
+        test_stat_dists_B.add_ts_dist(mu_test, results['ts_values_B'])
+
+        # Possibly save the fits
+        if save_fits:
+            test_stat_dists_SB.add_unconditional_best_fit(mu_test, results['unconditional_bfs_SB'])
+            test_stat_dists_SB.add_conditional_best_fit(mu_test, results['conditional_bfs_SB'])
+            test_stat_dists_B.add_unconditional_best_fit(mu_test, results['unconditional_bfs_B'])
+            test_stat_dists_B.add_conditional_best_fit(mu_test, results['conditional_bfs_B'])
+
+    def run_toys(self, start, stop, mu_test, signal_source_name, likelihood,
+                 save_fits=False, discovery=False):
+        """Internal function to run toys start, ..., stop - 1 for one value of mu_test.
+        Returns a dictionary of lists of test statistics, seeds and (optionally) fits.
+        """
+        if self.batched_fits:
+            return self.run_toys_batched(start, stop, mu_test, signal_source_name, likelihood,
+                                         save_fits=save_fits, discovery=discovery)
+
+        results = dict(ts_values_SB=[], ts_values_B=[], seeds=[])
         if save_fits:
-            unconditional_bfs_SB = []
-            conditional_bfs_SB = []
-            unconditional_bfs_B = []
-            conditional_bfs_B = []
+            results.update(unconditional_bfs_SB=[], conditional_bfs_SB=[],
+                           unconditional_bfs_B=[], conditional_bfs_B=[])
+
+        # If all sources store their annotations in their own columns,
+        # we can annotate the toys once for all sources, rather than
+        # copying and annotating them for each source in set_data.
+        # Binned toys need no annotation at all.
+        fast_toys = self.binned or all(
+            isinstance(source, (fd.ColumnSource, fd.MultiTemplateSource))
+            for source in likelihood.sources.values())
 
         # Loop over toys
-        for toy in tqdm(range(self.ntoys), desc='Doing toys'):
+        for toy in tqdm(range(start, stop), desc='Doing toys'):
+            seed = self.toy_seed(signal_source_name, mu_test, toy)
+            np.random.seed(seed)
+            results['seeds'].append(seed)
+
             simulate_dict_SB, toy_data_SB, constraint_extra_args_SB = \
                 self.sample_data_constraints(mu_test, signal_source_name, likelihood)
 
@@ -390,7 +843,7 @@ class TSEvaluation():
             # Shift the constraint in the likelihood based on the background RMs we drew
             likelihood.set_constraint_extra_args(**constraint_extra_args_SB)
             # Set data
-            likelihood.set_data(toy_data_SB)
+            self.set_toy_data(likelihood, toy_data_SB, fast_toys)
             # Create test statistic
             test_statistic_SB = self.test_statistic(likelihood)
             # Guesses for fit
@@ -404,10 +857,10 @@ class TSEvaluation():
             else:
                 ts_result_SB = test_statistic_SB(mu_test, signal_source_name, guess_dict_SB)
             # Save test statistic, and possibly fits
-            ts_values_SB.append(ts_result_SB[0])
+            results['ts_values_SB'].append(ts_result_SB[0])
             if save_fits:
-                unconditional_bfs_SB.append(ts_result_SB[1])
-                conditional_bfs_SB.append(ts_result_SB[2])
+                results['unconditional_bfs_SB'].append(ts_result_SB[1])
+                results['conditional_bfs_SB'].append(ts_result_SB[2])
 
             # B-only toys
 
@@ -425,8 +878,9 @@ class TSEvaluation():
 
             # Shift the constraint in the likelihood based on the background RMs we drew
             likelihood.set_constraint_extra_args(**constraint_extra_args_B)
-            # Set data
-            likelihood.set_data(toy_data_B)
+            # Set data. Copy, so annotations are not added to the stored toys
+            self.set_toy_data(likelihood, toy_data_B.copy() if fast_toys else toy_data_B,
+                              fast_toys)
             # Create test statistic
             test_statistic_B = self.test_statistic(likelihood)
             # Evaluate test statistic
@@ -435,26 +889,80 @@ class TSEvaluation():
             else:
                 ts_result_B = test_statistic_B(mu_test, signal_source_name, guess_dict_B)
             # Save test statistic, and possibly fits
-            ts_values_B.append(ts_result_B[0])
+            results['ts_values_B'].append(ts_result_B[0])
             if save_fits:
-                unconditional_bfs_B.append(ts_result_SB[1])
-                conditional_bfs_B.append(ts_result_SB[2])
+                results['unconditional_bfs_B'].append(ts_result_B[1])
+                results['conditional_bfs_B'].append(ts_result_B[2])
 
-        # Add to the test statistic distributions
-        test_stat_dists_SB.add_ts_dist(mu_test, ts_values_SB)
-        test_stat_dists_B.add_ts_dist(mu_test, ts_values_B)
+        return results
 
-        # Possibly save the fits
-        if save_fits:
-            test_stat_dists_SB.add_unconditional_best_fit(mu_test, unconditional_bfs_SB)
-            test_stat_dists_SB.add_conditional_best_fit(mu_test, conditional_bfs_SB)
-            test_stat_dists_B.add_unconditional_best_fit(mu_test, unconditional_bfs_B)
-            test_stat_dists_B.add_conditional_best_fit(mu_test, conditional_bfs_B)
+    def run_toys_batched(self, start, stop, mu_test, signal_source_name, likelihood,
+                         save_fits=False, discovery=False):
+        """Internal function to run toys start, ..., stop - 1 for one value of mu_test,
+        fitting all toys at once with a BatchedToyFitter. Returns the same as run_toys.
+        """
+        fitter = fd.BatchedToyFitter(likelihood)
+        results = dict(seeds=[])
+
+        # Simulate the S+B toys, with the same seeds as in run_toys
+        toy_data_SB = []
+        constraint_extra_args_SB = []
+        for toy in range(start, stop):
+            seed = self.toy_seed(signal_source_name, mu_test, toy)
+            np.random.seed(seed)
+            results['seeds'].append(seed)
+            simulate_dict_SB, toy_data, constraint_extra_args = \
+                self.sample_data_constraints(mu_test, signal_source_name, likelihood)
+            toy_data_SB.append(toy_data)
+            constraint_extra_args_SB.append(constraint_extra_args)
+        guess_dict_SB = {key: max(value, 0.1) for key, value in simulate_dict_SB.items()}
+
+        try:
+            guess_dict_B = self.simulate_dict_B.copy()
+            guess_dict_B[f'{signal_source_name}_rate_multiplier'] = 0.
+            guess_dict_B = {key: max(value, 0.1) for key, value in guess_dict_B.items()}
+            toy_data_B = [self.toy_data_B[toy+(self.toy_batch*self.ntoys)]
+                          for toy in range(start, stop)]
+            constraint_extra_args_B = [self.constraint_extra_args_B[toy]
+                                       for toy in range(start, stop)]
+        except Exception:
+            raise RuntimeError("Could not find background-only datasets")
+
+        for kind, toy_data, constraint_extra_args, guess_dict in (
+                ('SB', toy_data_SB, constraint_extra_args_SB, guess_dict_SB),
+                ('B', toy_data_B, constraint_extra_args_B, guess_dict_B)):
+            ts, bf_unconditional, bf_conditional = fitter.test_statistic(
+                self.test_statistic, toy_data,
+                0. if discovery else mu_test, signal_source_name,
+                guess_dict, constraint_extra_args)
+            results[f'ts_values_{kind}'] = list(ts)
+            if save_fits:
+                # Lists of {param: value} dictionaries, as for run_toys
+                for key, fits in ((f'unconditional_bfs_{kind}', bf_unconditional),
+                                  (f'conditional_bfs_{kind}', bf_conditional)):
+                    results[key] = [{pname: values[i] for pname, values in fits.items()}
+                                    for i in range(len(toy_data))]
+
+        return results
 
     def get_observed_test_stat(self, observed_test_stats, observed_data,
                                mu_test, signal_source_name, likelihood, save_fits=False):
         """Internal function to evaluate observed test statistic.
         """
+        if self.toy_store is not None:
+            stored = self.toy_store.read_observed(signal_source_name, mu_test)
+            if stored is not None:
+                observed_test_stats.add_test_stat(mu_test, float(stored['test_stat']))
+                if save_fits:
+                    if 'unconditional_bf' not in stored:
+                        raise RuntimeError("Stored observed test statistic does not include "
+                                           "best fits, but save_fits=True")
+                    observed_test_stats.add_unconditional_best_fit(
+                        mu_test, records_to_fits(stored['unconditional_bf'])[0])
+                    observed_test_stats.add_conditional_best_fit(
+                        mu_test, records_to_fits(stored['conditional_bf'])[0])
+                return
+
         # The constraints are centered on the expected values
         constraint_extra_args = dict()
         for background_source in self.background_source_names:
@@ -485,6 +993,12 @@ class TSEvaluation():
             observed_test_stats.add_unconditional_best_fit(mu_test, ts_result[1])
             observed_test_stats.add_conditional_best_fit(mu_test, ts_result[2])
 
+        if self.toy_store is not None:
+            self.toy_store.write_observed(
+                signal_source_name, mu_test, ts_result[0],
+                fits=dict(unconditional_bf=ts_result[1],
+                          conditional_bf=ts_result[2]) if save_fits else None)
+
 
 @export
 class IntervalCalculator():
@@ -667,12 +1181,21 @@ class IntervalCalculator():
                 mus.append(mu_test)
                 p_val_curves.append(these_p_vals)
 
-            p_val_curves = np.transpose(np.stack(p_val_curves, axis=0))
-            upper_lims_bands = np.apply_along_axis(self.upper_lims_bands, 1, p_val_curves, mus, conf_level)
-
             these_bands = dict()
-            for quantile in quantiles:
-                these_bands[quantile] = np.quantile(np.sort(upper_lims_bands), stats.norm.cdf(quantile))
+            if len(set([len(p_vals) for p_vals in p_val_curves])) == 1:
+                # Same B-only toys at each mu_test: find the upper limit of each toy
+                p_val_curves = np.transpose(np.stack(p_val_curves, axis=0))
+                upper_lims_bands = np.apply_along_axis(self.upper_lims_bands, 1, p_val_curves, mus, conf_level)
+                for quantile in quantiles:
+                    these_bands[quantile] = np.quantile(np.sort(upper_lims_bands), stats.norm.cdf(quantile))
+            else:
+                # Different numbers of B-only toys at each mu_test (see conf_level in
+                # TSEvaluation). Upper limits increase with the p-values, so find the
+                # limit from the band quantiles of the p-values at each mu_test instead.
+                for quantile in quantiles:
+                    p_val_curve = np.array([np.quantile(p_vals, stats.norm.cdf(quantile))
+                                            for p_vals in p_val_curves])
+                    these_bands[quantile] = self.upper_lims_bands(p_val_curve, mus, conf_level)
             bands[signal_source] = these_bands
 
         return bands
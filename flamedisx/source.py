@@ -18,6 +18,13 @@ export, __all__ = fd.exporter()
 o = tf.newaxis
 
 
+def _simulate_chunk(source, task):
+    """Return events simulated by source for task = (n_events, seed, kwargs)"""
+    n_events, seed, kwargs = task
+    np.random.seed(seed)
+    return source.simulate(n_events, n_workers=1, **kwargs)
+
+
 @export
 class Source:
     #: Number of event batches to use in differential rate computations
@@ -49,6 +56,22 @@ class Source:
     #: Array-valued data columns: tuple of (name, length)
     array_columns: ty.Tuple[ty.Tuple[str, int]] = tuple()
 
+    #: If True, store the data tensor as a fd.CompactTensor: integer
+    #: columns as int16 or int32 (see int16_column_suffixes and
+    #: int32_column_suffixes), and low_precision_columns as bfloat16.
+    #: Columns are upcast to float_type() when computing differential rates.
+    compact_data_tensor = False
+
+    #: Suffixes of integer columns stored as int16 (step and domain sizes
+    #: of hidden variables) and int32 (their bounds) if compact_data_tensor
+    #: is True. Columns of non_integer_dimensions are not included.
+    int16_column_suffixes = ('_steps', '_dimsizes')
+    int32_column_suffixes = ('_min', '_max')
+
+    #: Smooth columns that can be stored at bfloat16 precision
+    #: if compact_data_tensor is True
+    low_precision_columns: ty.Tuple[str] = tuple()
+
     #: Any additional source attributes that should be configurable.
     model_attributes = tuple()
 
@@ -58,9 +81,31 @@ class Source:
     def extra_needed_columns(self):
         return []
 
+    def shared_columns(self):
+        """Return names of columns the source reads unchanged from the data.
+        LogLikelihood stores these once for all sources in a dataset that
+        list them, so they must not be changed by add_extra_columns or
+        annotation.
+        """
+        return []
+
+    #: Annotation cache shared with other sources, used during set_data
+    _annotation_cache = None
+
     #: The fully annotated event data
     data: pd.DataFrame = None
 
+    #: Number of events simulated per chunk in seeded or parallel simulations
+    simulation_chunk_size = int(1e5)
+
+    #: Default number of processes for simulate (-1: all CPUs)
+    simulation_n_workers = 1
+
+    #: Random number generator for simulation. This is the global numpy
+    #: random state, except during columnar simulations
+    #: (see BlockModelSource.columnar_simulation).
+    rng = np.random
+
     ##
     # Initialization and helpers
     ##
@@ -276,9 +321,16 @@ class Source:
                  input_column_index=None,
                  input_data_tensor=None,
                  output_data_tensor=None,
+                 annotation_cache=None,
                  _skip_tf_init=False,
                  _skip_bounds_computation=False,
                  **params):
+        """Set new data for the source
+
+        :param annotation_cache: Dictionary shared between sources annotating
+            the same data, used to compute annotation columns once for blocks
+            the sources have in common. See BlockModelSource.
+        """
         self.set_defaults(**params)
 
         if data is None:
@@ -313,7 +365,11 @@ class Source:
         if not data_is_annotated:
             self.add_extra_columns(self.data)
             if not _skip_bounds_computation:
-                self._annotate()
+                self._annotation_cache = annotation_cache
+                try:
+                    self._annotate()
+                finally:
+                    self._annotation_cache = None
                 self._calculate_dimsizes()
 
         if not _skip_tf_init:
@@ -349,6 +405,59 @@ class Source:
             self.data_tensor = tf.zeros(shape, dtype=fd.float_type())
             return
 
+        # Shape the (n_events, n_columns) tensor to the batch size
+        self.data_tensor = tf.reshape(self._flat_data_tensor(), shape)
+
+        if output_data_tensor is not None:
+            write_out = tf.io.serialize_tensor(self.data_tensor)
+            with tf.io.TFRecordWriter(output_data_tensor) as writer:
+                writer.write(write_out.numpy())
+
+        if self.compact_data_tensor:
+            self.data_tensor = fd.CompactTensor.from_tensor(
+                self.data_tensor,
+                int16=self.integer_mask(self.int16_column_suffixes),
+                int32=self.integer_mask(self.int32_column_suffixes),
+                low_precision=self.low_precision_mask())
+
+    def integer_mask(self, suffixes):
+        """Return boolean array, True for columns of the data tensor
+        whose names end in suffixes, except those of non_integer_dimensions
+        """
+        non_integer = getattr(self, 'non_integer_dimensions', tuple())
+        return self._column_mask([
+            column for column in self.column_index
+            if column.endswith(tuple(suffixes))
+            and column.rsplit('_', 1)[0] not in non_integer])
+
+    def low_precision_mask(self):
+        """Return boolean array, True for columns of the data tensor
+        in low_precision_columns
+        """
+        return self._column_mask(self.low_precision_columns)
+
+    def _column_mask(self, columns):
+        """Return boolean array, True for the data tensor columns
+        of the data columns in columns
+        """
+        mask = np.zeros(self.n_columns_in_data_tensor, dtype=bool)
+        for column in columns:
+            if column in self.column_index:
+                index = self.column_index[column]
+                if isinstance(index, slice):
+                    index = slice(int(index.start), int(index.stop))
+                else:
+                    index = int(index)
+                mask[index] = True
+        return mask
+
+    def _flat_data_tensor(self, fill_missing=False):
+        """Return (n_events, n_columns_in_data_tensor) tensor with the
+        columns of self.data, as in self.column_index
+
+        :param fill_missing: If True, fill columns missing from self.data
+            with zeros, e.g. bounds of hidden variables in simulated data.
+        """
         # First, build a list of (n_events, 1 or column_width) tensors
         result = []
         for column in self.column_index:
@@ -356,6 +465,9 @@ class Source:
             if column in self.frozen_model_functions:
                 # Calculate the column
                 y = self.gimme(column)
+            elif fill_missing and column not in self.data.columns:
+                y = tf.zeros((len(self.data), self.array_columns.get(column, 1)),
+                             dtype=fd.float_type())
             else:
                 # Just fetch it from the dataframe
                 y = self._fetch(column)
@@ -368,14 +480,10 @@ class Source:
 
             result.append(y)
 
-        # Concat these and shape them to the batch size
-        result = tf.concat(result, axis=1)
-        self.data_tensor = tf.reshape(result, shape)
-
-        if output_data_tensor is not None:
-            write_out = tf.io.serialize_tensor(self.data_tensor)
-            with tf.io.TFRecordWriter(output_data_tensor) as writer:
-                writer.write(write_out.numpy())
+        if not result:
+            return tf.zeros((len(self.data), 0), dtype=fd.float_type())
+        # Concat these
+        return tf.concat(result, axis=1)
 
     def _calculate_dimsizes(self):
         # Overriden in IntegratingSource
@@ -427,7 +535,7 @@ class Source:
         """
         if data_tensor is None:
             # We're inside annotate, just return the column
-            x = self.data[x].values
+            x = np.asarray(self.data[x])
             if x.dtype == object:
                 # This will only work on homogeneous array fields
                 x = np.stack(x)
@@ -465,11 +573,6 @@ class Source:
         if data_tensor is None:
             # We're in an annotate
             assert hasattr(self, 'data'), "You must set data first"
-        else:
-            # We're computing
-            if not hasattr(self, 'data_tensor'):
-                raise ValueError(
-                    "You must set_data first (and populate the tensor cache)")
 
         f = getattr(self, fname)
 
@@ -492,7 +595,13 @@ class Source:
 
         else:
             if bonus_arg is None:
-                n = len(self.data) if data_tensor is None else data_tensor.shape[0]
+                if data_tensor is not None:
+                    n = data_tensor.shape[0]
+                elif isinstance(self.data, dict):
+                    # Columnar simulation, see BlockModelSource
+                    n = len(next(iter(self.data.values())))
+                else:
+                    n = len(self.data)
                 x = tf.ones(n, dtype=fd.float_type())
             else:
                 x = tf.ones_like(bonus_arg, dtype=fd.float_type())
@@ -532,16 +641,25 @@ class Source:
 
     def trace_differential_rate(self):
         """Compile the differential rate computation to a tensorflow graph"""
-        input_signature = (
-            tf.TensorSpec(shape=self._batch_data_tensor_shape(),
-                          dtype=fd.float_type()),
-            tf.TensorSpec(shape=[len(self.parameter_index)],
-                          dtype=fd.float_type()))
+        data_tensor_spec = tf.TensorSpec(
+            shape=self._batch_data_tensor_shape(),
+            dtype=fd.float_type())
         self._differential_rate_tf = tf.function(
             self._differential_rate,
-            input_signature=input_signature)
+            input_signature=(
+                data_tensor_spec,
+                tf.TensorSpec(shape=[len(self.parameter_index)],
+                              dtype=fd.float_type())))
+        self._differential_rate_grid_tf = tf.function(
+            self._differential_rate_grid,
+            input_signature=(
+                data_tensor_spec,
+                tf.TensorSpec(shape=[None, len(self.parameter_index)],
+                              dtype=fd.float_type())))
 
     def differential_rate(self, data_tensor=None, autograph=True, **kwargs):
+        if isinstance(data_tensor, fd.CompactTensor):
+            data_tensor = data_tensor.expand()
         ptensor = self.ptensor_from_kwargs(**kwargs)
         if autograph and self.trace_difrate:
             return self._differential_rate_tf(
@@ -550,19 +668,126 @@ class Source:
             return self._differential_rate(
                 data_tensor=data_tensor, ptensor=ptensor)
 
+    def differential_rate_grid(self, data_tensor=None, autograph=True,
+                               **kwargs):
+        """Return (n_points, batch_size) tensor with the differential rates
+        of the events in data_tensor at n_points parameter points,
+        computed in a single call.
+
+        :param kwargs: Parameter values, as (n_points,) arrays or scalars.
+            Omitted parameters are at their defaults.
+        """
+        if isinstance(data_tensor, fd.CompactTensor):
+            data_tensor = data_tensor.expand()
+        ptensors = self.ptensors_from_kwargs(**kwargs)
+        if autograph and self.trace_difrate:
+            return self._differential_rate_grid_tf(
+                data_tensor=data_tensor, ptensors=ptensors)
+        else:
+            return self._differential_rate_grid(
+                data_tensor=data_tensor, ptensors=ptensors)
+
+    def _differential_rate_grid(self, data_tensor, ptensors):
+        # Vectorize the differential rate over the parameter points,
+        # rather than calling it once per point
+        return tf.vectorized_map(
+            lambda ptensor: self._differential_rate(
+                data_tensor=data_tensor, ptensor=ptensor),
+            ptensors,
+            fallback_to_while_loop=True)
+
     def ptensor_from_kwargs(self, **kwargs):
         return tf.convert_to_tensor([kwargs.get(k, self.defaults[k])
                                      for k in self.defaults])
 
+    def ptensors_from_kwargs(self, **kwargs):
+        """Return (n_points, n_params) tensor of parameter points, from
+        kwargs with (n_points,) arrays or scalars of parameter values
+        """
+        values = np.broadcast_arrays(*[
+            np.atleast_1d(np.asarray(kwargs.get(k, self.defaults[k]),
+                                     dtype=np.float64))
+            for k in self.defaults])
+        if not values:
+            return tf.zeros((1, 0), dtype=fd.float_type())
+        return fd.np_to_tf(np.stack(values, axis=1))
+
     ##
     # Simulation methods and helpers
     ##
 
     def simulate(self, n_events, fix_truth=None, full_annotate=False,
-                 keep_padding=False, **params):
+                 keep_padding=False, quasi_random=False,
+                 n_workers=None, seed=None, **params):
         """Simulate n events.
 
         Will omit events lost due to selection/detection efficiencies
+
+        :param quasi_random: If True, draw the "deep truth" variables from a
+            scrambled Sobol sequence rather than pseudo-randomly. Sources
+            whose random_truth does not support this ignore it.
+        :param n_workers: Number of processes to simulate with
+            (-1: all CPUs). Defaults to simulation_n_workers.
+        :param seed: Seed for the simulation. If given, or if using multiple
+            processes, events are simulated in chunks of
+            simulation_chunk_size, each with its own random stream derived
+            from the seed (or from the global numpy random state, if no seed
+            is given). The result then does not depend on n_workers.
+        """
+        if n_workers is None:
+            n_workers = self.simulation_n_workers
+        if n_workers != 1 or seed is not None:
+            return self._simulate_chunked(
+                n_events, n_workers=n_workers, seed=seed,
+                fix_truth=fix_truth, full_annotate=full_annotate,
+                keep_padding=keep_padding, quasi_random=quasi_random,
+                **params)
+
+        with self._simulate_all(
+                n_events, fix_truth=fix_truth, keep_padding=keep_padding,
+                quasi_random=quasi_random, **params) as d:
+            if 'p_accepted' in d.columns:
+                # Draw which events are accepted
+                d = d.iloc[np.random.rand(len(d)) < d['p_accepted'].values].copy()
+            if full_annotate:
+                # Now that we have s1 and s2 values, we can populate
+                # columns like e_vis, photon_produced_mle, etc.
+                # This is optional since it can be expensive (e.g. for
+                # the WIMPsource, where it includes the full energy spectrum!)
+                return self.annotate_data(d)
+            return d
+
+    def _simulate_chunked(self, n_events, n_workers=1, seed=None, **kwargs):
+        """Simulate n_events in chunks, see simulate"""
+        n_events = int(n_events)
+        chunk_sizes = [self.simulation_chunk_size] * (n_events // self.simulation_chunk_size)
+        if n_events % self.simulation_chunk_size:
+            chunk_sizes.append(n_events % self.simulation_chunk_size)
+        if seed is None:
+            seed = np.random.randint(2**32, size=4, dtype=np.uint64)
+        seeds = [ss.generate_state(4)
+                 for ss in np.random.SeedSequence(seed).spawn(len(chunk_sizes))]
+        tasks = [(n, chunk_seed, kwargs)
+                 for n, chunk_seed in zip(chunk_sizes, seeds)]
+
+        # Do not let seeded simulations disturb the global random state
+        random_state = np.random.get_state()
+        try:
+            chunks = fd.map_with_worker_state(
+                _simulate_chunk, self, tasks, n_workers=n_workers)
+        finally:
+            np.random.set_state(random_state)
+        if not chunks:
+            return self.simulate(0, n_workers=1, **kwargs)
+        return pd.concat(chunks, ignore_index=True)
+
+    @contextmanager
+    def _simulate_all(self, n_events, fix_truth=None, keep_padding=False,
+                      quasi_random=False, **params):
+        """Simulate n events, without removing events lost due to
+        selection/detection efficiencies (these are in the p_accepted
+        column, if the source has one). Yields the simulated DataFrame,
+        while it is temporarily set as the source's data.
         """
         assert isinstance(n_events, (int, float)), \
             f"n_events must be an int or float, not {type(n_events)}"
@@ -572,23 +797,17 @@ class Source:
         fix_truth = self.validate_fix_truth(fix_truth.copy()
                                             if fix_truth is not None
                                             else None)
+        if quasi_random:
+            # Only pass the option if needed, not all sources accept it
+            params['quasi_random'] = True
         sim_data = self.random_truth(n_events, fix_truth=fix_truth, **params)
+        params.pop('quasi_random', None)
         assert isinstance(sim_data, pd.DataFrame)
 
         with self._set_temporarily(sim_data, _skip_bounds_computation=True,
                                    keep_padding=keep_padding, **params):
             # Do the forward simulation of the detector response
-            d = self._simulate_response()
-            if 'p_accepted' in d.columns:
-                # Draw which events are accepted
-                d = d.iloc[np.random.rand(len(d)) < d['p_accepted'].values].copy()
-            if full_annotate:
-                # Now that we have s1 and s2 values, we can populate
-                # columns like e_vis, photon_produced_mle, etc.
-                # This is optional since it can be expensive (e.g. for
-                # the WIMPsource, where it includes the full energy spectrum!)
-                return self.annotate_data(d)
-            return d
+            yield self._simulate_response()
 
     def validate_fix_truth(self, fix_truth):
         """Return checked fix truth, with extra derived variables if needed"""
@@ -606,13 +825,30 @@ class Source:
             for k, v in fix_truth.items():
                 data[k] = np.ones(n_events, dtype=float) * v
 
-    def estimate_mu(self, n_trials=int(1e5), **params):
+    def estimate_mu(self, n_trials=int(1e5), expected_acceptance=False,
+                    quasi_random=False, **params):
         """Return estimate of total expected number of events
         :param n_trials: Number of events to simulate for estimate
+        :param expected_acceptance: If True, average the acceptance
+            (p_accepted) of the simulated events, rather than counting
+            events that pass a random draw. This removes the binomial noise
+            of the draw, and makes the estimate a smooth function of
+            the parameters if the random state is fixed.
+        :param quasi_random: If True, draw the "deep truth" variables from a
+            scrambled Sobol sequence, see simulate.
         """
-        d_simulated = self.simulate(n_trials, **params)
+        if not expected_acceptance:
+            n_accepted = len(self.simulate(
+                n_trials, quasi_random=quasi_random, **params))
+        else:
+            with self._simulate_all(
+                    n_trials, quasi_random=quasi_random, **params) as d:
+                if 'p_accepted' in d.columns:
+                    n_accepted = d['p_accepted'].sum()
+                else:
+                    n_accepted = len(d)
         return (self.mu_before_efficiencies(**params)
-                * len(d_simulated) / n_trials)
+                * n_accepted / n_trials)
 
     ##
     # Functions you have to override
@@ -631,6 +867,18 @@ class Source:
     # Functions you probably should override
     ##
 
+    def cache_fingerprint(self):
+        """Return the instance data that cached mu estimators depend on,
+        beyond the source classes, defaults, model functions and model
+        attributes (see MuEstimator.cache_key): arrays, numbers, strings,
+        or dicts/tuples of these. Return None if mu estimators for this
+        source must not be cached.
+
+        Sources with other instance data, such as templates or reservoirs,
+        must override this.
+        """
+        return tuple()
+
     def _annotate(self):
         """Add columns needed in inference to self.data
         """
@@ -681,6 +929,10 @@ class ColumnSource(Source):
     def mu_before_efficiencies(self, **params):
         return self.mu
 
+    def cache_fingerprint(self):
+        # mu and the column are usually set per instance
+        return None
+
     def _differential_rate(self, data_tensor, ptensor):
         return self._fetch(self.column, data_tensor)
 
@@ -781,6 +1033,10 @@ class IntegratingSource(Source):
         result_y = tf.repeat(y_domain[:, o, :], tf.shape(x_domain)[1], axis=1)
         return result_x, result_y
 
+    def shared_columns(self):
+        # The observed signals
+        return super().shared_columns() + list(self.final_dimensions)
+
     def extra_needed_columns(self):
         cols = []
         for dim in (self.inner_dimensions + self.bonus_dimensions):
@@ -36,6 +36,12 @@ class TemplateWrapper:
     #: Names of template axes = names of final dimensions
     axis_names: str
 
+    #: Bin edges of the template, one array per axis
+    bin_edges: ty.List[np.ndarray]
+
+    #: Expected events in each template bin, flattened in C order
+    events_per_bin: tf.Tensor
+
     def __init__(
             self,
             template,
@@ -76,6 +82,9 @@ class TemplateWrapper:
             self._mh_diff_rate = _mh
 
         self.mu = fd.np_to_tf(self._mh_events_per_bin.n)
+        self.bin_edges = [np.asarray(edges) for edges in _mh.bin_edges]
+        self.events_per_bin = fd.np_to_tf(
+            self._mh_events_per_bin.histogram.ravel())
 
         if interpolate:
             # Build an interpolator for the differential rate
@@ -141,6 +150,7 @@ class TemplateSource(fd.ColumnSource):
             template, bin_edges, axis_names, events_per_bin, interpolate)
 
         self.final_dimensions = self._template.axis_names
+        self.bin_edges = self._template.bin_edges
         self.mu = self._template.mu
 
         # Generate a random column name to use to store the diff rates
@@ -157,8 +167,11 @@ class TemplateSource(fd.ColumnSource):
         self.data[self.column] = self._template.differential_rates_numpy(self.data)
 
     def simulate(self, n_events, fix_truth=None, full_annotate=False,
-                 keep_padding=False, **params):
+                 keep_padding=False, seed=None, **params):
         """Simulate n events.
+
+        :param seed: Seed for the simulation. If given, the global numpy
+            random state is not changed.
         """
         if fix_truth:
             raise NotImplementedError("TemplateSource does not yet support fix_truth")
@@ -167,8 +180,27 @@ class TemplateSource(fd.ColumnSource):
 
         # TODO: all other arguments are ignored, they make no sense
         # for this source. Should we warn about this? Remove them from def?
+        # (Simulating templates is fast, so n_workers is ignored too.)
+
+        if seed is None:
+            return self._template.simulate(n_events)
+        random_state = np.random.get_state()
+        try:
+            np.random.seed(np.random.SeedSequence(seed).generate_state(4))
+            return self._template.simulate(n_events)
+        finally:
+            np.random.set_state(random_state)
+
+    def expected_events_per_bin(self, ptensor=None):
+        """Return (n_bins,) tensor of expected events in each template bin,
+        flattened in C order.
+        """
+        return self._template.events_per_bin
 
-        return self._template.simulate(n_events)
+    def cache_fingerprint(self):
+        return dict(events_per_bin=self._template.events_per_bin,
+                    bin_edges=self.bin_edges,
+                    axis_names=tuple(self.final_dimensions))
 
 
 @export
@@ -284,6 +316,12 @@ class MultiTemplateSource(fd.Source):
         self._grid_coordinates = tuple([fd.np_to_tf(np.asarray(g)) for g in _grid_coordinates])
         self._grid_weights = fd.np_to_tf(_grid_weights)
 
+        self.final_dimensions = self._templates[0].axis_names
+        self.bin_edges = self._templates[0].bin_edges
+        # (n_templates, n_bins) tensor
+        self._events_per_bin = tf.stack([
+            template.events_per_bin for template in self._templates])
+
         super().__init__(*args, **kwargs)
 
     def scan_model_functions(self):
@@ -305,6 +343,14 @@ class MultiTemplateSource(fd.Source):
     def mu_before_efficiencies(self, **params):
         return self.estimate_mu(self, **params)
 
+    def cache_fingerprint(self):
+        return dict(events_per_bin=self._events_per_bin,
+                    grid_coordinates=self._grid_coordinates,
+                    grid_weights=self._grid_weights,
+                    grid_mus=self._grid_mus,
+                    bin_edges=self.bin_edges,
+                    axis_names=tuple(self.final_dimensions))
+
     def estimate_mu(self, **params):
         """Estimate the number of events expected from the template source.
         """
@@ -313,9 +359,10 @@ class MultiTemplateSource(fd.Source):
             params.get(param, default)
             for param, default in self.defaults.items()])
 
-    def _differential_rate(self, data_tensor, ptensor):
-        # Compute template weights at this parameter point
-        # (n_templates,) tensor
+    def _template_weights(self, ptensor):
+        """Return (n_templates,) tensor of template weights at the parameter
+        point ptensor
+        """
         # (The axis order is weird here. It seems to work...)
         permutation = (
             [self._grid_weights.ndim - 1]
@@ -327,7 +374,20 @@ class MultiTemplateSource(fd.Source):
             axis=1,
         )[:, 0]
         # Ensure template weights sum to one.
-        template_weights /= tf.reduce_sum(template_weights)
+        return template_weights / tf.reduce_sum(template_weights)
+
+    def expected_events_per_bin(self, ptensor):
+        """Return (n_bins,) tensor of expected events in each template bin,
+        flattened in C order, at the parameter point ptensor
+        """
+        return tf.reduce_sum(
+            self._template_weights(ptensor)[:, None] * self._events_per_bin,
+            axis=0)
+
+    def _differential_rate(self, data_tensor, ptensor):
+        # Compute template weights at this parameter point
+        # (n_templates,) tensor
+        template_weights = self._template_weights(ptensor)
 
         # Fetch precomputed diff rates for each template.
         # (n_events, n_templates) tensor
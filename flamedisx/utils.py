@@ -1,11 +1,18 @@
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import multiprocessing
+import os
 from pathlib import Path
 import subprocess
+import typing as ty
+import warnings
 
 import inspect
 import numpy as np
 import pandas as pd
 from scipy import stats
 import tensorflow as tf
+from tqdm import tqdm
 
 lgamma = tf.math.lgamma
 o = tf.newaxis
@@ -226,6 +233,96 @@ def index_lookup_dict(names, column_widths=None):
     return result
 
 
+@export
+class CompactTensor(tf.experimental.ExtensionType):
+    """Tensor whose columns (last axis) are stored in compact dtypes:
+    integer columns as int16 or int32, low-precision columns as bfloat16,
+    and the rest as float_type().
+
+    Storage dtypes depend only on which columns are given as integer or
+    low-precision, not on their values, so tensors of different datasets
+    with the same columns have the same type spec (and do not cause
+    retracing).
+
+    Indexing the leading axes (e.g. selecting a batch) returns another
+    CompactTensor; expand() returns the float_type() tensor, and can be
+    called inside a tf.function.
+    """
+    #: Columns stored as int16, int32, bfloat16 and float_type()
+    groups: ty.Tuple[tf.Tensor, ...]
+    #: Indices of the original columns in the concatenated groups
+    order: tf.Tensor
+
+    @classmethod
+    def from_tensor(cls, x, int16=None, int32=None, low_precision=None):
+        """Return CompactTensor storing the columns of x
+
+        :param x: array or tensor (..., n_columns)
+        :param int16: boolean array (n_columns), True for columns to store
+            as int16
+        :param int32: boolean array (n_columns), True for columns to store
+            as int32
+        :param low_precision: boolean array (n_columns), True for columns
+            that can be stored at bfloat16 precision
+
+        Raises ValueError if integer columns have non-integer values,
+        or values outside the range of their dtype.
+        """
+        x = np.asarray(x)
+        n_columns = x.shape[-1]
+        masks = []
+        for mask in (int16, int32, low_precision):
+            if mask is None:
+                mask = np.zeros(n_columns, dtype=bool)
+            mask = np.asarray(mask, dtype=bool)
+            for other_mask in masks:
+                mask = mask & ~other_mask
+            masks.append(mask)
+        masks.append(~np.any(masks, axis=0))
+
+        for mask, max_abs in zip(masks[:2], (2**15, 2**31)):
+            for i in np.flatnonzero(mask):
+                column = x[..., i]
+                # (NaNs and infinities fail both tests)
+                if not (np.all(column == np.round(column))
+                        and np.all(np.abs(column) < max_abs)):
+                    raise ValueError(
+                        f"Column {i} of the data tensor has non-integer "
+                        f"values, or values too large to store as "
+                        f"int{int(np.log2(max_abs)) + 1}")
+
+        group_columns = [np.flatnonzero(mask) for mask in masks]
+        dtypes = (tf.int16, tf.int32, tf.bfloat16, float_type())
+        groups = tuple(
+            tf.cast(x[..., columns], dtype)
+            for columns, dtype in zip(group_columns, dtypes))
+        order = np.argsort(np.concatenate(group_columns))
+        return cls(groups=groups,
+                   order=tf.constant(order, dtype=int_type()))
+
+    def __getitem__(self, index):
+        return CompactTensor(groups=tuple(g[index] for g in self.groups),
+                             order=self.order)
+
+    @property
+    def shape(self):
+        return self.groups[0].shape[:-1].concatenate(self.order.shape)
+
+    def expand(self):
+        """Return the float_type() tensor with the original columns"""
+        x = tf.concat([tf.cast(g, float_type()) for g in self.groups],
+                      axis=-1)
+        return tf.gather(x, self.order, axis=-1)
+
+    def numpy(self):
+        return self.expand().numpy()
+
+    @property
+    def nbytes(self):
+        """Number of bytes used to store the columns"""
+        return sum(g.dtype.size * int(np.prod(g.shape)) for g in self.groups)
+
+
 @export
 def values_to_constants(kwargs):
     """Return dictionary with python/numpy values replaced by tf.constant"""
@@ -241,6 +338,26 @@ def wilks_crit(confidence_level):
     return stats.norm.ppf(confidence_level) ** 2
 
 
+@export
+def random_uniforms(n, n_dims, quasi_random=False):
+    """Return (n, n_dims) array of random numbers uniform in [0, 1)
+
+    :param quasi_random: If True, return points of a scrambled Sobol
+        sequence, which covers the unit cube more evenly than independent
+        draws. The scrambling is seeded from the numpy random state.
+    """
+    if not quasi_random:
+        return np.random.rand(n, n_dims)
+    sampler = stats.qmc.Sobol(
+        d=n_dims, scramble=True,
+        seed=np.random.randint(2**32, dtype=np.uint64))
+    with warnings.catch_warnings():
+        # Sobol points are best balanced for n a power of two,
+        # but are still far more uniform than random draws otherwise
+        warnings.filterwarnings('ignore', message='.*balance properties')
+        return sampler.random(n)
+
+
 @export
 def run_command(command):
     """Run command and show its output in STDOUT"""
@@ -294,3 +411,49 @@ def filter_kwargs(func, kwargs):
         # if func accepts wildcard kwargs, return all
         return kwargs
     return {k: v for k, v in kwargs.items() if k in params}
+
+
+# State of a worker process in map_with_worker_state
+_worker_state = None
+
+
+def _init_worker(state):
+    global _worker_state
+    _worker_state = state
+
+
+def _call_with_worker_state(f, item):
+    return f(_worker_state, item)
+
+
+@export
+def map_with_worker_state(f, state, items, n_workers=1, progress=False, desc=None):
+    """Return [f(state, item) for item in items], computed in parallel
+    by n_workers processes (or all CPUs, if n_workers is -1).
+
+    f must be a module-level function. state (e.g. a source) is pickled
+    and sent to each worker once, rather than once per item.
+    Workers are spawned, so scripts using this must guard their main code
+    with if __name__ == '__main__'.
+
+    :param progress: If True, show a progress bar with description desc
+    """
+    items = list(items)
+    if n_workers == -1:
+        n_workers = os.cpu_count()
+    n_workers = min(n_workers, len(items))
+    if n_workers <= 1:
+        if progress:
+            items = tqdm(items, desc=desc)
+        return [f(state, item) for item in items]
+
+    # Forking a process that has initialized tensorflow is not safe
+    with ProcessPoolExecutor(
+            max_workers=n_workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_worker,
+            initargs=(state,)) as executor:
+        results = executor.map(partial(_call_with_worker_state, f), items)
+        if progress:
+            results = tqdm(results, total=len(items), desc=desc)
+        return list(results)
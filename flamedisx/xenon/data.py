@@ -51,6 +51,17 @@ def ensure_repo(repo_name, repo_path, token=None):
                        f'@github.com/{repo_name} {repo_path}')
 
 
+@export
+def bbf_file_path(data_file_name):
+    """Return path to file in bbf/bbf/data/..., cloning bbf if needed
+
+    Do NOT call on import time --
+    that would make flamedisx unusable to non-XENON folks!
+    """
+    ensure_repo('XENON1T/bbf.git', BBF_PATH)
+    return f'{BBF_PATH}/bbf/data/{data_file_name}'
+
+
 @export
 def get_bbf_file(data_file_name):
     """Return information from file in bbf/bbf/data/...
@@ -58,8 +69,18 @@ def get_bbf_file(data_file_name):
     Do NOT call on import time --
     that would make flamedisx unusable to non-XENON folks!
     """
-    ensure_repo('XENON1T/bbf.git', BBF_PATH)
-    return fd.get_resource(f'{BBF_PATH}/bbf/data/{data_file_name}')
+    return fd.get_resource(bbf_file_path(data_file_name))
+
+
+@export
+def nt_file_path(data_file_name):
+    """Return path to file in XENONnT/Flamedisx/..., cloning it if needed
+
+    Do NOT call on import time --
+    that would make flamedisx unusable to non-XENON folks!
+    """
+    ensure_repo('XENONnT/Flamedisx.git', NTFD_PATH)
+    return f'{NTFD_PATH}/{data_file_name}'
 
 
 @export
@@ -69,8 +90,7 @@ def get_nt_file(data_file_name):
     Do NOT call on import time --
     that would make flamedisx unusable to non-XENON folks!
     """
-    ensure_repo('XENONnT/Flamedisx.git', NTFD_PATH)
-    return fd.get_resource(f'{NTFD_PATH}/{data_file_name}')
+    return fd.get_resource(nt_file_path(data_file_name))
 
 
 @export
@@ -4,13 +4,19 @@ Adapted from https://github.com/XENONnT/straxen/blob/master/straxen/itp_map.py
 commit 156c5b1f0aad543ad5707911e2ee301a091a40a4
 """
 import logging
+import glob
 import gzip
+from hashlib import sha1
+import itertools
 import json
+import os
 import re
+import shutil
 
 import numpy as np
 from scipy.spatial import cKDTree
 from scipy.interpolate import RectBivariateSpline, RegularGridInterpolator
+import tensorflow as tf
 
 import flamedisx as fd
 export, __all__ = fd.exporter()
@@ -22,15 +28,28 @@ class InterpolateAndExtrapolate:
     weighted averaging between nearby points.
     """
 
+    #: Number of points to query at once, to bound memory use
+    chunk_size = int(1e6)
+
     def __init__(self, points, values,
-                 neighbours_to_use=None, array_valued=False):
+                 neighbours_to_use=None, array_valued=False, kdtree=None,
+                 workers=-1, grid_points=None):
         """
         :param points: array (n_points, n_dims) of coordinates
         :param values: array (n_points) of values
         :param neighbours_to_use: Number of neighbouring points to use for
         averaging. Default is 2 * dimensions of points.
+        :param kdtree: cKDTree of points, if already built
+        :param workers: Number of threads for neighbour queries
+        (-1, the default, uses all CPUs)
+        :param grid_points: If given, precompute the interpolation on a
+        regular grid with this many points per dimension (integer, or one
+        per dimension) spanning the points. Queries inside the grid then use
+        fast multilinear lookups instead of neighbour searches.
         """
-        self.kdtree = cKDTree(points)
+        if kdtree is None:
+            kdtree = cKDTree(points)
+        self.kdtree = kdtree
         self.values = values
         if neighbours_to_use is None:
             neighbours_to_use = points.shape[1] * 2
@@ -38,9 +57,49 @@ class InterpolateAndExtrapolate:
         self.array_valued = array_valued
         if array_valued:
             self.n_dim = self.values.shape[-1]
+        self.workers = workers
+
+        self.grid_interpolator = None
+        if grid_points is not None:
+            points = np.asarray(points)
+            grid_points = np.broadcast_to(grid_points, points.shape[1])
+            grid = [np.linspace(low, high, n)
+                    for low, high, n in zip(points.min(axis=0),
+                                            points.max(axis=0),
+                                            grid_points)]
+            nodes = np.stack(np.meshgrid(*grid, indexing='ij'), axis=-1)
+            grid_values = self(nodes.reshape(-1, len(grid)))
+            grid_values = grid_values.reshape(
+                (*grid_points, -1) if array_valued else tuple(grid_points))
+            self.grid_interpolator = RegularGridInterpolator(
+                tuple(grid), grid_values, bounds_error=False)
 
     def __call__(self, points):
-        distances, indices = self.kdtree.query(points, self.neighbours_to_use)
+        points = np.asarray(points)
+        if self.grid_interpolator is None:
+            return self._interpolate(points)
+
+        # Look up points inside the grid, interpolate the rest
+        # (outside the grid, or NaN) from the neighbours
+        result = self.grid_interpolator(points)
+        outside = np.isnan(result)
+        if self.array_valued:
+            outside = outside.any(axis=-1)
+        if outside.any():
+            result[outside] = self._interpolate(points[outside])
+        return result
+
+    def _interpolate(self, points):
+        """Return inverse-distance weighted average of the neighbours
+        of points, querying chunk_size points at a time
+        """
+        if len(points) > self.chunk_size:
+            return np.concatenate([
+                self._interpolate(points[i:i + self.chunk_size])
+                for i in range(0, len(points), self.chunk_size)])
+
+        distances, indices = self.kdtree.query(
+            points, self.neighbours_to_use, workers=self.workers)
 
         result = np.ones(len(points)) * float('nan')
         if self.array_valued:
@@ -53,14 +112,87 @@ class InterpolateAndExtrapolate:
 
         values = self.values[indices[valid]]
         weights = 1 / np.clip(distances[valid], 1e-6, float('inf'))
+        axis = -1
         if self.array_valued:
-            weights = np.repeat(weights, self.n_dim).reshape(values.shape)
+            weights = weights[..., None]
+            axis = -2
 
-        result[valid] = np.average(values, weights=weights,
-                                   axis=-2 if self.array_valued else -1)
+        result[valid] = ((values * weights).sum(axis=axis)
+                         / weights.sum(axis=axis))
         return result
 
 
+@export
+class RegularGridInterpolatorTF:
+    """Multilinear interpolation on a regular grid in TensorFlow.
+    Outside the grid, values are linearly extrapolated from the
+    edge cells, as in scipy's RegularGridInterpolator with fill_value=None.
+
+    Results are differentiable with respect to the positions (and the
+    values, if passed as a tensor), so they can be used inside
+    _differential_rate with fitted parameters.
+    """
+
+    def __init__(self, grid, values):
+        """
+        :param grid: list of n_dims arrays of evenly spaced grid coordinates,
+        each with at least two points
+        :param values: array (len(grid[0]), ..., len(grid[-1])) of values,
+        with an extra last axis for array-valued maps
+        """
+        self.n_dims = len(grid)
+        shape = [len(g) for g in grid]
+        assert min(shape) >= 2, "Need at least two grid points per dimension"
+        for g in grid:
+            assert np.allclose(np.diff(g), g[1] - g[0]), \
+                "Grid coordinates must be evenly spaced"
+        self.array_valued = len(values.shape) == self.n_dims + 1
+
+        self.lows = fd.np_to_tf(np.array([g[0] for g in grid]))
+        self.steps = fd.np_to_tf(np.array([g[1] - g[0] for g in grid]))
+        self.max_index = fd.np_to_tf(np.array(shape) - 2)
+        # Values of all grid points, as (n_points, n_values)
+        self.values = tf.reshape(
+            tf.cast(values, fd.float_type()), (int(np.prod(shape)), -1))
+        # Offsets of the 2**n_dims corners of a grid cell, and the
+        # flat index strides of each dimension
+        self.corners = np.array(list(itertools.product([0, 1],
+                                                       repeat=self.n_dims)))
+        self.strides = tf.constant(
+            np.cumprod([1] + shape[:0:-1])[::-1], dtype=tf.int32)
+
+    def __call__(self, positions):
+        """Return (n_points) tensor of interpolated values,
+        or (n_points, n_values) for array-valued maps
+
+        :param positions: (n_points, n_dims) tensor of positions
+        """
+        positions = tf.cast(positions, fd.float_type())
+        # Position in units of grid cells; the lower corner of the
+        # (edge) cell containing each position; and the position within it.
+        t = (positions - self.lows) / self.steps
+        lower = tf.clip_by_value(tf.floor(t), 0., self.max_index)
+        frac = t - lower
+
+        # (n_points, n_corners) indices and weights of the cell corners
+        index = tf.reduce_sum(
+            (tf.cast(lower, tf.int32)[:, None, :] + self.corners[None, :, :])
+            * self.strides,
+            axis=-1)
+        weights = tf.reduce_prod(
+            tf.where(self.corners[None, :, :] == 1,
+                     frac[:, None, :],
+                     1 - frac[:, None, :]),
+            axis=-1)
+
+        result = tf.reduce_sum(
+            weights[:, :, None] * tf.gather(self.values, index),
+            axis=1)
+        if self.array_valued:
+            return result
+        return result[:, 0]
+
+
 @export
 class InterpolatingMap:
     """Correction map that computes values using inverse-weighted distance
@@ -95,14 +227,23 @@ class InterpolatingMap:
     RegularGridInterpolator in scipy by pass keyword argument like
     method='RectBivariateSpline'
 
+    For maps on a regular grid, tf_interpolator returns a TensorFlow
+    version of the RegularGridInterpolator method.
+
     The interpolators are called with
     'positions' :  [[x1, y1], [x2, y2], [x3, y3], [x4, y4], ...]
     'map_name'  :  key to switch to map interpolator other than
                    the default 'map'
+
+    To load a map from a file, use InterpolatingMap.from_resource, which
+    caches the parsed map in a memory-mappable binary format.
     """
     metadata_field_names = ['timestamp', 'description', 'coordinate_system',
                             'name', 'irregular', 'compressed', 'quantized']
 
+    #: Suffix of directories with compiled maps, see from_resource
+    compiled_suffix = '.fdmap'
+
     def __init__(self, data, method='WeightedNearestNeighbors', **kwargs):
         if isinstance(data, bytes):
             data = gzip.decompress(data).decode()
@@ -142,11 +283,18 @@ class InterpolatingMap:
             csys = np.array(csys).reshape((-1, len(grid)))
             self.dimensions = len(grid)
         else:
-            csys = np.array(csys)
+            # asarray, so memory-mapped coordinates are not copied
+            csys = np.asarray(csys)
             self.dimensions = len(csys[0])
 
         self.coordinate_system = csys
         self.interpolators = {}
+
+        if method == 'WeightedNearestNeighbors' and self.dimensions:
+            # All maps share the coordinate system, so build the tree once
+            if kwargs.get('kdtree') is None:
+                kwargs['kdtree'] = cKDTree(csys)
+            self.kdtree = kwargs['kdtree']
         self.map_names = sorted([k for k in self.data.keys()
                                  if k not in self.metadata_field_names])
 
@@ -160,7 +308,8 @@ class InterpolatingMap:
 
         for map_name in self.map_names:
             # Specify dtype float to set Nones to nan
-            map_data = np.array(self.data[map_name], dtype=np.float64)
+            # (asarray, so memory-mapped maps are not copied)
+            map_data = np.asarray(self.data[map_name], dtype=np.float64)
             if len(self.coordinate_system) == len(map_data):
                 array_valued = len(map_data.shape) == 2
             else:
@@ -186,6 +335,89 @@ class InterpolatingMap:
 
             self.interpolators[map_name] = itp_fun
 
+    @classmethod
+    def from_resource(cls, x, method='WeightedNearestNeighbors',
+                      fmt=None, **kwargs):
+        """Return InterpolatingMap for the map file x, using a compiled
+        binary cache to avoid parsing the file.
+
+        On the first load, the coordinate system and map arrays are stored as
+        .npy files, with the metadata, in a directory next to x, keyed on the
+        size and modification time of x. Compiled directories of earlier
+        versions of x are removed. Later loads memory-map the arrays,
+        so they are near-instant and worker processes share the pages.
+        KD-trees (for the default method) are rebuilt from the coordinates,
+        and kept in fd.resource_cache.
+
+        If x is a URL, or the directory next to x is not writeable,
+        the map is loaded through get_resource without compiling it.
+
+        :param x: Path to the map file
+        :param method: Interpolation method, see class docstring
+        :param fmt: Format of x, passed to get_resource
+        """
+        if '://' in x:
+            return cls(fd.get_resource(x, fmt=fmt), method=method, **kwargs)
+
+        stat = os.stat(x)
+        file_key = sha1(f'{stat.st_size}:{stat.st_mtime_ns}'.encode()
+                        ).hexdigest()[:16]
+        compiled_dir = f'{x}.{file_key}{cls.compiled_suffix}'
+        if not os.path.exists(compiled_dir):
+            itp_map = cls(fd.get_resource(x, fmt=fmt), method=method, **kwargs)
+            itp_map._save_compiled(compiled_dir)
+            if os.path.exists(compiled_dir):
+                # Remove maps compiled from earlier versions of x
+                for stale_dir in glob.glob(
+                        glob.escape(x) + '.*' + cls.compiled_suffix):
+                    if stale_dir != compiled_dir:
+                        shutil.rmtree(stale_dir, ignore_errors=True)
+            return itp_map
+
+        with open(os.path.join(compiled_dir, 'metadata.json')) as f:
+            data = json.load(f)
+        # Copy-on-write mode, so scale_coordinates still works
+        data['coordinate_system'] = np.load(
+            os.path.join(compiled_dir, 'coordinate_system.npy'),
+            mmap_mode='c')
+        for map_name in data.pop('map_names'):
+            data[map_name] = np.load(
+                os.path.join(compiled_dir, f'map_{map_name}.npy'),
+                mmap_mode='c')
+        if (method == 'WeightedNearestNeighbors'
+                and len(data['coordinate_system'])
+                and kwargs.get('kdtree') is None):
+            kdtree_key = (compiled_dir, 'kdtree')
+            kwargs['kdtree'] = fd.resource_cache.get(kdtree_key)
+            if kwargs['kdtree'] is None:
+                kwargs['kdtree'] = cKDTree(data['coordinate_system'])
+                fd.resource_cache[kdtree_key] = kwargs['kdtree']
+        return cls(data, method=method, **kwargs)
+
+    def _save_compiled(self, compiled_dir):
+        """Store the parsed map in compiled_dir, see from_resource"""
+        # Build in a temporary directory, then move it into place,
+        # so other processes never see a partially written map
+        tmp_dir = compiled_dir + f'.{os.getpid()}.tmp'
+        try:
+            os.makedirs(tmp_dir)
+            metadata = {k: v for k, v in self.data.items()
+                        if k in self.metadata_field_names
+                        and k != 'coordinate_system'}
+            metadata['map_names'] = self.map_names
+            with open(os.path.join(tmp_dir, 'metadata.json'), mode='w') as f:
+                json.dump(metadata, f)
+            np.save(os.path.join(tmp_dir, 'coordinate_system.npy'),
+                    np.asarray(self.coordinate_system, dtype=np.float64))
+            for map_name in self.map_names:
+                np.save(os.path.join(tmp_dir, f'map_{map_name}.npy'),
+                        np.asarray(self.data[map_name], dtype=np.float64))
+            os.rename(tmp_dir, compiled_dir)
+        except OSError:
+            # Directory not writeable, or another process compiled
+            # the map first
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
     def __call__(self, *args, map_name='map'):
         """Returns the value of the map at the position given by coordinates
         :param positions: array (n_dim) or (n_points, n_dim) of positions
@@ -193,6 +425,28 @@ class InterpolatingMap:
         """
         return self.interpolators[map_name](*args)
 
+    def tf_interpolator(self, map_name='map'):
+        """Return RegularGridInterpolatorTF for map_name, which evaluates
+        the map with TensorFlow, consistent with the
+        RegularGridInterpolator method.
+
+        Only maps on a regular grid (such as maps with a gridspec
+        coordinate system) are supported.
+        """
+        csys = self.coordinate_system
+        grid = [np.unique(csys[:, i]) for i in range(self.dimensions)]
+        grid_shape = [len(g) for g in grid]
+        if not self.dimensions or np.prod(grid_shape) != len(csys):
+            raise ValueError("tf_interpolator needs a map on a regular grid")
+        map_data = np.asarray(self.data[map_name], dtype=np.float64)
+        if len(csys) == len(map_data):
+            array_valued = len(map_data.shape) == 2
+        else:
+            array_valued = len(map_data.shape) == self.dimensions + 1
+        if array_valued:
+            grid_shape += [map_data.shape[-1]]
+        return RegularGridInterpolatorTF(grid, map_data.reshape(grid_shape))
+
     @staticmethod
     def _rect_bivariate_spline(csys, map_data, array_valued, **kwargs):
         dimensions = len(csys[0])
@@ -3,12 +3,14 @@
 Copy-paste from https://github.com/XENONnT/straxen/blob/master/straxen/common.py
 """
 from base64 import b32encode
+from collections import OrderedDict
 import gzip
 from hashlib import sha1
 import json
 import os
 import os.path as osp
 import pickle
+import sys
 import urllib.request
 
 import numpy as np
@@ -16,14 +18,109 @@ import pandas as pd
 
 import flamedisx as fd
 export, __all__ = fd.exporter()
+__all__.extend(['resource_cache'])
+
+
+@export
+class ResourceCache:
+    """In-memory cache of parsed resources, with least-recently-used eviction
+    once the (approximate) total size exceeds a byte budget,
+    or the number of resources exceeds max_items.
+
+    Memory-mapped arrays are not counted towards the byte budget,
+    since their pages are managed by the operating system;
+    max_items bounds the number of mappings kept open.
+    """
+
+    def __init__(self, max_bytes=int(2e9), mmap_min_bytes=int(1e8),
+                 max_items=1000):
+        """
+        :param max_bytes: Maximum total size of cached resources in bytes.
+        Resources larger than this are returned, but not cached.
+        :param mmap_min_bytes: .npy files larger than this (in bytes) are
+        memory-mapped read-only rather than read into memory.
+        :param max_items: Maximum number of cached resources.
+        """
+        self.max_bytes = max_bytes
+        self.mmap_min_bytes = mmap_min_bytes
+        self.max_items = max_items
+        # key -> (resource, size in bytes), most recently used last
+        self._items = OrderedDict()
+        self.clear()
+
+    def clear(self):
+        """Remove all resources and reset the statistics"""
+        self._items.clear()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key, default=None):
+        """Return resource stored under key, or default if not cached"""
+        if key not in self._items:
+            self.misses += 1
+            return default
+        self.hits += 1
+        self._items.move_to_end(key)
+        return self._items[key][0]
+
+    def __setitem__(self, key, value):
+        if key in self._items:
+            self.nbytes -= self._items.pop(key)[1]
+        size = resource_nbytes(value)
+        if size > self.max_bytes:
+            return
+        self._items[key] = (value, size)
+        self.nbytes += size
+        while (self.nbytes > self.max_bytes
+               or len(self._items) > self.max_items):
+            _, (_, evicted_size) = self._items.popitem(last=False)
+            self.nbytes -= evicted_size
+            self.evictions += 1
+
+    def stats(self):
+        """Return dictionary with cache size and hit/miss statistics"""
+        return dict(n_resources=len(self), max_items=self.max_items,
+                    nbytes=self.nbytes, max_bytes=self.max_bytes,
+                    hits=self.hits, misses=self.misses,
+                    evictions=self.evictions)
+
+
+@export
+def resource_nbytes(x):
+    """Return approximate memory used by resource x, in bytes.
+    Memory-mapped arrays count as zero.
+    """
+    if isinstance(x, np.memmap):
+        return 0
+    if isinstance(x, np.ndarray):
+        return x.nbytes
+    if isinstance(x, pd.DataFrame):
+        return int(x.memory_usage(deep=True).sum())
+    if isinstance(x, dict):
+        return sys.getsizeof(x) + sum(resource_nbytes(k) + resource_nbytes(v)
+                                      for k, v in x.items())
+    if isinstance(x, (list, tuple)):
+        return sys.getsizeof(x) + sum(resource_nbytes(v) for v in x)
+    return sys.getsizeof(x)
 
 
 # In-memory resource cache
-_resource_cache = dict()
+resource_cache = ResourceCache()
 
 # Formats for which the original file is text, not binary
 _text_formats = ['text', 'csv', 'json']
 
+# Marks resources missing from the in-memory cache
+_missing = object()
+
 
 @export
 def get_resource(x, fmt=None):
@@ -31,6 +128,9 @@ def get_resource(x, fmt=None):
     :param fmt: Format to parse contents into. If not specified, will use the
     file extension (minus dot) as the format
 
+    Results are cached in memory in fd.resource_cache. Large .npy files
+    are memory-mapped read-only.
+
     Do NOT mutate the result you get. Make a copy if you're not sure.
     If you mutate resources it will corrupt the cache, cause terrible bugs in
     unrelated code, tears unnumbered ye shall shed, not even the echo of
@@ -42,9 +142,11 @@ def get_resource(x, fmt=None):
             raise ValueError(f"Please specify format for {x}")
         fmt = fmt[1:]  # Removes dot
 
-    if x in _resource_cache:
-        # Retrieve from in-memory cache
-        return _resource_cache[x]
+    # Retrieve from in-memory cache
+    # (the same file may be requested in different formats)
+    result = resource_cache.get((x, fmt), _missing)
+    if result is not _missing:
+        return result
 
     if '://' in x:
         # Web resource; look first in on-disk cache
@@ -60,7 +162,7 @@ def get_resource(x, fmt=None):
                 continue
             cf = osp.join(cache_folder, cache_fn)
             if osp.exists(cf):
-                result = get_resource(cf, fmt=fmt)
+                result = _load_file(cf, fmt=fmt)
                 break
         else:
             print(f'Did not find {cache_fn} in cache, downloading {x}')
@@ -90,44 +192,55 @@ def get_resource(x, fmt=None):
 
             # Retrieve result from file-cache
             # (so we only need one format-parsing logic)
-            result = get_resource(available_cf, fmt=fmt)
+            result = _load_file(available_cf, fmt=fmt)
 
     else:
-        # File resource
-        if fmt in ['npy', 'npy_pickle', 'npz']:
-            result = np.load(x, allow_pickle=fmt == 'npy_pickle')
-            if isinstance(result, np.lib.npyio.NpzFile):
-                # Slurp the arrays in the file, so the result can be copied,
-                # then close the file so its descriptors does not leak.
-                result_slurped = {k: v[:] for k, v in result.items()}
-                result.close()
-                result = result_slurped
-        elif fmt == 'pkl':
-            with open(x, 'rb') as f:
-                result = pickle.load(f)
-        elif fmt == 'pkl.gz':
-            with gzip.open(x, 'rb') as f:
-                result = pickle.load(f)
-        elif fmt == 'json.gz':
-            with gzip.open(x, 'rb') as f:
-                result = json.load(f)
-        elif fmt == 'json':
-            with open(x, mode='r') as f:
-                result = json.load(f)
-        elif fmt == 'binary':
-            with open(x, mode='rb') as f:
-                result = f.read()
-        elif fmt == 'text':
-            with open(x, mode='r') as f:
-                result = f.read()
-        elif fmt == 'csv':
-            result = pd.read_csv(x)
-        else:
-            raise ValueError(f"Unsupported format {fmt}!")
+        result = _load_file(x, fmt=fmt)
 
     # Store in in-memory cache
-    _resource_cache[x] = result
+    resource_cache[(x, fmt)] = result
+
+    return result
 
+
+def _load_file(x, fmt):
+    """Return contents of file x, parsed according to fmt"""
+    if fmt in ['npy', 'npy_pickle', 'npz']:
+        mmap_mode = None
+        if (fmt == 'npy'
+                and osp.getsize(x) > resource_cache.mmap_min_bytes):
+            mmap_mode = 'r'
+        result = np.load(x, allow_pickle=fmt == 'npy_pickle',
+                         mmap_mode=mmap_mode)
+        if isinstance(result, np.lib.npyio.NpzFile):
+            # Slurp the arrays in the file, so the result can be copied,
+            # then close the file so its descriptors does not leak.
+            # (numpy cannot memory-map arrays inside npz archives)
+            result_slurped = {k: v[:] for k, v in result.items()}
+            result.close()
+            result = result_slurped
+    elif fmt == 'pkl':
+        with open(x, 'rb') as f:
+            result = pickle.load(f)
+    elif fmt == 'pkl.gz':
+        with gzip.open(x, 'rb') as f:
+            result = pickle.load(f)
+    elif fmt == 'json.gz':
+        with gzip.open(x, 'rb') as f:
+            result = json.load(f)
+    elif fmt == 'json':
+        with open(x, mode='r') as f:
+            result = json.load(f)
+    elif fmt == 'binary':
+        with open(x, mode='rb') as f:
+            result = f.read()
+    elif fmt == 'text':
+        with open(x, mode='r') as f:
+            result = f.read()
+    elif fmt == 'csv':
+        result = pd.read_csv(x)
+    else:
+        raise ValueError(f"Unsupported format {fmt}!")
     return result
 
 
@@ -1,6 +1,7 @@
 """XENON1T SR1 implementation"""
+import os
+
 import numpy as np
-from scipy import stats
 import tensorflow as tf
 import tensorflow_probability as tfp
 from multihist import Histdd
@@ -117,38 +118,66 @@ def calculate_reconstruction_efficiency(sig, fmap, domain_def, pivot_pt):
 # Utility for the spatial template construction
 ##
 def construct_exponential_r_spatial_hist(n = 2e6, max_r = 42.8387,
-                                         exp_const=1.36 ):
+                                         exp_const=1.36, cache_dir=None):
   """ Utility function to construct a spatial template for sources
   :param n: number of samples in the template
   :param max_r: maximum radius for the exponential r template
   :param exp_const: exponential constant for the exponential function in r
+  :param cache_dir: directory in which to cache the template. If a template
+           with the same arguments was cached there, it is loaded instead.
   :return: multihist.Histdd 3D normalised histogram in the format needed
            for the spatial_hist method of fd.SpatialRateERSource
   """
   assert max_r < 50, "max_r should be < 50cm."
+  n = int(n)
+  axis_names = ['r', 'theta', 'z']
+  if cache_dir is not None:
+    cache_path = os.path.join(
+      cache_dir, f'exponential_r_spatial_hist_{n}_{max_r}_{exp_const}.npz')
+    if os.path.exists(cache_path):
+      with np.load(cache_path) as f:
+        return Histdd.from_histogram(
+          f['histogram'], bin_edges=[f[k] for k in axis_names],
+          axis_names=axis_names)
+
   theta_arr= np.random.uniform(0, 2 * np.pi, size = n)
-  r = np.zeros(n)
-  z = np.zeros(n)
   theta_edges = np.linspace(0,2 * np.pi, 361)
   z_edges = np.linspace(-100, 0, 101)
   r_edges = np.sqrt(np.linspace(0, 50**2,51))
-  # For SR1 FV
-  for i in range(len(r)):
-    rr = max_r - stats.expon.rvs(loc = 0, scale = exp_const, size = 1)
-    zr = np.random.uniform(-94., -8.)
-    while  ((-94 > zr) | (zr > -8) | (rr > max_r) | \
-                (zr > -2.63725 - 0.00946597 * rr * rr) | \
-                (zr < -158.173 + 0.0456094 * rr * rr)):
-      rr = max_r - stats.expon.rvs(loc = 0, scale = exp_const, size = 1)
-      zr = np.random.uniform(-94., -8.)
-    r[i] = rr
-    z[i] = zr
+  # Rejection sampling in batches, oversampled by the acceptance
+  # observed so far (starting from a guess), until we have n samples
+  # inside the SR1 FV
+  r = np.zeros(0)
+  z = np.zeros(0)
+  acceptance = 0.5
+  while len(r) < n:
+    n_draw = int(1.1 * (n - len(r)) / acceptance) + 1000
+    rr = max_r - np.random.exponential(scale = exp_const, size = n_draw)
+    zr = np.random.uniform(-94., -8., size = n_draw)
+    accepted = ~((-94 > zr) | (zr > -8) | (rr > max_r) |
+                 (zr > -2.63725 - 0.00946597 * rr * rr) |
+                 (zr < -158.173 + 0.0456094 * rr * rr))
+    acceptance = max(accepted.mean(), 1e-3)
+    r = np.concatenate([r, rr[accepted]])
+    z = np.concatenate([z, zr[accepted]])
+  r, z = r[:n], z[:n]
+
   hist, edges = np.histogramdd([r,theta_arr,z],bins=(r_edges, theta_edges,
                                                  z_edges))
   exp_spatial_rate = Histdd.from_histogram(hist, bin_edges = edges,
-                                          axis_names = ['r','theta','z'])
-  return exp_spatial_rate / np.mean(exp_spatial_rate.histogram / \
-                                    exp_spatial_rate.bin_volumes())
+                                          axis_names = axis_names)
+  exp_spatial_rate = exp_spatial_rate / np.mean(
+    exp_spatial_rate.histogram / exp_spatial_rate.bin_volumes())
+
+  if cache_dir is not None:
+    os.makedirs(cache_dir, exist_ok=True)
+    # Write to a temporary file first, so other processes
+    # never see a partially written cache file
+    tmp_path = cache_path + f'.{os.getpid()}.tmp.npz'
+    np.savez(tmp_path, histogram=exp_spatial_rate.histogram,
+             **dict(zip(axis_names, exp_spatial_rate.bin_edges)))
+    os.replace(tmp_path, cache_path)
+  return exp_spatial_rate
 
 
 ##
@@ -243,8 +272,10 @@ class SR1Source:
         super().set_defaults(*args, **kwargs)
 
         # Yield maps
-        self.s1_map = fd.InterpolatingMap(fd.get_nt_file(self.path_s1_rly))
-        self.s2_map = fd.InterpolatingMap(fd.get_nt_file(self.path_s2_rly))
+        self.s1_map = fd.InterpolatingMap.from_resource(
+            fd.nt_file_path(self.path_s1_rly))
+        self.s2_map = fd.InterpolatingMap.from_resource(
+            fd.nt_file_path(self.path_s2_rly))
 
         # SE gain map
         se_gain_map=fd.get_nt_file(self.path_se_gain_map)
@@ -291,10 +322,12 @@ class SR1Source:
             read_maps_tf(self.path_electron_lifetimes, is_bbf=False)
 
         # Field maps
-        self.field_map = fd.InterpolatingMap(fd.get_nt_file(self.path_drift_field))
+        self.field_map = fd.InterpolatingMap.from_resource(
+            fd.nt_file_path(self.path_drift_field))
 
         # Drift velocity map
-        self.drift_velocity_map = fd.InterpolatingMap(fd.get_nt_file(self.path_drift_velocity))
+        self.drift_velocity_map = fd.InterpolatingMap.from_resource(
+            fd.nt_file_path(self.path_drift_velocity))
 
         # Field distortion maps
         # cheap hack
@@ -304,7 +337,8 @@ class SR1Source:
         del aa
 
         # FDC maps
-        self.fdc_map = fd.InterpolatingMap(fd.get_nt_file(self.path_drift_field_distortion_correction))
+        self.fdc_map = fd.InterpolatingMap.from_resource(
+            fd.nt_file_path(self.path_drift_field_distortion_correction))
 
     # Forward simulation
     # S1
@@ -0,0 +1,105 @@
+import flamedisx as fd
+import numpy as np
+import pandas as pd
+import pytest
+from multihist import Histdd
+
+
+bin_edges = [np.array([0, 1, 2, 3, 4]), np.array([0, 1, 2, 3])]
+
+
+def make_likelihoods():
+    mh_a = Histdd.from_histogram(
+        histogram=np.array([[1, 2, 3], [4, 5, 6], [7, 8, 9], [10, 11, 12]]),
+        bin_edges=bin_edges, axis_names=('x', 'y'))
+    mh_b = Histdd.from_histogram(
+        histogram=np.ones((4, 3)),
+        bin_edges=bin_edges, axis_names=('x', 'y'))
+    kwargs = dict(
+        sources=dict(a=fd.TemplateSource, b=fd.TemplateSource),
+        arguments=dict(a=dict(template=mh_a, events_per_bin=True),
+                       b=dict(template=mh_b, events_per_bin=True)),
+        free_rates=('a', 'b'),
+        batch_size=10)
+    return fd.LogLikelihood(**kwargs), fd.BinnedLogLikelihood(**kwargs)
+
+
+def test_binned_likelihood():
+    lf, lf_binned = make_likelihoods()
+    np.random.seed(0)
+    data = lf.simulate(a_rate_multiplier=2., b_rate_multiplier=3.)
+    lf.set_data(data)
+    lf_binned.set_data(data)
+    assert lf_binned.counts[fd.likelihood.DEFAULT_DSETNAME].sum() == len(data)
+    assert lf_binned.guess() == lf.guess()
+
+    # Without interpolation, the differential rate is constant in each bin,
+    # so the likelihoods differ only by a constant (the bin volumes)
+    params = [dict(a_rate_multiplier=1.2, b_rate_multiplier=0.8),
+              dict(a_rate_multiplier=2.5, b_rate_multiplier=3.)]
+    ll_diffs = [lf(**p) - lf_binned(**p) for p in params]
+    np.testing.assert_allclose(ll_diffs[0], ll_diffs[1], atol=1e-3)
+    for p in params:
+        np.testing.assert_allclose(
+            lf.log_likelihood(**p)[1],
+            lf_binned.log_likelihood(**p)[1],
+            rtol=1e-4)
+        np.testing.assert_allclose(
+            lf.mu(dataset_name=fd.likelihood.DEFAULT_DSETNAME, **p),
+            lf_binned.mu(dataset_name=fd.likelihood.DEFAULT_DSETNAME, **p),
+            rtol=1e-5)
+
+    # Counts can also be set directly
+    counts = lf_binned.simulate_binned(a_rate_multiplier=2.)
+    assert counts.shape == (12,)
+    lf_binned.set_data(counts)
+    lf_binned.set_data(pd.DataFrame(dict(x=[0.5, 5.], y=[0.5, 0.5])))
+    assert lf_binned.counts[fd.likelihood.DEFAULT_DSETNAME].sum() == 1
+
+
+def test_binned_likelihood_bad_binning():
+    def template(edges):
+        return Histdd.from_histogram(np.ones((4, 3)), bin_edges=edges,
+                                     axis_names=('x', 'y'))
+
+    with pytest.raises(ValueError):
+        fd.BinnedLogLikelihood(
+            sources=dict(a=fd.TemplateSource, b=fd.TemplateSource),
+            arguments=dict(a=dict(template=template(bin_edges)),
+                           b=dict(template=template([bin_edges[0],
+                                                     bin_edges[1] / 2]))),
+            data=pd.DataFrame(dict(x=[1.], y=[1.])))
+
+
+def test_batched_fits_multi_template():
+    mhs = [Histdd.from_histogram(histogram=offset + np.ones((4, 3)),
+                                 bin_edges=bin_edges, axis_names=('x', 'y'))
+           for offset in (1., 0., 2., 3.)]
+    params = [dict(p=0., q=0.), dict(p=0., q=1.),
+              dict(p=1., q=0.), dict(p=1., q=1.)]
+    lf_binned = fd.BinnedLogLikelihood(
+        sources=dict(a=fd.TemplateSource, b=fd.MultiTemplateSource),
+        arguments=dict(
+            a=dict(template=Histdd.from_histogram(
+                       histogram=np.arange(1., 13.).reshape(4, 3),
+                       bin_edges=bin_edges, axis_names=('x', 'y')),
+                   events_per_bin=True),
+            b=dict(params_and_templates=list(zip(params, mhs)),
+                   events_per_bin=True)),
+        free_rates=('a', 'b'))
+
+    # Shape parameters are evaluated at the sources' defaults
+    fitter = fd.BatchedToyFitter(lf_binned)
+    np.testing.assert_allclose(fitter.mus.numpy(), [78., 24.])
+
+    np.random.seed(0)
+    counts = lf_binned.simulate_binned(a_rate_multiplier=2.,
+                                       b_rate_multiplier=3.)
+    best_fits, _ = fitter.bestfit([counts])
+    lf_binned.set_data(counts)
+    bf = lf_binned.bestfit()
+    best_fit = {pname: value[0] for pname, value in best_fits.items()}
+    # (the likelihood is quite flat, scipy converges less tightly)
+    assert lf_binned(**best_fit) >= lf_binned(**bf) - 1e-3
+    for pname, value in bf.items():
+        np.testing.assert_allclose(best_fit[pname], value, rtol=0.1)
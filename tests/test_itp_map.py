@@ -0,0 +1,117 @@
+import json
+import os
+
+import numpy as np
+import pytest
+import tensorflow as tf
+
+import flamedisx as fd
+
+
+def grid_map(n_points=(11, 7, 5)):
+    csys = [[name, [-1., 2., n]] for name, n in zip('xyz', n_points)]
+    return fd.InterpolatingMap(
+        dict(coordinate_system=csys,
+             map=np.random.rand(*n_points).tolist(),
+             vector_map=np.random.rand(*n_points, 2).tolist()),
+        method='RegularGridInterpolator')
+
+
+def test_tf_interpolator():
+    itp_map = grid_map()
+    # Include positions outside the grid, which are extrapolated
+    positions = np.random.uniform(-1.5, 2.5, size=(1000, 3))
+    for map_name in ('map', 'vector_map'):
+        np.testing.assert_allclose(
+            itp_map.tf_interpolator(map_name)(positions).numpy(),
+            itp_map(positions, map_name=map_name),
+            atol=1e-4)
+
+    # Gradients with respect to positions are available
+    positions = tf.constant(positions[:10], dtype=fd.float_type())
+    with tf.GradientTape() as t:
+        t.watch(positions)
+        values = itp_map.tf_interpolator()(positions)
+    assert np.all(np.isfinite(t.gradient(values, positions).numpy()))
+
+    # Maps not on a grid are not supported
+    irregular = fd.InterpolatingMap(dict(
+        coordinate_system=np.random.rand(20, 2).tolist(),
+        map=np.random.rand(20).tolist()))
+    with pytest.raises(ValueError):
+        irregular.tf_interpolator()
+
+
+def test_interpolate_and_extrapolate():
+    rng = np.random.default_rng(42)
+    points = rng.random((1000, 2))
+    values = np.sin(3 * points).sum(axis=1)
+    positions = rng.uniform(-0.2, 1.2, size=(5000, 2))
+    itp = fd.InterpolateAndExtrapolate(points, values)
+    expected = itp(positions)
+
+    # Chunked queries give the same result
+    itp.chunk_size = 999
+    np.testing.assert_array_equal(itp(positions), expected)
+
+    # A precomputed grid approximates the interpolation inside the grid,
+    # and positions outside it are interpolated as before
+    itp_grid = fd.InterpolateAndExtrapolate(points, values, grid_points=100)
+    inside = ((positions >= points.min(axis=0))
+              & (positions <= points.max(axis=0))).all(axis=1)
+    result = itp_grid(positions)
+    np.testing.assert_array_equal(result[~inside], expected[~inside])
+
+    # Inside the grid, the result is a weighted average of the values at
+    # the corners of the grid cell, so it differs from the interpolation
+    # by at most as much as these do.
+    grid = itp_grid.grid_interpolator.grid
+    cell = np.stack([
+        np.clip(np.searchsorted(g, positions[inside, i]) - 1, 0, len(g) - 2)
+        for i, g in enumerate(grid)], axis=1)
+    corner_errors = np.stack([
+        np.abs(itp(np.stack([grid[0][cell[:, 0] + i],
+                             grid[1][cell[:, 1] + j]], axis=1))
+               - expected[inside])
+        for i in (0, 1) for j in (0, 1)])
+    assert np.all(np.abs(result[inside] - expected[inside])
+                  <= corner_errors.max(axis=0) + 1e-6)
+    # ... which is small, given the grid spacing
+    spacing = max([g[1] - g[0] for g in grid])
+    assert np.median(corner_errors.max(axis=0)) < 10 * spacing
+
+
+def test_compiled_map(tmpdir):
+    points = np.random.rand(50, 2)
+    map_fn = os.path.join(tmpdir, 'map.json')
+    with open(map_fn, mode='w') as f:
+        json.dump(dict(coordinate_system=points.tolist(),
+                       map=np.random.rand(50).tolist(),
+                       vector_map=np.random.rand(50, 3).tolist(),
+                       name='test map'), f)
+    positions = np.random.rand(100, 2)
+    expected = fd.InterpolatingMap(fd.get_resource(map_fn))
+
+    # The first load compiles the map; later loads use the compiled map
+    for _ in range(2):
+        itp_map = fd.InterpolatingMap.from_resource(map_fn)
+        for map_name in ('map', 'vector_map'):
+            np.testing.assert_array_equal(
+                itp_map(positions, map_name=map_name),
+                expected(positions, map_name=map_name))
+    compiled = [fn for fn in os.listdir(tmpdir) if fn != 'map.json']
+    assert len(compiled) == 1 and compiled[0].endswith('.fdmap')
+    assert isinstance(itp_map.data['map'], np.memmap)
+    assert itp_map.data['name'] == 'test map'
+
+    # A map that was compiled already (e.g. by another process)
+    # is not overwritten, and leaves no temporary files
+    compiled_dir = os.path.join(tmpdir, compiled[0])
+    itp_map._save_compiled(compiled_dir)
+    assert sorted(os.listdir(tmpdir)) == sorted(['map.json', compiled[0]])
+
+    # Changing the file compiles it again, and removes the old compiled map
+    os.utime(map_fn, ns=(0, 0))
+    fd.InterpolatingMap.from_resource(map_fn)
+    recompiled = [f for f in os.listdir(tmpdir) if f != 'map.json']
+    assert len(recompiled) == 1 and recompiled != compiled
@@ -103,6 +103,169 @@ def test_multisource_er_nr(xes: fd.ERSource):
     lf()
 
 
+def test_shared_columns(xes: fd.ERSource):
+    class myColumnSource(fd.ColumnSource):
+        column = "diffrate"
+        mu = 3.14
+
+    xes.data['diffrate'] = 5.
+    # Within the time range of the WIMP source
+    xes.data['event_time'] = pd.to_datetime('2019-10-01').value
+
+    lf = fd.LogLikelihood(
+        sources=dict(er=xes.__class__, wimp=fd.WIMPSource,
+                     muur=myColumnSource),
+        data=xes.data)
+
+    # Columns shared between sources are stored only once
+    data_tensor = lf.data_tensors[DEFAULT_DSETNAME]
+    source_tensors = [s.data_tensor for s in lf.sources.values()]
+    assert data_tensor.shape[2] < sum(t.shape[2] for t in source_tensors)
+
+    # Each source still sees its own data tensor
+    for source_i, source_tensor in enumerate(source_tensors):
+        np.testing.assert_array_equal(
+            lf._source_data_tensor(data_tensor[0], DEFAULT_DSETNAME,
+                                   source_i).numpy(),
+            source_tensor[0].numpy())
+    assert np.isfinite(lf())
+
+
+def test_column_layout():
+    # Two sources that compute their column differently, with the same
+    # values on some datasets: they never share the column
+    class SourceA(fd.ColumnSource):
+        column = 'x'
+        mu = 1.
+
+    class SourceB(fd.ColumnSource):
+        column = 'x'
+        mu = 2.
+
+        def add_extra_columns(self, d):
+            super().add_extra_columns(d)
+            d['x'] = np.where(d['s1'] > 0, d['x'], d['y'])
+
+    x, y = np.arange(1., 7.), np.arange(11., 17.)
+    data_1 = pd.DataFrame(dict(s1=np.ones(6), x=x, y=y))
+    data_2 = pd.DataFrame(dict(s1=-np.ones(6), x=x, y=y))
+
+    lf = fd.LogLikelihood(sources=dict(a=SourceA, b=SourceB), data=data_1)
+    layout = [x.tolist() for x in lf.source_column_indices[DEFAULT_DSETNAME]]
+    np.testing.assert_allclose(lf(), -3 + np.sum(np.log(2 * x)), rtol=1e-5)
+
+    # Same tensor shape as before, so the traced likelihood is reused
+    lf.set_data(data_2)
+    assert [x.tolist() for x in
+            lf.source_column_indices[DEFAULT_DSETNAME]] == layout
+    np.testing.assert_allclose(lf(), -3 + np.sum(np.log(x + y)), rtol=1e-5)
+    fresh = fd.LogLikelihood(sources=dict(a=SourceA, b=SourceB), data=data_2)
+    np.testing.assert_allclose(lf(), fresh(), rtol=1e-5)
+
+    with pytest.raises(AttributeError):
+        lf.column_indices
+
+
+def test_shared_annotations(xes: fd.ERSource, monkeypatch):
+    annotated = []
+    annotate = fd.Block.annotate
+
+    def counting_annotate(self, d):
+        annotated.append(type(self))
+        return annotate(self, d)
+    monkeypatch.setattr(fd.Block, 'annotate', counting_annotate)
+
+    sources = dict(er=fd.ERSource, er2=fd.ERSource, nr=fd.NRSource)
+    # Mu estimation draws from the global random state,
+    # leave it as it was for the other tests
+    random_state = np.random.get_state()
+    lf = fd.LogLikelihood(sources=sources, data=xes.data)
+    np.random.set_state(random_state)
+
+    # The second ER source reuses all annotations, the NR source those
+    # of the detector response blocks it has in common with ER
+    n_blocks = len(lf.sources['er'].model_blocks)
+    assert len(annotated) == n_blocks + 3
+
+    # Annotations are the same as without sharing
+    monkeypatch.setattr(fd.Block, 'annotate', annotate)
+    for sname, source_class in sources.items():
+        reference = source_class(xes.data.copy(), _skip_tf_init=True).data
+        pd.testing.assert_frame_equal(
+            lf.sources[sname].data[reference.columns][:len(reference)],
+            reference)
+
+
+def test_compact_data_tensor(xes: fd.ERSource):
+    lf = fd.LogLikelihood(
+        sources=dict(er=xes.__class__),
+        data=xes.data)
+
+    class CompactSource(xes.__class__):
+        compact_data_tensor = True
+
+    lf_compact = fd.LogLikelihood(
+        sources=dict(er=CompactSource),
+        data=xes.data)
+
+    data_tensor = lf.data_tensors[DEFAULT_DSETNAME]
+    compact_tensor = lf_compact.data_tensors[DEFAULT_DSETNAME]
+    assert isinstance(compact_tensor, fd.CompactTensor)
+    assert compact_tensor.nbytes < data_tensor.numpy().nbytes
+    # Integer-valued columns are stored losslessly
+    np.testing.assert_array_equal(compact_tensor.numpy(),
+                                  data_tensor.numpy())
+    # Storage dtypes do not depend on the values in the dataset
+    source = lf_compact.sources['er']
+    other_tensor = fd.CompactTensor.from_tensor(
+        data_tensor.numpy() * 0,
+        int16=source.integer_mask(source.int16_column_suffixes),
+        int32=source.integer_mask(source.int32_column_suffixes))
+    assert ([g.shape[-1] for g in other_tensor.groups]
+            == [g.shape[-1] for g in compact_tensor.groups])
+    with pytest.raises(ValueError):
+        fd.CompactTensor.from_tensor(np.array([[0.5]]), int32=[True])
+    # mu is estimated separately for each likelihood, compare the rest
+    np.testing.assert_allclose(
+        lf_compact() + lf_compact.mu(dataset_name=DEFAULT_DSETNAME),
+        lf() + lf.mu(dataset_name=DEFAULT_DSETNAME),
+        rtol=1e-5)
+
+
+def test_log_likelihood_grid(xes: fd.ERSource):
+    lf = fd.LogLikelihood(
+        sources=dict(er=xes.__class__),
+        elife=(100e3, 500e3, 5),
+        free_rates='er',
+        data=xes.data)
+
+    points = dict(elife=np.linspace(200e3, 400e3, 3),
+                  er_rate_multiplier=np.array([0.5, 1., 2.]))
+    expected = [lf(elife=elife, er_rate_multiplier=rm)
+                for elife, rm in zip(*points.values())]
+    np.testing.assert_allclose(lf.log_likelihood_grid(points),
+                               expected, rtol=1e-5)
+    # Evaluating fewer points per call gives the same result
+    np.testing.assert_allclose(
+        lf.log_likelihood_grid(pd.DataFrame(points), points_per_call=2),
+        expected, rtol=1e-5)
+
+    # Differential rates at many points, for a batch of events
+    source = lf.sources['er']
+    data_tensor = source.data_tensor[0]
+    drs = source.differential_rate_grid(data_tensor,
+                                        elife=points['elife']).numpy()
+    assert drs.shape == (3, source.batch_size)
+    np.testing.assert_allclose(
+        drs[1],
+        source.differential_rate(data_tensor,
+                                 elife=points['elife'][1]).numpy(),
+        rtol=1e-5)
+
+    with pytest.raises(ValueError):
+        lf.log_likelihood_grid(dict(bla=[1., 2.]))
+
+
 def test_columnsource(xes: fd.ERSource):
     class myColumnSource(fd.ColumnSource):
         column = "diffrate"
@@ -343,3 +506,79 @@ def test_hessian_rate_and_shape(xes: fd.ERSource):
     a = inv_hess[0, 1]
     b = inv_hess[1, 0]
     assert abs(a - b)/(a+b) < 1e-3
+
+
+def test_scan(xes: fd.ERSource):
+    lf = fd.LogLikelihood(
+        sources=dict(er=xes.__class__),
+        elife=(100e3, 500e3, 5),
+        free_rates='er',
+        data=xes.data)
+
+    # Scan with the other parameter fixed
+    elifes = np.linspace(200e3, 400e3, 3)
+    result = lf.scan(dict(elife=elifes, er_rate_multiplier=[0.5, 2.]))
+    assert len(result) == 6
+    assert list(result.columns) == lf.param_names + ['ll']
+    row = result.iloc[1]
+    np.testing.assert_allclose(
+        row['ll'],
+        lf(elife=row['elife'], er_rate_multiplier=row['er_rate_multiplier']),
+        rtol=1e-5)
+
+    # Profile scan, fitting the rate multiplier at each point
+    result = lf.scan(dict(elife=elifes), profile=True, n_workers=2,
+                     use_hessian=False)
+    np.testing.assert_array_equal(result['elife'], elifes)
+    fit = lf.bestfit(fix=dict(elife=elifes[2]), use_hessian=False)
+    np.testing.assert_allclose(result['er_rate_multiplier'].values[2],
+                               fit['er_rate_multiplier'], rtol=1e-2)
+    np.testing.assert_allclose(result['ll'].values[2], lf(**fit), rtol=1e-4)
+
+
+def test_save_load(xes: fd.ERSource, tmp_path):
+    lf = fd.LogLikelihood(
+        sources=dict(er=xes.__class__),
+        elife=(100e3, 500e3, 5),
+        free_rates='er',
+        data=xes.data)
+    lf.save(tmp_path)
+
+    lf2 = fd.LogLikelihood.load(tmp_path)
+    assert isinstance(lf2, fd.SavedLogLikelihood)
+    assert lf2.param_names == lf.param_names
+
+    params = dict(elife=300e3, er_rate_multiplier=2.)
+    for omit_grads in (tuple(), ('elife',)):
+        result = lf.log_likelihood(second_order=True,
+                                   omit_grads=omit_grads, **params)
+        result2 = lf2.log_likelihood(second_order=True,
+                                     omit_grads=omit_grads, **params)
+        for x, x2 in zip(result, result2):
+            np.testing.assert_allclose(x2, x, rtol=1e-5)
+    np.testing.assert_allclose(
+        lf2.mu(dataset_name=DEFAULT_DSETNAME, **params),
+        lf.mu(dataset_name=DEFAULT_DSETNAME, **params))
+
+    fix = dict(elife=300e3)
+    bestfit = lf.bestfit(fix=fix)
+    bestfit2 = lf2.bestfit(fix=fix)
+    np.testing.assert_allclose(bestfit2['er_rate_multiplier'],
+                               bestfit['er_rate_multiplier'],
+                               rtol=1e-4)
+    np.testing.assert_allclose(
+        lf2.limit('er_rate_multiplier', bestfit=bestfit2, fix=fix),
+        lf.limit('er_rate_multiplier', bestfit=bestfit, fix=fix),
+        rtol=1e-3)
+
+    # Methods that need the sources or the constraint raise clear errors
+    for method, args in ((lf2.set_data, (xes.data,)),
+                         (lf2.annotate_data, (xes.data,)),
+                         (lf2.simulate, tuple()),
+                         (lf2.set_log_constraint, (None,)),
+                         (lf2.set_constraint_extra_args, tuple())):
+        with pytest.raises(NotImplementedError):
+            method(*args)
+    with pytest.raises(NotImplementedError):
+        lf2.mu(source_name='er')
+    assert lf2.constraint_extra_args is None
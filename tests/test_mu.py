@@ -1,5 +1,9 @@
+import pickle
+
 import numpy as np
 import pandas as pd
+from multihist import Histdd
+import pytest
 import tensorflow as tf
 from scipy.interpolate import interpn
 
@@ -122,3 +126,163 @@ def test_grid_interpolation():
     mu_est_corner = -ll(x=-1, y=-1)
 
     assert np.isclose(mu_est_corner, mu_func(-1, -1))
+
+
+def test_parallel_mu_estimation():
+    # Seeded estimates do not depend on the number of worker processes,
+    # nor disturb the global random state
+    source = fd.ERSource()
+    mus = []
+    for n_workers in (1, 2):
+        np.random.seed(0)
+        est = fd.GridInterpolatedMu(
+            source, n_trials=1000, progress=False,
+            n_workers=n_workers, seed=42,
+            g2=(15., 25., 2), elife=(4e5, 5e5, 2))
+        assert np.random.randint(1000) == np.random.RandomState(0).randint(1000)
+        mus.append(est.mu_grid.numpy())
+    np.testing.assert_array_equal(mus[0], mus[1])
+    assert len(np.unique(mus[0])) > 1
+
+
+def test_mu_cache(tmpdir):
+    class CountingSource(MuTestSource):
+        n_estimates = 0
+
+        def estimate_mu(self, n_trials=None, **params):
+            CountingSource.n_estimates += 1
+            return super().estimate_mu(n_trials=n_trials, **params)
+
+    opts = {**ll_options, 'sources': dict(bla=CountingSource)}
+    for mu_est in (fd.CrossInterpolatedMu, fd.GridInterpolatedMu, double_cross):
+        CountingSource.n_estimates = 0
+        ll = fd.LogLikelihood(**opts, mu_estimators=mu_est, mu_cache_dir=str(tmpdir))
+        n_estimates = CountingSource.n_estimates
+        assert n_estimates > 0
+
+        # Rebuilding the likelihood loads the estimators from the cache
+        ll_cached = fd.LogLikelihood(**opts, mu_estimators=mu_est, mu_cache_dir=str(tmpdir))
+        assert CountingSource.n_estimates == n_estimates
+        assert np.isclose(ll_cached(x=0.5, y=0.3), ll(x=0.5, y=0.3))
+
+        # Changing the parameter specification rebuilds them
+        fd.LogLikelihood(**{**opts, 'x': (-2, 1)}, mu_estimators=mu_est,
+                         mu_cache_dir=str(tmpdir))
+        assert CountingSource.n_estimates > n_estimates
+
+
+def test_mu_cache_instance_data(tmpdir):
+    # Template sources with different templates get different cache files
+    mh = Histdd.from_histogram(
+        np.ones((2, 2)),
+        bin_edges=[np.array([0, 1, 2]), np.array([0, 1, 2])],
+        axis_names=('s1', 's2'))
+    for scale in (1, 10):
+        ll = fd.LogLikelihood(
+            sources=dict(template=fd.TemplateSource),
+            arguments=dict(template=dict(template=mh * scale)),
+            data=pd.DataFrame(dict(s1=[0.5], s2=[0.5])),
+            mu_cache_dir=str(tmpdir))
+        assert np.isclose(ll.mu(source_name='template'), 4 * scale)
+
+    # Sources with attributes that cannot be described by content
+    # are not cached
+    class OpaqueSource(MuTestSource):
+        model_attributes = ('opaque',)
+        opaque = object()
+
+    with pytest.warns(UserWarning, match='Not caching'):
+        est = fd.CrossInterpolatedMu(OpaqueSource(), cache_dir=str(tmpdir),
+                                     progress=False, x=(-1, 1))
+    assert est.cache_path(OpaqueSource()) is None
+
+
+def test_unpickle_old_estimators():
+    # Estimators pickled before anchors were stored, with linearly spaced
+    # anchors, can still be used
+    for est_class, n_anchors in ((fd.CrossInterpolatedMu, 2),
+                                 (fd.GridInterpolatedMu, 3)):
+        est = est_class(MuTestSource(), progress=False,
+                        x=(-1, 1, n_anchors), y=(-1, 1, n_anchors))
+        state = {k: v for k, v in est.__dict__.items() if k != 'anchors'}
+        if est_class is fd.GridInterpolatedMu:
+            state['param_lowers'] = fd.np_to_tf(np.array([-1., -1.]))
+            state['param_uppers'] = fd.np_to_tf(np.array([1., 1.]))
+        old_est = est_class.__new__(est_class)
+        old_est.__dict__.update(state)
+
+        est_loaded = pickle.loads(pickle.dumps(old_est))
+        ll_loaded = fd.LogLikelihood(**ll_options, mu_estimators=est_loaded)
+        for params in (dict(), dict(x=0.3, y=-0.5)):
+            assert np.isclose(ll_loaded.mu(source_name='bla', **params),
+                              est(**{**dict(x=0., y=0.), **params}))
+
+
+def test_reweighted_mu():
+    source = fd.ERSource()
+    est = fd.ReweightedMu(
+        source, n_trials=int(1e5), seed=1,
+        extraction_eff=(0.9, 1.), g2=(19., 21.), s1_min=(1., 5.))
+    assert min(est.effective_events.values()) > 1000
+
+    for params in (dict(), dict(g2=19.5, s1_min=4.)):
+        np.random.seed(0)
+        mu_sim = source.estimate_mu(n_trials=int(2e5), **params)
+        np.testing.assert_allclose(est(**params), mu_sim, rtol=0.02)
+
+    # Reweighting gives smooth, nonzero gradients
+    g2 = tf.constant(20.5, dtype=fd.float_type())
+    with tf.GradientTape() as t:
+        t.watch(g2)
+        mu = est(g2=g2)
+    assert np.isfinite(t.gradient(mu, g2).numpy())
+
+    # Quanta splitting cannot be reweighted
+    with pytest.raises(ValueError):
+        fd.ReweightedMu(source, n_trials=100, er_pel_a=(10., 20.))
+
+
+def test_variance_reduced_mu():
+    source = fd.ERSource()
+    np.random.seed(0)
+    mu_ref = source.estimate_mu(n_trials=int(2e5))
+    mu_qmc = source.estimate_mu(n_trials=int(2e4), expected_acceptance=True,
+                                quasi_random=True)
+    np.testing.assert_allclose(mu_qmc, mu_ref, rtol=0.02)
+
+    # With common random numbers, nearby anchors see the same simulated
+    # events, so mu estimates vary smoothly with the parameters
+    est = fd.CrossInterpolatedMu(
+        source, n_trials=2000, progress=False,
+        expected_acceptance=True, common_random_numbers=True,
+        g2=(19.9, 20.1, 3))
+    mus = est.mus['g2'].numpy()
+    assert np.all(np.abs(np.diff(mus)) < 1e-3 * mus[0])
+
+
+def test_adaptive_anchors():
+    class CurvedSource(MuTestSource):
+        def our_mu(self, x=0, y=0):
+            # Curved for x < 0, linear for x > 0
+            return 42 + np.minimum(x, 0.)**2 * 10 + x + y
+
+    source = CurvedSource()
+    for est_class in (fd.CrossInterpolatedMu, fd.GridInterpolatedMu):
+        est = est_class(
+            source, progress=False,
+            x=(-1., 1., dict(tolerance=1e-3)), y=(-1., 1., 2))
+        anchors = est.anchors['x'].numpy()
+        assert est.anchor_counts['x'] == len(anchors)
+        assert est.interpolation_errors['x'] <= 1e-3
+        # Anchors are only refined where mu is curved
+        assert (anchors < 0).sum() > 3 * (anchors > 0).sum()
+        for x in np.linspace(-1, 1, 11):
+            np.testing.assert_allclose(
+                est(x=x, y=0.), source.our_mu(x=x, y=0.), rtol=2e-3)
+
+    # Refinement stops at max_anchors
+    with pytest.warns(UserWarning):
+        est = fd.CrossInterpolatedMu(
+            source, progress=False,
+            x=(-1., 1., dict(tolerance=1e-6, max_anchors=9)))
+    assert est.anchor_counts['x'] <= 9
@@ -0,0 +1,216 @@
+import os
+
+import flamedisx as fd
+import numpy as np
+import pytest
+from multihist import Histdd
+
+
+def template(slope):
+    """Return a normalized 1d template, with axis name 's1'"""
+    bin_edges = np.linspace(0., 10., 11)
+    hist = np.exp(slope * 0.5 * (bin_edges[1:] + bin_edges[:-1]))
+    return Histdd.from_histogram(hist / hist.sum(),
+                                 bin_edges=[bin_edges],
+                                 axis_names=['s1'])
+
+
+def log_constraint(**kwargs):
+    return -0.5 * ((kwargs['background_rate_multiplier']
+                    - kwargs['background_expected_counts']) / 5.)**2
+
+
+def make_ts_evaluation(ntoys=4, **kwargs):
+    return fd.TSEvaluation(
+        test_statistic=fd.TestStatisticTMuTilde,
+        signal_source_names=('signal',),
+        background_source_names=('background',),
+        sources=dict(signal=fd.TemplateSource,
+                     background=fd.TemplateSource),
+        arguments=dict(signal=dict(template=template(-0.5), events_per_bin=True),
+                       background=dict(template=template(0.), events_per_bin=True)),
+        expected_background_counts=dict(background=20.),
+        gaussian_constraint_widths=dict(background=5.),
+        log_constraint_fn=log_constraint,
+        ntoys=ntoys,
+        batch_size=100,
+        **kwargs)
+
+
+def test_toy_store(tmpdir):
+    tse = make_ts_evaluation()
+    simulate_dict_B, toy_data_B, constraint_extra_args_B = \
+        tse.run_routine(generate_B_toys=True)
+    toy_kwargs = dict(mus_test=dict(signal=np.array([5.])),
+                      simulate_dict_B=simulate_dict_B,
+                      toy_data_B=toy_data_B,
+                      constraint_extra_args_B=constraint_extra_args_B,
+                      save_fits=True,
+                      seed=42,
+                      checkpoint_every=2)
+
+    store_dir = os.path.join(tmpdir, 'toys')
+    dists_SB, dists_B = tse.run_routine(**toy_kwargs, toy_store=store_dir)
+    store = fd.ToyStore(store_dir)
+    assert store.n_completed_toys('signal', 5., 0) == 4
+
+    # Merged results from the store match the in-memory results
+    merged_SB, merged_B = store.test_stat_dists()
+    np.testing.assert_allclose(merged_SB['signal'].ts_dists[5.],
+                               dists_SB['signal'].ts_dists[5.])
+    np.testing.assert_allclose(merged_B['signal'].ts_dists[5.],
+                               dists_B['signal'].ts_dists[5.])
+    fits = merged_SB['signal'].conditional_best_fits[5.]
+    assert len(fits) == 4
+    np.testing.assert_allclose(fits['signal_rate_multiplier'], 5.)
+    np.testing.assert_allclose(
+        fits[1]['background_rate_multiplier'],
+        dists_SB['signal'].conditional_best_fits[5.][1]['background_rate_multiplier'])
+
+    # Remove the last shard, as if the run were interrupted. The resumed
+    # run reproduces the toys of the uninterrupted run.
+    shards = sorted(f for f in os.listdir(store_dir) if f.startswith('toys'))
+    assert len(shards) == 2
+    os.remove(os.path.join(store_dir, shards[-1]))
+    assert store.n_completed_toys('signal', 5., 0) == 2
+    resumed_SB, resumed_B = tse.run_routine(**toy_kwargs, toy_store=store)
+    np.testing.assert_allclose(resumed_SB['signal'].ts_dists[5.],
+                               dists_SB['signal'].ts_dists[5.],
+                               rtol=1e-4, atol=1e-4)
+    np.testing.assert_allclose(resumed_B['signal'].ts_dists[5.],
+                               dists_B['signal'].ts_dists[5.],
+                               rtol=1e-4, atol=1e-4)
+
+
+def test_toy_store_source_names(tmpdir):
+    # Source names are stored in the shards, not parsed from the file names
+    store = fd.ToyStore(str(tmpdir))
+    names = ['wimp', 'wimp__50GeV', 'wimp*']
+    for i, name in enumerate(names):
+        for start, stop in [(0, 2), (2, 3)]:
+            store.write_toys(name, 1., 0, start, stop,
+                             ts_values_SB=np.full(stop - start, float(i)),
+                             ts_values_B=np.zeros(stop - start),
+                             seeds=np.arange(start, stop))
+        store.write_observed(name, 1., test_stat=float(i))
+
+    assert store._signal_source_names('toys') == sorted(names)
+    for i, name in enumerate(names):
+        assert store.n_completed_toys(name, 1., 0) == 3
+        np.testing.assert_array_equal(
+            store.read_toys(name, 1., 0)['ts_values_SB'], np.full(3, float(i)))
+        assert store.read_observed(name, 1.)['test_stat'] == float(i)
+
+    dists_SB, _ = store.test_stat_dists()
+    assert sorted(dists_SB.keys()) == sorted(names)
+    np.testing.assert_array_equal(dists_SB['wimp'].ts_dists[1.], np.zeros(3))
+    observed = store.observed_test_stats()
+    assert observed['wimp__50GeV'].test_stats[1.] == 1.
+
+    with pytest.raises(ValueError):
+        store.write_observed(os.path.join('wimp', '50GeV'), 1., test_stat=0.)
+
+
+def test_adaptive_ntoys():
+    # p-value errors are binomial, and non-zero for p-values of 0 or 1
+    p_val, p_val_error = fd.non_asymptotic_inference.p_val_with_error(
+        np.arange(100.), 89.5)
+    assert np.isclose(p_val, 0.1)
+    assert np.isclose(p_val_error, np.sqrt(0.1 * 0.9 / 100), rtol=0.05)
+    assert fd.non_asymptotic_inference.p_val_with_error(np.arange(10.), 20.)[1] > 0
+
+    # Stop once the p-value is clearly away from conf_level,
+    # or known precisely enough
+    tse = make_ts_evaluation(ntoys=1000)
+    tse.conf_level = 0.1
+    tse.ntoys_min = 10
+    tse.observed_test_stats = None
+    ts_B = np.full(100, 5.)
+    assert not tse.p_val_resolved(np.zeros(5), ts_B, 1., 'signal')
+    assert tse.p_val_resolved(np.zeros(50), ts_B, 1., 'signal')
+    ts_SB = np.linspace(0., 10., 50)
+    assert not tse.p_val_resolved(ts_SB, np.full(100, 9.), 1., 'signal')
+    tse.p_val_precision = 0.1
+    assert tse.p_val_resolved(ts_SB, np.full(100, 9.), 1., 'signal')
+
+    # For expected limits, the p-values at all band quantiles
+    # of the B-only test statistics must be resolved
+    tse.p_val_precision = 0.005
+    ts_B = np.concatenate([np.full(90, 0.5), np.full(10, 9.)])
+    assert not tse.p_val_resolved(ts_SB, ts_B, 1., 'signal')
+    tse.band_quantiles = (0,)
+    assert tse.p_val_resolved(ts_SB, ts_B, 1., 'signal')
+
+    # Without conf_level, never stop early
+    tse.conf_level = None
+    assert not tse.p_val_resolved(np.zeros(50), ts_B, 1., 'signal')
+
+
+def test_adaptive_bands():
+    # With adapted numbers of toys, the B-only toys differ in number
+    # between mu_test values. Bands of expected limits are still available.
+    tse = make_ts_evaluation(ntoys=60, conf_level=0.1, ntoys_min=10,
+                             binned=True)
+    simulate_dict_B, toy_data_B, constraint_extra_args_B = \
+        tse.run_routine(generate_B_toys=True)
+    mus = np.array([3., 8., 15., 40.])
+    dists_SB, dists_B = tse.run_routine(
+        mus_test=dict(signal=mus),
+        simulate_dict_B=simulate_dict_B,
+        toy_data_B=toy_data_B,
+        constraint_extra_args_B=constraint_extra_args_B,
+        seed=42,
+        checkpoint_every=10)
+    n_toys_B = [len(dists_B['signal'].ts_dists[mu_test]) for mu_test in mus]
+    assert len(set(n_toys_B)) > 1
+
+    bands = fd.IntervalCalculator(
+        signal_source_names=('signal',),
+        observed_test_stats=None,
+        test_stat_dists_SB=dists_SB,
+        test_stat_dists_B=dists_B).get_bands(quantiles=[0, 1, 2])['signal']
+    assert mus[0] < bands[0] <= bands[1] <= bands[2] < mus[-1]
+
+
+def test_binned_toys():
+    tse = make_ts_evaluation(binned=True)
+    simulate_dict_B, toy_data_B, constraint_extra_args_B = \
+        tse.run_routine(generate_B_toys=True)
+    assert toy_data_B[0].shape == (10,)
+    dists_SB, dists_B = tse.run_routine(
+        mus_test=dict(signal=np.array([5.])),
+        simulate_dict_B=simulate_dict_B,
+        toy_data_B=toy_data_B,
+        constraint_extra_args_B=constraint_extra_args_B)
+    assert len(dists_SB['signal'].ts_dists[5.]) == 4
+    assert np.all(np.isfinite(dists_B['signal'].ts_dists[5.]))
+
+
+def test_batched_fits():
+    results = dict()
+    for batched_fits in (False, True):
+        tse = make_ts_evaluation(ntoys=6, batched_fits=batched_fits)
+        np.random.seed(1)
+        simulate_dict_B, toy_data_B, constraint_extra_args_B = \
+            tse.run_routine(generate_B_toys=True)
+        results[batched_fits] = tse.run_routine(
+            mus_test=dict(signal=np.array([0., 5.])),
+            simulate_dict_B=simulate_dict_B,
+            toy_data_B=toy_data_B,
+            constraint_extra_args_B=constraint_extra_args_B,
+            save_fits=True,
+            seed=3)
+
+    # The batched fitter finds the same best fits and test statistics
+    for dists, dists_batched in zip(results[False], results[True]):
+        for mu_test in (0., 5.):
+            np.testing.assert_allclose(dists_batched['signal'].ts_dists[mu_test],
+                                       dists['signal'].ts_dists[mu_test],
+                                       rtol=1e-3, atol=1e-3)
+            for toy in range(6):
+                fit = dists['signal'].unconditional_best_fits[mu_test][toy]
+                fit_batched = dists_batched['signal'].unconditional_best_fits[mu_test][toy]
+                for pname, value in fit.items():
+                    # (scipy converges less tightly, especially at the zero bound)
+                    np.testing.assert_allclose(fit_batched[pname], value,
+                                               rtol=2e-2, atol=1e-2)
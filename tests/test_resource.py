@@ -0,0 +1,66 @@
+import json
+import os
+
+import numpy as np
+
+import flamedisx as fd
+
+
+def test_resource_cache(tmpdir):
+    cache = fd.ResourceCache(max_bytes=3000, max_items=3)
+    for key in 'abc':
+        cache[key] = np.zeros(100)
+    assert cache.nbytes == 2400
+
+    # Least recently used resources are evicted first
+    assert cache.get('a') is not None
+    cache['d'] = np.zeros(100)
+    assert 'b' not in cache and 'a' in cache
+    assert cache.get('b') is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 1
+    assert cache.stats()['evictions'] == 1
+
+    # Resources over the byte budget are not cached
+    cache['e'] = np.zeros(1000)
+    assert 'e' not in cache and len(cache) == 3
+
+    # Memory-mapped arrays do not count towards the byte budget,
+    # but do count towards the number of resources
+    mmap = np.memmap(os.path.join(tmpdir, 'mmap'), dtype=np.uint8,
+                     mode='w+', shape=(1,))
+    assert fd.resource_nbytes(mmap) == 0
+    for i in range(5):
+        cache[('mmap', i)] = mmap
+    assert cache.nbytes == 0 and len(cache) == 3
+
+    cache.clear()
+    assert len(cache) == 0 and cache.stats()['evictions'] == 0
+
+
+def test_get_resource(tmpdir):
+    cache = fd.resource_cache
+    old_mmap_min_bytes = cache.mmap_min_bytes
+    cache.clear()
+    try:
+        # Resources are cached per (path, format)
+        fn = os.path.join(tmpdir, 'data.json')
+        with open(fn, mode='w') as f:
+            json.dump(dict(x=1), f)
+        assert fd.get_resource(fn) == dict(x=1)
+        assert fd.get_resource(fn) == dict(x=1)
+        assert fd.get_resource(fn, fmt='text') == '{"x": 1}'
+        assert (fn, 'json') in cache and (fn, 'text') in cache
+        assert cache.stats()['hits'] == 1
+
+        # Only .npy files above mmap_min_bytes are memory-mapped
+        cache.mmap_min_bytes = 1000
+        for n in (10, 1000):
+            fn = os.path.join(tmpdir, f'array_{n}.npy')
+            np.save(fn, np.arange(n))
+            result = fd.get_resource(fn)
+            np.testing.assert_array_equal(result, np.arange(n))
+            assert isinstance(result, np.memmap) == (n == 1000)
+    finally:
+        cache.mmap_min_bytes = old_mmap_min_bytes
+        cache.clear()
@@ -1,4 +1,6 @@
+from collections import OrderedDict
 from datetime import timedelta
+import os
 import warnings
 
 import numpy as np
@@ -150,6 +152,52 @@ def test_simulate(xes: fd.ERSource):
     assert simd['energy'].values[0] == e_test
 
 
+def test_columnar_simulation(xes: fd.ERSource):
+    """Test the columnar simulator gives the same distributions"""
+    n_ev = int(2e4)
+    results = []
+    for columnar in (False, True):
+        xes.columnar_simulation = columnar
+        np.random.seed(0)
+        simd = xes.simulate(n_ev)
+        assert isinstance(simd, pd.DataFrame)
+        results.append(simd)
+
+        # Data was not changed, and seeds are respected
+        assert len(xes.data) == 2
+        np.random.seed(0)
+        pd.testing.assert_frame_equal(simd, xes.simulate(n_ev))
+    xes.columnar_simulation = False
+
+    a, b = results
+    assert set(a.columns) == set(b.columns)
+    assert abs(len(a) - len(b)) < 5 * len(a)**0.5
+    for col in ('energy', 'electrons_produced', 'photons_detected',
+                's1', 's2'):
+        sigma = a[col].std() / len(a)**0.5
+        assert abs(a[col].mean() - b[col].mean()) < 5 * 2**0.5 * sigma
+
+
+def test_chunked_simulation():
+    """Test seeded simulations do not depend on the number of processes"""
+    source = fd.ERSource()
+    source.simulation_chunk_size = 1000
+    results = []
+    for n_workers in (1, 2):
+        np.random.seed(0)
+        results.append(source.simulate(2500, n_workers=n_workers, seed=42))
+        # Global random state was not disturbed
+        assert np.random.randint(1000) == np.random.RandomState(0).randint(1000)
+    pd.testing.assert_frame_equal(results[0], results[1])
+    assert 0 < len(results[0]) <= 2500
+    assert not results[0].equals(source.simulate(2500, seed=43))
+
+    ll = fd.LogLikelihood(sources=dict(er=fd.ERSource, nr=fd.NRSource),
+                          free_rates=('er', 'nr'))
+    pd.testing.assert_frame_equal(ll.simulate(seed=1, er_rate_multiplier=3.),
+                                  ll.simulate(seed=1, er_rate_multiplier=3.))
+
+
 def test_bounds(xes: fd.ERSource):
     """Test bounds on nq_produced and _detected"""
     data = xes.data
@@ -402,6 +450,60 @@ def test_clip(xes):
     xes.simulate(10, fix_truth=dict(event_time=t_good))
 
 
+def test_wimp_energy_spectrum():
+    # Vectorized lookup matches slicing the energy-time histogram,
+    # including at the time bin edges
+    b = fd.WIMPSource().model_blocks[0]
+    edges = b.time_edges
+    ts = np.concatenate([np.linspace(edges[0], edges[-1], 100), edges])
+    event_time = fd.j2000_to_event_time(ts)
+    ts = b.clip_j2000_times(j2000(event_time))
+    expected = np.stack([b.energy_hist.slicesum(t).histogram for t in ts])
+    np.testing.assert_array_equal(
+        b.energy_spectrum(event_time).numpy(),
+        fd.np_to_tf(expected).numpy())
+
+
+def test_wimp_spectra_cache(tmpdir, monkeypatch):
+    from flamedisx.lxe_blocks import energy_spectrum
+    n_calls = 0
+    rate_wimp_std = energy_spectrum.wr.rate_wimp_std
+
+    def counting_rate(*args, **kwargs):
+        nonlocal n_calls
+        n_calls += 1
+        return rate_wimp_std(*args, **kwargs)
+
+    monkeypatch.setattr(energy_spectrum.wr, 'rate_wimp_std', counting_rate)
+    monkeypatch.setattr(energy_spectrum, '_wimp_spectra_cache', OrderedDict())
+    time_centers = [7000., 7100.]
+    energy_edges = np.geomspace(1, 50, 10)
+    mws = [50., 200., 1000.]
+
+    spectra = fd.wimp_spectra(mws, time_centers, energy_edges,
+                              cache_dir=str(tmpdir))
+    assert spectra.shape == (3, 2, 9)
+    assert n_calls == 6
+
+    # Spectra are reused from memory and from disk, and rates scale
+    # with the cross-section
+    np.testing.assert_allclose(
+        fd.wimp_spectra(200., time_centers, energy_edges, sigma_nucleon=1e-46),
+        spectra[1] / 10)
+    energy_spectrum._wimp_spectra_cache.clear()
+    np.testing.assert_array_equal(
+        fd.wimp_spectra(mws, time_centers, energy_edges,
+                        cache_dir=str(tmpdir)),
+        spectra)
+    assert n_calls == 6
+
+    # Sources with the same settings share spectra
+    fd.WIMPSource()
+    n_calls = 0
+    fd.WIMPSource()
+    assert n_calls == 0
+
+
 def test_config(xes):
     # Test the use of config files to set source attributes
     xes.set_defaults(config='example')
@@ -454,3 +556,41 @@ def test_FrozenReservoirSource():
 
     assert (dr_data_nr_source_er == d_nr['er_diff_rate'].values).all()
     assert (dr_data_nr_source_nr == d_nr['nr_diff_rate'].values).all()
+
+
+def test_exponential_r_spatial_hist(tmpdir):
+    construct = fd.xenon.x1t_sr1.construct_exponential_r_spatial_hist
+    max_r, exp_const = 42.8387, 1.36
+
+    def old_sampler(n):
+        # Per-event rejection sampler, which the vectorized one replaced
+        r, z = np.zeros(n), np.zeros(n)
+        for i in range(n):
+            while True:
+                rr = max_r - np.random.exponential(scale=exp_const)
+                zr = np.random.uniform(-94., -8.)
+                if not ((zr > -2.63725 - 0.00946597 * rr * rr)
+                        | (zr < -158.173 + 0.0456094 * rr * rr)):
+                    break
+            r[i], z[i] = rr, zr
+        return r, z
+
+    np.random.seed(0)
+    mh = construct(n=int(1e5), cache_dir=str(tmpdir))
+    r_old, z_old = old_sampler(5000)
+
+    # The r and z marginals match those of the old sampler
+    for axis, x_old in ((0, r_old), (2, z_old)):
+        edges = mh.bin_edges[axis]
+        counts = mh.histogram.sum(axis=tuple({0, 1, 2} - {axis}))
+        cdf = np.cumsum(counts) / counts.sum()
+        cdf_old = np.cumsum(np.histogram(x_old, bins=edges)[0]) / len(x_old)
+        assert np.abs(cdf - cdf_old).max() < 0.03
+
+    # The second call loads the histogram from the cache
+    assert len(os.listdir(tmpdir)) == 1
+    np.random.seed(1)
+    mh_cached = construct(n=int(1e5), cache_dir=str(tmpdir))
+    np.testing.assert_array_equal(mh_cached.histogram, mh.histogram)
+    for edges, edges_cached in zip(mh.bin_edges, mh_cached.bin_edges):
+        np.testing.assert_array_equal(edges_cached, edges)
@@ -134,3 +134,34 @@ def test_multi_template():
     np.testing.assert_allclose(
         s.estimate_mu(a=0.5, b=0),
         (s._templates[0].mu + s._templates[2].mu)/2)
+
+
+def test_template_likelihood_annotated_data():
+    """Test setting pre-annotated data in a likelihood of template sources"""
+    bin_edges = [np.array([0, 1, 2, 3, 4]), np.array([0, 1, 2, 3])]
+    mh_a = Histdd.from_histogram(
+        histogram=np.array([[1, 2, 3], [4, 5, 6], [7, 8, 9], [10, 11, 12]]),
+        bin_edges=bin_edges, axis_names=('x', 'y'))
+    mh_b = Histdd.from_histogram(
+        histogram=np.ones((4, 3)),
+        bin_edges=bin_edges, axis_names=('x', 'y'))
+
+    lf = fd.LogLikelihood(
+        sources=dict(a=fd.TemplateSource, b=fd.TemplateSource),
+        arguments=dict(a=dict(template=mh_a), b=dict(template=mh_b)),
+        free_rates=('a', 'b'),
+        batch_size=4)
+
+    data = lf.simulate(annotate=True)
+    for sname in ('a', 'b'):
+        assert lf.sources[sname].column in data.columns
+
+    lf.set_data(data)
+    ll = lf(a_rate_multiplier=1.2, b_rate_multiplier=0.8)
+    guess = lf.guess()
+
+    lf.set_data(data, data_is_annotated=True, update_guesses=False)
+    assert lf.guess() == guess
+    np.testing.assert_allclose(
+        lf(a_rate_multiplier=1.2, b_rate_multiplier=0.8),
+        ll)